@@ -0,0 +1,68 @@
+import io
+import wave
+
+import numpy as np
+
+# Whisper works on 16 kHz mono
+SAMPLE_RATE = 16000
+
+
+def decode(file, rate=SAMPLE_RATE):
+    """
+    Decodes a clip in any container and codec FFmpeg reads (through PyAV)
+    into mono float32 PCM at `rate`, leaving the file where it started.
+    """
+    # Optional dependency, only needed to look inside the audio
+    import av
+
+    file.seek(0)
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=rate)
+    chunks = []
+    try:
+        with av.open(file, mode="r", metadata_errors="ignore") as container:
+            for frame in container.decode(audio=0):
+                chunks.extend(f.to_ndarray().reshape(-1) for f in resampler.resample(frame))
+            chunks.extend(f.to_ndarray().reshape(-1) for f in resampler.resample(None))
+    finally:
+        file.seek(0)
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32) / 32768.0
+
+
+def encode(samples, rate=SAMPLE_RATE, bitrate=24000):
+    """
+    Compact Ogg/Opus bytes for mono float32 PCM, for uploading to an API.
+    """
+    import av
+
+    buffer = io.BytesIO()
+    with av.open(buffer, mode="w", format="ogg") as container:
+        # Mid complexity encodes ~3x faster than the default 10 for a few % more bytes
+        stream = container.add_stream("libopus", rate=rate, options={"compression_level": "5"})
+        stream.layout = "mono"
+        stream.bit_rate = bitrate
+        frame = av.AudioFrame.from_ndarray(samples.astype(np.float32).reshape(1, -1), format="flt", layout="mono")
+        frame.sample_rate = rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+def duration_ms(samples, rate=SAMPLE_RATE):
+    return len(samples) * 1000 / rate
+
+
+def to_wav(samples, rate=SAMPLE_RATE):
+    """
+    16-bit mono WAV bytes for float32 PCM.
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as clip:
+        clip.setnchannels(1)
+        clip.setsampwidth(2)
+        clip.setframerate(rate)
+        clip.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
@@ -0,0 +1,84 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import metrics
+
+
+class MicroBatcher:
+    """
+    Collects items submitted within window_ms of the first one (up to
+    max_size) and hands them to handler(items) as one batch, which must
+    return one result per item. Each submit() gets a Future for its own
+    result, so callers on any thread (or event loop, via
+    asyncio.wrap_future) just wait on it.
+
+    One collector thread forms the batches; up to `concurrency` batches are
+    dispatched at once.
+    """
+
+    def __init__(self, handler, window_ms=5, max_size=8, concurrency=4, name="batch"):
+        self.handler = handler
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.name = name
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"{self.name}-dispatch")
+                threading.Thread(target=self._collect, name=f"{self.name}-collector", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, item):
+        self._start()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            closes = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = closes - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        now = time.perf_counter()
+        metrics.incr(f"{self.name}.batches")
+        metrics.incr(f"{self.name}.items", len(batch))
+        metrics.incr(f"{self.name}.wait_ms", round(sum(now - queued for _, _, queued in batch) * 1000))
+        try:
+            results = list(self.handler([item for item, _, _ in batch]))
+            if len(results) != len(batch):
+                raise ValueError(f"Batch handler returned {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+
+metrics.register_gauge(
+    "batch.mean_size",
+    lambda: round(metrics.get("batch.items") / max(1, metrics.get("batch.batches")), 2),
+)
+metrics.register_gauge(
+    "batch.wait_ms_per_item",
+    lambda: round(metrics.get("batch.wait_ms") / max(1, metrics.get("batch.items")), 2),
+)
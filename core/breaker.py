@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class BackendUnavailable(Exception):
+    """
+    Raised when every LLM backend failed or had its circuit open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Per-backend circuit breaker. Calls are recorded in a sliding window;
+    once enough of them failed or were slower than slow_ms the circuit
+    opens and calls are refused without touching the network. After
+    cooldown seconds a single probe call is let through (half-open): if it
+    succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, name, window=20, min_calls=5, failure_rate=0.5, slow_ms=3000, cooldown=15.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_ms = slow_ms
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)  # True for a failed or slow call
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        Returns True if a call may go to the backend now.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and now - self._opened_at < self.cooldown:
+                metrics.incr(f"breaker.{self.name}.rejected")
+                return False
+            # Half-open: one probe at a time; a probe that never reported
+            # back (e.g. an abandoned stream) is replaced after a cooldown
+            if self._probe_started is not None and now - self._probe_started < self.cooldown:
+                metrics.incr(f"breaker.{self.name}.rejected")
+                return False
+            self._state = HALF_OPEN
+            self._probe_started = now
+            metrics.incr(f"breaker.{self.name}.probes")
+            return True
+
+    def record(self, ok, elapsed_ms=0.0):
+        """
+        Records the outcome of an allowed call. A call slower than slow_ms
+        counts against the backend even though its answer was used.
+        """
+        failed = not ok or elapsed_ms > self.slow_ms
+        if failed:
+            metrics.incr(f"breaker.{self.name}.{'failures' if not ok else 'slow_calls'}")
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_started = None
+                if failed:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(failed)
+            if (
+                self._state == CLOSED
+                and len(self._outcomes) >= self.min_calls
+                and sum(self._outcomes) / len(self._outcomes) >= self.failure_rate
+            ):
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        metrics.incr(f"breaker.{self.name}.opened")
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                window=settings.LLM_BREAKER_WINDOW,
+                min_calls=settings.LLM_BREAKER_MIN_CALLS,
+                failure_rate=settings.LLM_BREAKER_FAILURE_RATE,
+                slow_ms=settings.LLM_BREAKER_SLOW_MS,
+                cooldown=settings.LLM_BREAKER_COOLDOWN,
+            )
+            _breakers[name] = breaker
+            metrics.register_gauge(f"breaker.{name}.state", lambda: breaker.state)
+        return breaker
@@ -0,0 +1,106 @@
+import math
+import re
+from collections import Counter
+
+from django.conf import settings
+
+from . import metrics
+from .parsing import FILLER_WORDS, STOPWORDS
+
+# The client marks completed sentences by a trailing full stop on the last word
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+_TOKEN_PIECE_RE = re.compile(r"[A-Za-z0-9']+|[^\sA-Za-z0-9']")
+_KEYWORD_RE = re.compile(r"\b[a-z][a-z']+\b")
+
+
+def count_tokens(text):
+    """
+    Estimates the number of BPE tokens in text without a tokenizer download:
+    roughly one token per 4 letters of each word, and one per punctuation mark.
+    """
+    return sum(max(1, math.ceil(len(piece) / 4)) for piece in _TOKEN_PIECE_RE.findall(text))
+
+
+def split_sentences(text):
+    return [s for s in _SENTENCE_END_RE.split((text or "").strip()) if s]
+
+
+def _tail_words(text, max_tokens):
+    """
+    Keeps the last words of text that fit in max_tokens.
+    """
+    kept = []
+    used = 0
+    for word in reversed(text.split()):
+        used += count_tokens(word)
+        if used > max_tokens:
+            break
+        kept.append(word)
+    return " ".join(reversed(kept))
+
+
+def keyword_summary(sentences, limit):
+    """
+    Compact summary of older sentences: their most frequent content words,
+    most recent first on ties.
+    """
+    counts = Counter()
+    recency = {}
+    for i, sentence in enumerate(sentences):
+        for word in _KEYWORD_RE.findall(sentence.lower()):
+            if word in STOPWORDS or word in FILLER_WORDS or len(word) < 3:
+                continue
+            counts[word] += 1
+            recency[word] = i
+    ranked = sorted(counts, key=lambda w: (-counts[w], -recency[w]))
+    return ", ".join(ranked[:limit])
+
+
+def build_context(text):
+    """
+    Builds the bounded context sent to the LLM from the full conversation text:
+    the current (unfinished) sentence, as many recent completed sentences as
+    fit in LLM_CONTEXT_HISTORY_TOKENS, and optionally a keyword summary of the
+    sentences before that. Prompt size then stays flat however long the
+    session gets.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return ""
+
+    if sentences[-1].endswith((".", "!", "?")):
+        current = ""
+        history = sentences
+    else:
+        current = sentences[-1]
+        history = sentences[:-1]
+
+    current = _tail_words(current, settings.LLM_CONTEXT_SENTENCE_TOKENS)
+
+    recent = []
+    budget = settings.LLM_CONTEXT_HISTORY_TOKENS
+    while history and count_tokens(history[-1]) <= budget:
+        budget -= count_tokens(history[-1])
+        recent.insert(0, history.pop())
+
+    parts = []
+    if history and settings.LLM_CONTEXT_SUMMARY_KEYWORDS:
+        summary = keyword_summary(history, settings.LLM_CONTEXT_SUMMARY_KEYWORDS)
+        if summary:
+            parts.append(f"(earlier topics: {summary})")
+    parts.extend(recent)
+    if current:
+        parts.append(current)
+    context = " ".join(parts)
+
+    if history:
+        metrics.incr("context.truncated")
+    metrics.incr("context.requests")
+    metrics.incr("context.tokens", count_tokens(context))
+    return context
+
+
+metrics.register_gauge(
+    "context.tokens_per_request",
+    lambda: round(metrics.get("context.tokens") / max(1, metrics.get("context.requests")), 1),
+)
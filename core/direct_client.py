@@ -0,0 +1,112 @@
+import json
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib decoder is used without it
+    orjson = None
+
+_USER_PLACEHOLDER = "\x1fuser\x1f"
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class DirectChatClient:
+    """
+    Chat completions against an OpenAI-compatible endpoint without
+    LangChain: the request body is serialised once per prompt with the user
+    message left open, so a call is one format(), one splice and one POST
+    on the pooled HTTP client, and the reply is decoded with orjson when it
+    is installed.
+    """
+
+    def __init__(self, url, api_key, body, system, user_template, timeout, http_client,
+                 http_async_client=None, defaults=None):
+        self.url = url
+        self.headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        self.user_template = user_template
+        self.defaults = defaults or {}
+        self.timeout = timeout
+        self.http_client = http_client
+        self.http_async_client = http_async_client
+        messages = [{"role": "system", "content": system}, {"role": "user", "content": _USER_PLACEHOLDER}]
+        self._templates = {
+            stream: dumps({**body, "stream": stream, "messages": messages}).split(dumps(_USER_PLACEHOLDER))
+            for stream in (False, True)
+        }
+
+    def payload(self, inputs, stream=False):
+        head, tail = self._templates[stream]
+        return head + dumps(self.user_template.format(**{**self.defaults, **inputs})) + tail
+
+    def _content(self, response):
+        response.raise_for_status()
+        metrics.incr("direct.requests")
+        return loads(response.content)["choices"][0]["message"]["content"] or ""
+
+    def invoke(self, inputs):
+        """
+        Returns the reply text for the prompt's inputs.
+        """
+        response = self.http_client.post(self.url, content=self.payload(inputs), headers=self.headers, timeout=self.timeout)
+        return self._content(response)
+
+    async def ainvoke(self, inputs):
+        response = await self.http_async_client.post(
+            self.url, content=self.payload(inputs), headers=self.headers, timeout=self.timeout,
+        )
+        return self._content(response)
+
+    @staticmethod
+    def _delta(line):
+        """
+        Text of one server-sent event line, or None at the end of the stream.
+        """
+        if not line.startswith("data:"):
+            return ""
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return None
+        choices = loads(data).get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def stream(self, inputs):
+        """
+        Yields the reply text as it is generated. Closing the generator
+        closes the connection, which stops generation upstream.
+        """
+        with self.http_client.stream(
+            "POST", self.url, content=self.payload(inputs, stream=True), headers=self.headers, timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            metrics.incr("direct.requests")
+            for line in response.iter_lines():
+                text = self._delta(line)
+                if text is None:
+                    return
+                if text:
+                    yield text
+
+    async def astream(self, inputs):
+        async with self.http_async_client.stream(
+            "POST", self.url, content=self.payload(inputs, stream=True), headers=self.headers, timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            metrics.incr("direct.requests")
+            async for line in response.aiter_lines():
+                text = self._delta(line)
+                if text is None:
+                    return
+                if text:
+                    yield text
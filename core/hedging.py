@@ -0,0 +1,172 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from . import metrics
+
+
+class HedgePolicy:
+    """
+    Decides when to hedge: after the observed latency percentile of
+    predictions (a fixed delay until enough samples exist), and only while
+    hedges stay under max_rate of requests. The cap is a token bucket: each
+    request earns max_rate of a hedge, each hedge spends one, and the bucket
+    starts full with `burst` hedges so the first requests after startup are
+    not throttled by a window with no history yet.
+    A hedged request whose primary was cancelled contributes its served
+    latency, a lower bound on what the primary alone would have taken.
+    """
+
+    def __init__(self, percentile=90, default_delay_ms=1000, min_delay_ms=50, max_rate=0.1, burst=5,
+                 min_samples=20, window=500):
+        self.percentile = percentile
+        self.default_delay_ms = default_delay_ms
+        self.min_delay_ms = min_delay_ms
+        self.max_rate = max_rate
+        self.burst = max(1.0, burst)
+        self.min_samples = min_samples
+        self.latency = metrics.LatencyWindow(window)
+        self._tokens = self.burst
+        self._lock = threading.Lock()
+
+    def delay_ms(self):
+        if len(self.latency) < self.min_samples:
+            return self.default_delay_ms
+        return max(self.min_delay_ms, self.latency.percentile(self.percentile))
+
+    def decide(self, hedge):
+        """
+        Records whether this request hedges, refusing when the rate cap is
+        reached, and returns the decision.
+        """
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.max_rate)
+            if hedge:
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                else:
+                    metrics.incr("hedge.rate_capped")
+                    hedge = False
+        return hedge
+
+    def observe(self, started):
+        self.latency.add((time.perf_counter() - started) * 1000)
+
+
+_policy = None
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def get_policy():
+    global _policy
+    with _lock:
+        if _policy is None:
+            _policy = HedgePolicy(
+                percentile=settings.LLM_HEDGE_PERCENTILE,
+                default_delay_ms=settings.LLM_HEDGE_DEFAULT_DELAY_MS,
+                min_delay_ms=settings.LLM_HEDGE_MIN_DELAY_MS,
+                max_rate=settings.LLM_HEDGE_MAX_RATE,
+                burst=settings.LLM_HEDGE_BURST,
+            )
+        return _policy
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=settings.LLM_HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _succeeded(future):
+    return future.exception() is None and bool(future.result())
+
+
+def hedged(primary, secondary):
+    """
+    Runs primary(cancel) and, if it has not answered by the policy's delay,
+    also secondary(cancel). Returns the first non-empty answer; the loser's
+    cancel event is set so it can stop generating. Each callable receives a
+    threading.Event and should return a list of suggestions.
+    """
+    policy = get_policy()
+    started = time.perf_counter()
+    metrics.incr("hedge.requests")
+    cancels = {"primary": threading.Event(), "secondary": threading.Event()}
+    executor = _get_executor()
+    first = executor.submit(primary, cancels["primary"])
+    futures = {first: "primary"}
+
+    done, _ = wait([first], timeout=policy.delay_ms() / 1000)
+    if not policy.decide(not done):
+        try:
+            return first.result()
+        finally:
+            policy.observe(started)
+
+    metrics.incr("hedge.fired")
+    futures[executor.submit(secondary, cancels["secondary"])] = "secondary"
+    pending = set(futures)
+    winner = None
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((f for f in done if _succeeded(f)), None)
+
+    for future, name in futures.items():
+        if future is not winner:
+            cancels[name].set()
+    policy.observe(started)
+    if winner is None:
+        return first.result()
+    metrics.incr(f"hedge.{futures[winner]}_won")
+    return winner.result()
+
+
+async def ahedged(primary, secondary):
+    """
+    Async version of hedged(): primary and secondary are coroutine functions
+    and the loser's task is cancelled.
+    """
+    policy = get_policy()
+    started = time.perf_counter()
+    metrics.incr("hedge.requests")
+    first = asyncio.ensure_future(primary())
+    tasks = {first: "primary"}
+    try:
+        done, _ = await asyncio.wait({first}, timeout=policy.delay_ms() / 1000)
+        if not policy.decide(not done):
+            try:
+                return await first
+            finally:
+                policy.observe(started)
+
+        metrics.incr("hedge.fired")
+        tasks[asyncio.ensure_future(secondary())] = "secondary"
+        pending = set(tasks)
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((t for t in done if _succeeded(t)), None)
+        policy.observe(started)
+        if winner is None:
+            return first.result()
+        metrics.incr(f"hedge.{tasks[winner]}_won")
+        return winner.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+metrics.register_gauge("hedge.fired_rate", lambda: metrics.ratio("hedge.fired", "hedge.requests"))
+metrics.register_gauge("hedge.delay_ms", lambda: _policy.delay_ms() if _policy else 0.0)
+metrics.register_gauge("hedge.p50_ms", lambda: _policy.latency.percentile(50) if _policy else 0.0)
+metrics.register_gauge("hedge.p99_ms", lambda: _policy.latency.percentile(99) if _policy else 0.0)
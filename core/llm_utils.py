@@ -1,118 +1,1168 @@
+import asyncio
 import logging
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
+import httpx
 from django.conf import settings
 from langchain.output_parsers import OutputFixingParser
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.output_parsers import BaseOutputParser, PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
+from . import local_model, logprobs, metrics, routing
+from .batching import MicroBatcher
+from .breaker import BackendUnavailable, get_breaker
+from .context import build_context
+from .direct_client import DirectChatClient
+from .hedging import ahedged, hedged
+from .ngram import suggest_next_words
+from .parsing import TokenStreamParser, repair_batch_results, repair_token_list
+from .phonetic import sound_alike_words
+from .prediction_cache import acached_prediction, cached_prediction, get_cache, make_key
+from .ranking import arank_with_deadline, history_words, merge_ranked, rank_with_deadline
+from .singleflight import acoalesced, acoalesced_stream, coalesced, coalesced_stream
+
 logger = logging.getLogger(__name__)
 
 # Define the expected output structure
 class TokenList(BaseModel):
     tokens: List[str] = Field(description="A list of 15 distinct lowercase string suggestions (nouns/verbs)")
 
-def get_llm():
+# Backend definitions. Each entry holds the ChatOpenAI kwargs for one
+# OpenAI-compatible endpoint; clients are built from these once per worker.
+BACKENDS = {
+    "ollama": lambda: dict(
+        # Local Ollama (OpenAI compatible)
+        base_url=settings.OLLAMA_API_BASE,
+        api_key="ollama",  # Dummy key
+        model=settings.MISTRAL_MODEL_NAME,
+        temperature=0.3,
+        # max_tokens=256 # Removed to avoid 422 error with local Ollama/Mistral
+        # (see GENERATION_LIMITS for how the output is bounded instead)
+    ),
+    "ollama_replica": lambda: dict(
+        # A second Ollama server, used as a hedging target (see LLM_HEDGE_BACKEND)
+        base_url=settings.OLLAMA_REPLICA_API_BASE or settings.OLLAMA_API_BASE,
+        api_key="ollama",
+        model=settings.MISTRAL_MODEL_NAME,
+        temperature=0.3,
+    ),
+    "mistral": lambda: dict(
+        # Mistral API via OpenAI SDK compatibility
+        base_url="https://api.mistral.ai/v1",
+        api_key=settings.MISTRAL_API_KEY,
+        model="ministral-3b-latest",
+        temperature=0.3,
+        # max_tokens=256
+    ),
+}
+
+# In-process CPU backend (see local_model.py), usable in LLM_BACKEND_ORDER
+# when settings.LOCAL_MODEL_PATH is set. It is not a ChatOpenAI client, so the
+# generation paths below call it directly.
+LOCAL_BACKEND = "local"
+
+# Native JSON modes, used when settings.LLM_STRUCTURED_OUTPUT is on.
+# Ollama accepts a full JSON schema; the Mistral API only has a JSON object mode.
+STRUCTURED_OUTPUT_FORMATS = {
+    "ollama": {
+        "type": "json_schema",
+        "json_schema": {"name": "token_list", "schema": TokenList.model_json_schema()},
+    },
+    "mistral": {"type": "json_object"},
+}
+STRUCTURED_OUTPUT_FORMATS["ollama_replica"] = STRUCTURED_OUTPUT_FORMATS["ollama"]
+
+# Per-backend bounds on generation. ChatOpenAI renames max_tokens to
+# max_completion_tokens, which the Ollama and Mistral OpenAI-compatible
+# endpoints reject (the 422 above), so the limit goes out as a plain
+# max_tokens field via extra_body; Ollama maps it to num_predict.
+# The stop sequences end generation right after the token list closes.
+GENERATION_LIMITS = {
+    "ollama": lambda: dict(
+        stop=["]}", "\n\n"],
+        extra_body={"max_tokens": settings.LLM_MAX_OUTPUT_TOKENS},
+    ),
+    "mistral": lambda: dict(
+        stop=["]}", "\n\n"],
+        extra_body={"max_tokens": settings.LLM_MAX_OUTPUT_TOKENS},
+    ),
+}
+GENERATION_LIMITS["ollama_replica"] = GENERATION_LIMITS["ollama"]
+
+# Backends whose server returns top_logprobs, for settings.LLM_PREDICTION_MODE
+LOGPROB_BACKENDS = ("ollama", "ollama_replica")
+
+# Local backends whose server keeps each slot's evaluated prompt (KV cache)
+# between requests; see settings.LLM_PROMPT_CACHE.
+PROMPT_CACHE_BACKENDS = ("ollama", "ollama_replica")
+
+_registry_lock = threading.Lock()
+_registry_pid = None
+_http_client = None
+_async_http_client = None
+_llms = {}
+_chains = {}
+_direct_clients = {}
+
+
+def backend_order(kind=None):
     """
-    Returns a configured ChatOpenAI instance based on settings.
+    Backends to try for a prediction, in the route's order for that kind
+    (see settings.LLM_ROUTES) or settings.LLM_BACKEND_ORDER. The Mistral API
+    is skipped when no key is configured. The local n-gram and lexicon
+    engines answer when all of them fail.
     """
-    if settings.USE_LOCAL_SLM_FOR_NEXT_WORD:
-        # Local Ollama (OpenAI compatible)
-        return ChatOpenAI(
-            base_url=settings.OLLAMA_API_BASE,
-            api_key="ollama",  # Dummy key
-            model=settings.MISTRAL_MODEL_NAME,
-            temperature=0.3,
+    return [
+        b for b in routing.get_route(kind).get("backends") or settings.LLM_BACKEND_ORDER
+        if (b in BACKENDS and (b != "mistral" or settings.MISTRAL_API_KEY))
+        or (b == LOCAL_BACKEND and settings.LOCAL_MODEL_PATH)
+    ]
+
+
+def backends_in_use():
+    """
+    Every backend some route may call.
+    """
+    return {b for kind in PROMPTS for b in backend_order(kind)}
+
+
+def default_backend():
+    order = backend_order()
+    if order:
+        return order[0]
+    return "ollama" if settings.USE_LOCAL_SLM_FOR_NEXT_WORD else "mistral"
+
+
+def _reset_after_fork():
+    """
+    Drops every cached client if we are running in a different process than
+    the one that built them (e.g. a gunicorn worker forked from a preloaded
+    master), so sockets are never shared between processes.
+    Must be called with _registry_lock held.
+    """
+    global _registry_pid, _http_client, _async_http_client
+    if _registry_pid == os.getpid():
+        return
+    _registry_pid = os.getpid()
+    _http_client = None
+    _async_http_client = None
+    _llms.clear()
+    _chains.clear()
+    _direct_clients.clear()
+
+
+def _http_limits(max_connections):
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_http_client():
+    """
+    Returns the worker-wide httpx client shared by all LLM backends.
+    Connections are kept alive between requests so we skip the TCP/TLS
+    handshake on every prediction.
+    """
+    global _http_client
+    with _registry_lock:
+        _reset_after_fork()
+        if _http_client is None:
+            _http_client = httpx.Client(timeout=settings.LLM_HTTP_TIMEOUT, limits=_http_limits(settings.LLM_HTTP_MAX_CONNECTIONS))
+        return _http_client
 
-            # max_tokens=256 # Removed to avoid 422 error with local Ollama/Mistral
-        )
-    else:
-        # Mistral API via OpenAI SDK compatibility (or direct OpenAI if configured for that)
-        # Assuming MISTRAL_API_KEY is used with Mistral endpoint via OpenAI client
-        return ChatOpenAI(
-            base_url="https://api.mistral.ai/v1",
-            api_key=settings.MISTRAL_API_KEY,
-            model="ministral-3b-latest",
-            temperature=0.3
-            # max_tokens=256
-        )
+
+def get_async_http_client():
+    """
+    Async counterpart of get_http_client(), used by ainvoke() in the async views.
+    Its pool belongs to the event loop that first uses it, so the async views
+    are only routed under the ASGI server (see settings.ASYNC_VIEWS).
+    """
+    global _async_http_client
+    with _registry_lock:
+        _reset_after_fork()
+        if _async_http_client is None:
+            # Async workers hold many more requests open at once
+            _async_http_client = httpx.AsyncClient(
+                timeout=settings.LLM_HTTP_TIMEOUT,
+                limits=_http_limits(settings.LLM_ASYNC_MAX_CONNECTIONS),
+            )
+        return _async_http_client
+
+
+def build_llm(backend=None, http_client=None, http_async_client=None, overrides=None):
+    """
+    Builds a new ChatOpenAI instance for the given backend (uncached), with
+    a route's model, temperature and max_tokens (see routing.llm_overrides()).
+    """
+    backend = backend or default_backend()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend: {backend}")
+    overrides = dict(overrides or {})
+    kwargs = BACKENDS[backend]()
+    for field in ("model", "temperature"):
+        if field in overrides:
+            kwargs[field] = overrides[field]
+    extra_body = {}
+    if settings.LLM_LIMIT_GENERATION and backend in GENERATION_LIMITS:
+        limits = GENERATION_LIMITS[backend]()
+        kwargs["stop"] = limits["stop"]
+        extra_body.update(limits["extra_body"])
+    if settings.LLM_STRUCTURED_OUTPUT and backend in STRUCTURED_OUTPUT_FORMATS:
+        # Sent through extra_body so LangChain keeps using the plain create() call
+        extra_body["response_format"] = STRUCTURED_OUTPUT_FORMATS[backend]
+    if settings.LLM_PROMPT_CACHE and backend in PROMPT_CACHE_BACKENDS:
+        # llama.cpp server field; Ollama reuses cached prefixes on its own
+        extra_body["cache_prompt"] = True
+    if "max_tokens" in overrides:
+        # Same plain field as GENERATION_LIMITS
+        extra_body["max_tokens"] = overrides["max_tokens"]
+    if extra_body:
+        kwargs["extra_body"] = extra_body
+    # Fail fast so the next backend or the n-gram fallback answers instead
+    kwargs["timeout"] = settings.LLM_BACKEND_TIMEOUTS.get(backend, settings.LLM_PREDICTION_TIMEOUT)
+    kwargs["max_retries"] = settings.LLM_MAX_RETRIES
+    if http_client is not None:
+        kwargs["http_client"] = http_client
+    if http_async_client is not None:
+        kwargs["http_async_client"] = http_async_client
+    return ChatOpenAI(**kwargs)
+
+
+def get_llm(backend=None, kind=None):
+    """
+    Returns the configured ChatOpenAI instance for a backend, as the route
+    for `kind` sets it up, built once per worker and sharing the pooled HTTP
+    client. Routes with the same settings share an instance.
+    """
+    backend = backend or default_backend()
+    overrides = routing.llm_overrides(kind, backend) if kind else {}
+    key = (backend, tuple(sorted(overrides.items())))
+    http_client = get_http_client()
+    http_async_client = get_async_http_client()
+    with _registry_lock:
+        llm = _llms.get(key)
+        if llm is None:
+            llm = build_llm(backend, http_client=http_client, http_async_client=http_async_client, overrides=overrides)
+            _llms[key] = llm
+        return llm
 
 # Initialize parser
 parser = PydanticOutputParser(pydantic_object=TokenList)
+FORMAT_INSTRUCTIONS = parser.get_format_instructions()
 
 # Create a robust fixing parser that can retry once if JSON is malformed
 # This requires an LLM to "fix" the output, which we reuse the main LLM for
 def get_parser(llm):
     return OutputFixingParser.from_llm(parser=parser, llm=llm)
 
-def predict_next_token_chain(sentence: str):
-    llm = get_llm()
-    fixing_parser = get_parser(llm)
-
-    system_prompt = (
-        "You are an AI assistant helping a stroke patient with Anomia. "
-        "Your task is to predict the next *meaningful content word* the user intends to say.\n\n"
-        "Patients often forget:\n"
-        "1. Specific Nouns (Food, Drink, Nature, Gardening, Entertainment, Places, Clothes, Proper Nouns)\n"
-        "2. Action Verbs (e.g., 'cutting', 'walking')\n\n"
-        "Guidelines:\n"
-        "- PRIORITIZE concrete, high-imageability nouns and action verbs.\n"
-        "- AVOID abstract concepts (low-imageability) if a concrete word fits.\n"
-        "- STRICTLY AVOID filler words, prepositions, articles, and conjunctions (e.g., the, a, is, and, of, to).\n"
-        "- Return a JSON object with a single key 'tokens' containing a list of 15 strings.\n"
-        "{format_instructions}"
-    )
 
+class TokenListParser(BaseOutputParser[TokenList]):
+    """
+    Parses a TokenList locally, repairing malformed output instead of asking
+    the LLM to fix it (see parsing.repair_token_list).
+    """
+
+    def parse(self, text: str) -> TokenList:
+        return TokenList(tokens=repair_token_list(text))
+
+    def get_format_instructions(self) -> str:
+        return FORMAT_INSTRUCTIONS
+
+    @property
+    def _type(self) -> str:
+        return "token_list"
+
+
+def get_output_parser(llm):
+    """
+    Returns the local repairing parser in structured-output mode, otherwise the
+    legacy OutputFixingParser (which costs a second LLM call on bad JSON).
+    """
+    if settings.LLM_STRUCTURED_OUTPUT:
+        return TokenListParser()
+    return get_parser(llm)
+
+NEXT_TOKEN_SYSTEM_PROMPT = (
+    "You are an AI assistant helping a stroke patient with Anomia. "
+    "Your task is to predict the next *meaningful content word* the user intends to say.\n\n"
+    "Patients often forget:\n"
+    "1. Specific Nouns (Food, Drink, Nature, Gardening, Entertainment, Places, Clothes, Proper Nouns)\n"
+    "2. Action Verbs (e.g., 'cutting', 'walking')\n\n"
+    "Guidelines:\n"
+    "- PRIORITIZE concrete, high-imageability nouns and action verbs.\n"
+    "- AVOID abstract concepts (low-imageability) if a concrete word fits.\n"
+    "- STRICTLY AVOID filler words, prepositions, articles, and conjunctions (e.g., the, a, is, and, of, to).\n"
+    "- Return a JSON object with a single key 'tokens' containing a list of 15 strings.\n"
+    "{format_instructions}"
+)
+NEXT_TOKEN_USER_PROMPT = "The user is speaking a sentence. usage context: '{sentence}'.{seed_hint} What are the 15 most likely *content words* (nouns/verbs) the user wants to say next?"
+
+WORD_COMPLETION_SYSTEM_PROMPT = (
+    "You are an AI assistant helping a stroke patient with Anomia. "
+    "The user has said a partial sound/word. Predict the full word they are trying to retrieve.\n\n"
+    "Focus on the vocabulary often lost by Anomia patients:\n"
+    "- Specific Concrete Nouns (Food: coffee, bread; Nature: tree, garden; Places, Clothes)\n"
+    "- Action Verbs\n"
+    "- Avoid abstract concepts.\n"
+    "- Be aware of phonemic errors (e.g. 'hos-ti-pal').\n"
+    "- Return a JSON object with a single key 'tokens' containing a list of 15 strings.\n"
+    "{format_instructions}"
+)
+WORD_COMPLETION_USER_PROMPT = "Context: {sentence}\nPartial sound: '{partial}'.{candidate_hint}\nList the 15 most likely full meaningful words."
+
+PROMPTS = {
+    "next_token": (NEXT_TOKEN_SYSTEM_PROMPT, NEXT_TOKEN_USER_PROMPT),
+    "word_completion": (WORD_COMPLETION_SYSTEM_PROMPT, WORD_COMPLETION_USER_PROMPT),
+}
+
+
+PROMPT_DEFAULTS = {"seed_hint": "", "candidate_hint": ""}
+
+
+def build_prompt(kind):
+    system_prompt, user_prompt = PROMPTS[kind]
     prompt = ChatPromptTemplate.from_messages([
         ("system", system_prompt),
-        ("user", "The user is speaking a sentence. usage context: '{sentence}'. What are the 15 most likely *content words* (nouns/verbs) the user wants to say next?")
+        ("user", user_prompt)
     ])
+    # The format instructions never change, so bake them in once
+    defaults = {"format_instructions": FORMAT_INSTRUCTIONS, **PROMPT_DEFAULTS}
+    return prompt.partial(**{k: v for k, v in defaults.items() if k in prompt.input_variables})
+
+
+def prompt_slot(kind, inputs, backend):
+    """
+    Server slot (llama.cpp id_slot) for this session's prompts of this kind,
+    so its previous turn's prompt is still cached there and only the newly
+    spoken words are evaluated. None when settings.LLM_PROMPT_CACHE_SLOTS is
+    unset, the backend is remote or the request carries no session.
+    """
+    session = inputs.get("session")
+    if not (settings.LLM_PROMPT_CACHE and settings.LLM_PROMPT_CACHE_SLOTS and session):
+        return None
+    if backend not in PROMPT_CACHE_BACKENDS:
+        return None
+    # Stable across workers, so a session keeps its slot whichever one serves it
+    return zlib.crc32(f"{session}:{kind}".encode()) % settings.LLM_PROMPT_CACHE_SLOTS
+
+
+def get_chain(kind, backend=None, parsed=True, slot=None):
+    """
+    Returns the precompiled prompt | llm | parser chain for 'next_token' or
+    'word_completion' on the given backend. With parsed=False the chain stops
+    at the LLM so its output can be streamed and parsed incrementally. With
+    a slot the request is pinned to that server slot (see prompt_slot()).
+    The LLM is set up as the kind's route says (see get_llm()).
+    """
+    backend = backend or default_backend()
+    key = (kind, backend, parsed, slot)
+    chain = _chains.get(key)
+    if chain is not None and _registry_pid == os.getpid():
+        return chain
+    llm = get_llm(backend, kind)
+    with _registry_lock:
+        chain = _chains.get(key)
+        if chain is None:
+            model = llm
+            if slot is not None:
+                # bind() replaces extra_body, so keep the backend's own fields
+                model = llm.bind(extra_body={**(llm.extra_body or {}), "id_slot": slot})
+            chain = build_prompt(kind) | model
+            if parsed:
+                chain = chain | get_output_parser(llm)
+            _chains[key] = chain
+        return chain
+
+
+def build_direct_client(kind, llm, slot=None):
+    """
+    Builds the LangChain-free client for a prompt (see settings.LLM_CLIENT),
+    sending exactly what the ChatOpenAI instance sends: the same endpoint,
+    model, temperature, stop sequences and extra_body fields.
+    """
+    body = {"model": llm.model_name, "temperature": llm.temperature, **(llm.extra_body or {})}
+    if llm.stop:
+        body["stop"] = llm.stop
+    if slot is not None:
+        body["id_slot"] = slot
+    system_prompt, user_prompt = PROMPTS[kind]
+    return DirectChatClient(
+        f"{llm.openai_api_base.rstrip('/')}/chat/completions",
+        llm.openai_api_key.get_secret_value() if llm.openai_api_key else "",
+        body,
+        system_prompt.format(format_instructions=FORMAT_INSTRUCTIONS),
+        user_prompt,
+        timeout=llm.request_timeout,
+        http_client=llm.http_client,
+        http_async_client=llm.http_async_client,
+        defaults=PROMPT_DEFAULTS,
+    )
+
+
+def get_direct_client(kind, backend=None, slot=None):
+    """
+    Returns the direct client for a prompt on a backend, built once per
+    worker from the route's LLM (see get_llm()).
+    """
+    backend = backend or default_backend()
+    key = (kind, backend, slot)
+    client = _direct_clients.get(key)
+    if client is not None and _registry_pid == os.getpid():
+        return client
+    llm = get_llm(backend, kind)
+    with _registry_lock:
+        client = _direct_clients.get(key)
+        if client is None:
+            client = build_direct_client(kind, llm, slot)
+            _direct_clients[key] = client
+        return client
 
-    chain = prompt | llm | fixing_parser
 
+def warm_chains():
+    """
+    Builds each route's first HTTP backend's clients and chains ahead of the
+    first request.
+    """
     try:
-        result = chain.invoke({
-            "sentence": sentence,
-            "format_instructions": parser.get_format_instructions()
-        })
-        return result.tokens
+        for kind in PROMPTS:
+            backend = next((b for b in backend_order(kind) if b in BACKENDS), None)
+            if backend is not None:
+                get_chain(kind, backend)
     except Exception as e:
-        logger.error(f"LangChain prediction failed: {e}")
-        return []
-
-def predict_word_completion_chain(sentence: str, partial: str):
-    llm = get_llm()
-    fixing_parser = get_parser(llm)
-
-    system_prompt = (
-        "You are an AI assistant helping a stroke patient with Anomia. "
-        "The user has said a partial sound/word. Predict the full word they are trying to retrieve.\n\n"
-        "Focus on the vocabulary often lost by Anomia patients:\n"
-        "- Specific Concrete Nouns (Food: coffee, bread; Nature: tree, garden; Places, Clothes)\n"
-        "- Action Verbs\n"
-        "- Avoid abstract concepts.\n"
-        "- Be aware of phonemic errors (e.g. 'hos-ti-pal').\n"
-        "- Return a JSON object with a single key 'tokens' containing a list of 15 strings.\n"
-        "{format_instructions}"
-    )
+        logger.warning(f"Could not prebuild LLM chains: {e}")
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("user", "Context: {sentence}\nPartial sound: '{partial}'.\nList the 15 most likely full meaningful words.")
-    ])
 
-    chain = prompt | llm | fixing_parser
+metrics.register_gauge(
+    "generation.chunks_per_request",
+    lambda: round(metrics.get("generation.chunks") / max(1, metrics.get("generation.requests")), 2),
+)
+
+
+def _backend_attempts(backend, kind=None):
+    """
+    Yields the backends to try in order with their circuit breakers, skipping
+    those whose circuit is open. An explicit backend is tried on its own.
+    """
+    for name in [backend] if backend else backend_order(kind):
+        breaker = get_breaker(name)
+        if breaker.allow():
+            yield name, breaker
+
+
+def _elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+def _no_backend(last_error):
+    if last_error is not None:
+        return last_error
+    metrics.incr("breaker.all_open")
+    return BackendUnavailable("No LLM backend available")
+
+
+def iter_tokens(kind, inputs, backend=None):
+    """
+    Yields suggestions from the first backend in backend_order(kind) that
+    answers; a backend that fails before its first suggestion hands over to
+    the next one.
+    """
+    last_error = None
+    for i, (name, breaker) in enumerate(_backend_attempts(backend, kind)):
+        start = time.perf_counter()
+        produced = False
+        try:
+            for token in _iter_backend_tokens(kind, inputs, name):
+                produced = True
+                yield token
+        except Exception as e:
+            breaker.record(False)
+            if produced:
+                raise
+            logger.warning(f"LLM backend '{name}' failed: {e}")
+            last_error = e
+            continue
+        breaker.record(True, _elapsed_ms(start))
+        if i:
+            metrics.incr("breaker.fallovers")
+        return
+    raise _no_backend(last_error)
+
+
+async def aiter_tokens(kind, inputs, backend=None):
+    """
+    Async version of iter_tokens().
+    """
+    last_error = None
+    for i, (name, breaker) in enumerate(_backend_attempts(backend, kind)):
+        start = time.perf_counter()
+        produced = False
+        stream = _aiter_backend_tokens(kind, inputs, name)
+        try:
+            async for token in stream:
+                produced = True
+                yield token
+        except Exception as e:
+            breaker.record(False)
+            if produced:
+                raise
+            logger.warning(f"LLM backend '{name}' failed: {e}")
+            last_error = e
+            continue
+        finally:
+            await stream.aclose()
+        breaker.record(True, _elapsed_ms(start))
+        if i:
+            metrics.incr("breaker.fallovers")
+        return
+    raise _no_backend(last_error)
+
+
+def _chunk_texts(stream):
+    try:
+        for chunk in stream:
+            yield chunk.content
+    finally:
+        stream.close()
+
+
+def _iter_backend_tokens(kind, inputs, backend):
+    """
+    Streams the raw chain and yields each suggestion as it is parsed. The
+    stream is closed, cancelling generation upstream, as soon as enough
+    distinct valid words have been parsed.
+    """
+    if backend == LOCAL_BACKEND:
+        yield from local_model.predict(kind, inputs)
+        return
+    parser = TokenStreamParser()
+    chunks = 0
+    slot = prompt_slot(kind, inputs, backend)
+    if settings.LLM_CLIENT == "direct":
+        stream = get_direct_client(kind, backend, slot).stream(inputs)
+    else:
+        stream = _chunk_texts(get_chain(kind, backend, parsed=False, slot=slot).stream(inputs))
+    try:
+        for text in stream:
+            chunks += 1
+            yield from parser.feed(text)
+            if parser.done:
+                metrics.incr("generation.early_stop")
+                break
+        else:
+            yield from parser.finish()
+    finally:
+        stream.close()
+        metrics.incr("generation.requests")
+        metrics.incr("generation.chunks", chunks)
+
+
+async def _achunk_texts(stream):
+    try:
+        async for chunk in stream:
+            yield chunk.content
+    finally:
+        await stream.aclose()
+
+
+async def _aiter_backend_tokens(kind, inputs, backend):
+    if backend == LOCAL_BACKEND:
+        for token in await asyncio.to_thread(local_model.predict, kind, inputs):
+            yield token
+        return
+    parser = TokenStreamParser()
+    chunks = 0
+    slot = prompt_slot(kind, inputs, backend)
+    if settings.LLM_CLIENT == "direct":
+        stream = get_direct_client(kind, backend, slot).astream(inputs)
+    else:
+        stream = _achunk_texts(get_chain(kind, backend, parsed=False, slot=slot).astream(inputs))
+    try:
+        async for text in stream:
+            chunks += 1
+            for token in parser.feed(text):
+                yield token
+            if parser.done:
+                metrics.incr("generation.early_stop")
+                break
+        else:
+            for token in parser.finish():
+                yield token
+    finally:
+        await stream.aclose()
+        metrics.incr("generation.requests")
+        metrics.incr("generation.chunks", chunks)
+
+
+def _call_backends(call, backend=None, kind=None):
+    """
+    Returns call(name) for the first backend that answers, in order and
+    behind the circuit breakers.
+    """
+    last_error = None
+    for i, (name, breaker) in enumerate(_backend_attempts(backend, kind)):
+        start = time.perf_counter()
+        try:
+            result = call(name)
+        except Exception as e:
+            breaker.record(False)
+            logger.warning(f"LLM backend '{name}' failed: {e}")
+            last_error = e
+            continue
+        breaker.record(True, _elapsed_ms(start))
+        if i:
+            metrics.incr("breaker.fallovers")
+        return result
+    raise _no_backend(last_error)
+
+
+async def _acall_backends(acall, backend=None, kind=None):
+    last_error = None
+    for i, (name, breaker) in enumerate(_backend_attempts(backend, kind)):
+        start = time.perf_counter()
+        try:
+            result = await acall(name)
+        except Exception as e:
+            breaker.record(False)
+            logger.warning(f"LLM backend '{name}' failed: {e}")
+            last_error = e
+            continue
+        breaker.record(True, _elapsed_ms(start))
+        if i:
+            metrics.incr("breaker.fallovers")
+        return result
+    raise _no_backend(last_error)
+
+
+def _invoke_backends(kind, inputs, backend):
+    def call(name):
+        if name == LOCAL_BACKEND:
+            return local_model.predict(kind, inputs)
+        slot = prompt_slot(kind, inputs, name)
+        if settings.LLM_CLIENT == "direct":
+            return repair_token_list(get_direct_client(kind, name, slot).invoke(inputs))
+        return get_chain(kind, name, slot=slot).invoke(inputs).tokens
+    return _call_backends(call, backend, kind)
+
+
+async def _ainvoke_backends(kind, inputs, backend):
+    async def acall(name):
+        if name == LOCAL_BACKEND:
+            return await asyncio.to_thread(local_model.predict, kind, inputs)
+        slot = prompt_slot(kind, inputs, name)
+        if settings.LLM_CLIENT == "direct":
+            return repair_token_list(await get_direct_client(kind, name, slot).ainvoke(inputs))
+        return (await get_chain(kind, name, slot=slot).ainvoke(inputs)).tokens
+    return await _acall_backends(acall, backend, kind)
+
+
+def hedge_backend(kind=None):
+    """
+    Backend that hedged requests go to: settings.LLM_HEDGE_BACKEND, or the
+    second backend in the kind's chain. None when hedging is off or has no
+    target.
+    """
+    if not settings.LLM_HEDGE_ENABLED:
+        return None
+    if settings.LLM_HEDGE_BACKEND:
+        return settings.LLM_HEDGE_BACKEND
+    order = backend_order(kind)
+    return order[1] if len(order) > 1 else None
+
+
+def _generate(kind, inputs, backend=None, cancel=None):
+    if not settings.LLM_EARLY_STOP:
+        return _invoke_backends(kind, inputs, backend)
+    tokens = []
+    stream = iter_tokens(kind, inputs, backend)
+    try:
+        for token in stream:
+            # A hedged call that lost closes its stream to stop generation
+            if cancel is not None and cancel.is_set():
+                break
+            tokens.append(token)
+    finally:
+        stream.close()
+    return tokens
+
+
+async def _agenerate(kind, inputs, backend=None):
+    if settings.LLM_EARLY_STOP:
+        return [token async for token in aiter_tokens(kind, inputs, backend)]
+    return await _ainvoke_backends(kind, inputs, backend)
+
+
+BATCH_SYSTEM_PROMPT = (
+    "You are an AI assistant helping stroke patients with Anomia find words. "
+    "You will get several numbered requests from different conversations; answer each one on its own.\n"
+    "- 'next' requests: the 15 most likely *content words* (nouns/verbs) the user wants to say next. "
+    "No articles, prepositions, conjunctions or pronouns.\n"
+    "- 'complete' requests: the user said a partial sound/word, possibly with phonemic errors "
+    "(e.g. 'hos-ti-pal'). Give the 15 most likely full words, mostly concrete nouns and action verbs.\n"
+    'Return only a JSON object: {"results": [{"id": 1, "tokens": ["...", ...]}, ...]} '
+    "with one entry per request, in order."
+)
+
+
+def batch_request_text(items):
+    lines = []
+    for i, (kind, inputs) in enumerate(items, 1):
+        if kind == "next_token":
+            lines.append(f"{i}. next: '{inputs['sentence']}'.{inputs.get('seed_hint', '')}")
+        else:
+            hint = inputs.get("candidate_hint", "").strip()
+            lines.append(f"{i}. complete: partial sound '{inputs['partial']}' in context '{inputs['sentence']}'. {hint}".rstrip())
+    return "\n".join(lines)
+
+
+def _generate_packed(items):
+    """
+    Batch handler: answers every (kind, inputs) request in a single
+    generation, one numbered request per line of the prompt. The stop
+    sequences and single-list JSON schema are lifted and the token limit
+    scaled to the batch.
+    """
+    if len(items) == 1:
+        return [_generate(*items[0])]
+    messages = [("system", BATCH_SYSTEM_PROMPT), ("user", batch_request_text(items))]
+    extra_body = {"max_tokens": settings.LLM_MAX_OUTPUT_TOKENS * len(items)}
+    if settings.LLM_STRUCTURED_OUTPUT:
+        extra_body["response_format"] = {"type": "json_object"}
+
+    def call(name):
+        if name == LOCAL_BACKEND:
+            # Nothing to pack in-process; answer each request in turn
+            return [local_model.predict(kind, inputs) for kind, inputs in items]
+        text = get_llm(name).bind(stop=[], extra_body=extra_body).invoke(messages).content
+        return repair_batch_results(text, len(items))
+
+    results = _call_backends(call)
+    metrics.incr("batch.missing", sum(1 for tokens in results if not tokens))
+    return results
+
+
+def _generate_parallel(items):
+    """
+    Batch handler: sends the requests side by side, for servers that
+    decode several sequences at once (e.g. OLLAMA_NUM_PARALLEL slots).
+    """
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        futures = [pool.submit(_generate, kind, inputs) for kind, inputs in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f"Batched generation failed: {e}")
+            results.append([])
+    return results
+
+
+_batcher = None
+
+
+def get_batcher():
+    global _batcher
+    with _registry_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(
+                _generate_packed if settings.LLM_BATCH_MODE == "packed" else _generate_parallel,
+                window_ms=settings.LLM_BATCH_WINDOW_MS,
+                max_size=settings.LLM_BATCH_MAX_SIZE,
+                concurrency=settings.LLM_BATCH_CONCURRENCY,
+            )
+        return _batcher
+
+
+def logprob_backend(kind, backend=None):
+    """
+    Backend to read next-word logprobs from when settings.LLM_PREDICTION_MODE
+    is 'logprobs': the requested or first capable backend in the chain.
+    None for word completion, in list mode or without a capable backend.
+    """
+    if kind != "next_token" or settings.LLM_PREDICTION_MODE != "logprobs":
+        return None
+    candidates = [backend] if backend else backend_order(kind)
+    # The local backend already ranks by logits, so it is used as it is
+    name = next((b for b in candidates if b in LOGPROB_BACKENDS or b == LOCAL_BACKEND), None)
+    return None if name == LOCAL_BACKEND else name
+
+
+def _generate_logprobs(inputs, backend):
+    return _call_backends(lambda name: logprobs.predict_next_words(get_llm(name, "next_token"), inputs["sentence"]), backend)
+
+
+async def _agenerate_logprobs(inputs, backend):
+    async def acall(name):
+        return await logprobs.apredict_next_words(get_llm(name, "next_token"), inputs["sentence"])
+    return await _acall_backends(acall, backend)
+
+
+def generate_tokens(kind, inputs, backend=None):
+    """
+    Returns the suggestion list for a prompt, stopping generation early when
+    settings.LLM_EARLY_STOP is on, otherwise running the parsed chain.
+    Backends are tried in order behind their circuit breakers; with
+    settings.LLM_BATCH_ENABLED the prompt joins a micro-batch, otherwise
+    with settings.LLM_HEDGE_ENABLED a slow call is hedged to hedge_backend().
+    Customised routes skip the batch, which is sent with the shared settings.
+    In logprobs mode next words come from logprob_backend(), falling back
+    to the list prompt if it fails.
+    """
+    scorer = logprob_backend(kind, backend)
+    if scorer:
+        try:
+            return _generate_logprobs(inputs, scorer)
+        except Exception as e:
+            metrics.incr("logprobs.fallback")
+            logger.warning(f"Logprob prediction failed, generating a list instead: {e}")
+    if backend is None and settings.LLM_BATCH_ENABLED and not routing.is_customised(kind):
+        return get_batcher().submit((kind, inputs)).result()
+    secondary = hedge_backend(kind) if backend is None else None
+    if secondary:
+        return hedged(
+            lambda cancel: _generate(kind, inputs, cancel=cancel),
+            lambda cancel: _generate(kind, inputs, secondary, cancel),
+        )
+    return _generate(kind, inputs, backend)
+
+
+async def agenerate_tokens(kind, inputs, backend=None):
+    scorer = logprob_backend(kind, backend)
+    if scorer:
+        try:
+            return await _agenerate_logprobs(inputs, scorer)
+        except Exception as e:
+            metrics.incr("logprobs.fallback")
+            logger.warning(f"Logprob prediction failed, generating a list instead: {e}")
+    if backend is None and settings.LLM_BATCH_ENABLED and not routing.is_customised(kind):
+        return await asyncio.wrap_future(get_batcher().submit((kind, inputs)))
+    secondary = hedge_backend(kind) if backend is None else None
+    if secondary:
+        return await ahedged(
+            lambda: _agenerate(kind, inputs),
+            lambda: _agenerate(kind, inputs, secondary),
+        )
+    return await _agenerate(kind, inputs, backend)
+
+
+def _predict(kind, sentence, partial, invoke):
+    """
+    Runs invoke() behind the prediction cache, coalescing concurrent identical
+    requests into a single upstream call.
+    """
+    key = make_key(kind, sentence, partial)
+    return cached_prediction(kind, sentence, partial, lambda: coalesced(key, invoke))
+
+
+def next_token_inputs(sentence, session=""):
+    """
+    Prompt inputs for a next-token prediction, seeded with the local n-gram
+    engine's suggestions when settings.NGRAM_SEED_PROMPT is on. The session
+    id only picks the server slot (see prompt_slot()).
+    """
+    inputs = {"sentence": sentence}
+    if session:
+        inputs["session"] = session
+    if settings.NGRAM_SEED_PROMPT:
+        seeds = suggest_next_words(sentence, k=settings.NGRAM_SEED_COUNT)
+        if seeds:
+            inputs["seed_hint"] = f" Words this patient has used after similar phrases: {', '.join(seeds)}."
+    return inputs
+
+
+def fallback_next_tokens(sentence):
+    """
+    Local n-gram answer used when the LLM fails, times out or returns nothing.
+    """
+    metrics.incr("ngram.fallback")
+    return suggest_next_words(sentence)
+
+
+def completion_inputs(sentence, partial, candidates, session=""):
+    """
+    Prompt inputs for a word completion. When the phonetic index found
+    sound-alike words, the LLM is asked to put them in context order.
+    """
+    inputs = {"sentence": sentence, "partial": partial}
+    if session:
+        inputs["session"] = session
+    if candidates:
+        inputs["candidate_hint"] = (
+            f"\nWords that sound like it: {', '.join(candidates)}. "
+            "Order these by how well they fit the context; only add other words if none fit."
+        )
+    return inputs
+
+
+def rerank_completions(tokens, candidates):
+    """
+    The LLM's completions merged with the phonetic candidates by weighted
+    rank (see ranking.merge_ranked()): words both suggest lead, and the
+    LLM's own words, which may not be in the lexicon ("physiotherapy" for
+    "physio"), outrank the weaker sound-alikes further down its list.
+    """
+    if not candidates:
+        return tokens
+    return merge_ranked({"llm": tokens, "lexicon": candidates})
+
+
+def fallback_completions(sentence, partial, candidates=()):
+    if candidates:
+        metrics.incr("phonetic.fallback")
+        return list(candidates)
+    metrics.incr("ngram.fallback")
+    prefix = completion_prefix(partial)
+    tokens = suggest_next_words(sentence, prefix=prefix) if prefix else []
+    # Fallback to returning the partial if nothing matches
+    return tokens or [partial]
+
+
+def completion_prefix(partial):
+    return re.match(r"[a-z]*", partial.lower()).group()
+
+
+def next_token_sources(conversation, sentence):
+    """
+    Local sources merged with the LLM answer under the prediction deadline.
+    """
+    return {
+        "ngram": lambda: suggest_next_words(sentence),
+        "history": lambda: history_words(conversation),
+    }
+
+
+def completion_sources(conversation, sentence, partial, candidates):
+    prefix = completion_prefix(partial)
+    return {
+        "lexicon": lambda: candidates,
+        "ngram": lambda: suggest_next_words(sentence, prefix=prefix) if prefix else [],
+        "history": lambda: history_words(conversation, partial),
+    }
+
+
+@routing.observed("next_token")
+def predict_next_token_chain(sentence: str, session: str = ""):
+    """
+    Next-word suggestions. With a prediction deadline (the route's, or
+    settings.PREDICTION_DEADLINE_MS) the LLM only gets that long: whatever it and the local sources have returned by then
+    is merged, and a late LLM answer fills the cache for the next request.
+    """
+    conversation = sentence
+    sentence = build_context(sentence)
+
+    def invoke():
+        return generate_tokens("next_token", next_token_inputs(sentence, session))
+
+    def llm():
+        try:
+            return _predict("next_token", sentence, "", invoke)
+        except Exception as e:
+            logger.error(f"LangChain prediction failed: {e}")
+            return []
+
+    deadline = routing.deadline_ms("next_token")
+    if deadline:
+        return rank_with_deadline(llm, next_token_sources(conversation, sentence), deadline)
+    return llm() or fallback_next_tokens(sentence)
+
+@routing.observed("word_completion")
+def predict_word_completion_chain(sentence: str, partial: str, session: str = ""):
+    conversation = sentence
+    sentence = build_context(sentence)
+    candidates = sound_alike_words(partial)
+    use_llm = settings.PHONETIC_LLM_RERANK or not candidates
+
+    def invoke():
+        return generate_tokens("word_completion", completion_inputs(sentence, partial, candidates, session))
+
+    def llm():
+        try:
+            tokens = _predict("word_completion", sentence, partial, invoke)
+        except Exception as e:
+            logger.error(f"LangChain completion failed: {e}")
+            return []
+        return rerank_completions(tokens, candidates) if tokens else []
+
+    deadline = routing.deadline_ms("word_completion")
+    if deadline:
+        tokens = rank_with_deadline(
+            llm if use_llm else None,
+            completion_sources(conversation, sentence, partial, candidates),
+            deadline,
+        )
+        return tokens or [partial]
+    if not use_llm:
+        return candidates
+    return llm() or fallback_completions(sentence, partial, candidates)
+
+
+def warm_prediction(kind, sentence, partial=""):
+    """
+    Runs the LLM for a logged context as the prediction chains would, but
+    without their deadline, local sources or fallback, so only the LLM's
+    answer is returned and cached. Returns [] for completions the phonetic
+    index answers without the LLM, which are never cached.
+    """
+    sentence = build_context(sentence)
+    if kind == "next_token":
+        inputs = next_token_inputs(sentence)
+    else:
+        candidates = sound_alike_words(partial)
+        if candidates and not settings.PHONETIC_LLM_RERANK:
+            return []
+        inputs = completion_inputs(sentence, partial, candidates)
+    return _predict(kind, sentence, partial, lambda: generate_tokens(kind, inputs))
+
+
+async def _apredict(kind, sentence, partial, ainvoke):
+    key = make_key(kind, sentence, partial)
+    return await acached_prediction(kind, sentence, partial, lambda: acoalesced(key, ainvoke))
+
+
+@routing.observed("next_token")
+async def apredict_next_token_chain(sentence: str, session: str = ""):
+    """
+    Async version of predict_next_token_chain() for the async views.
+    """
+    conversation = sentence
+    sentence = build_context(sentence)
+
+    async def ainvoke():
+        return await agenerate_tokens("next_token", next_token_inputs(sentence, session))
+
+    async def allm():
+        try:
+            return await _apredict("next_token", sentence, "", ainvoke)
+        except Exception as e:
+            logger.error(f"LangChain prediction failed: {e}")
+            return []
+
+    deadline = routing.deadline_ms("next_token")
+    if deadline:
+        return await arank_with_deadline(allm, next_token_sources(conversation, sentence), deadline)
+    return await allm() or fallback_next_tokens(sentence)
+
+
+@routing.observed("word_completion")
+async def apredict_word_completion_chain(sentence: str, partial: str, session: str = ""):
+    """
+    Async version of predict_word_completion_chain() for the async views.
+    """
+    conversation = sentence
+    sentence = build_context(sentence)
+    candidates = sound_alike_words(partial)
+    use_llm = settings.PHONETIC_LLM_RERANK or not candidates
+
+    async def ainvoke():
+        return await agenerate_tokens("word_completion", completion_inputs(sentence, partial, candidates, session))
+
+    async def allm():
+        try:
+            tokens = await _apredict("word_completion", sentence, partial, ainvoke)
+        except Exception as e:
+            logger.error(f"LangChain completion failed: {e}")
+            return []
+        return rerank_completions(tokens, candidates) if tokens else []
+
+    deadline = routing.deadline_ms("word_completion")
+    if deadline:
+        tokens = await arank_with_deadline(
+            allm if use_llm else None,
+            completion_sources(conversation, sentence, partial, candidates),
+            deadline,
+        )
+        return tokens or [partial]
+    if not use_llm:
+        return candidates
+    return await allm() or fallback_completions(sentence, partial, candidates)
+
+
+@routing.observed("next_token", stream=True)
+def stream_next_token_chain(sentence: str, session: str = ""):
+    """
+    Yields next-token suggestions one at a time as soon as each one has been
+    generated, instead of waiting for the whole list. Concurrent streams for
+    the same context share one generation (see singleflight.StreamFlight).
+    """
+    sentence = build_context(sentence)
+    key = make_key("next_token", sentence)
+    cache = get_cache()
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        yield from cached
+        return
+
+    def generate():
+        inputs = next_token_inputs(sentence, session)
+        # Logprob mode has the whole ranked list at once, so there is nothing to stream
+        stream = generate_tokens("next_token", inputs) if logprob_backend("next_token") else iter_tokens("next_token", inputs)
+        tokens = []
+        for token in stream:
+            tokens.append(token)
+            yield token
+        # Only a stream that ran to the end is cached
+        if tokens and cache is not None:
+            cache.set(key, tokens)
+
+    produced = False
+    try:
+        for token in coalesced_stream(key, generate):
+            produced = True
+            yield token
+    except Exception as e:
+        logger.error(f"LangChain streaming prediction failed: {e}")
+    if not produced:
+        yield from fallback_next_tokens(sentence)
+
+
+async def _anext_token_stream(inputs):
+    if logprob_backend("next_token"):
+        for token in await agenerate_tokens("next_token", inputs):
+            yield token
+        return
+    async for token in aiter_tokens("next_token", inputs):
+        yield token
+
+
+@routing.observed("next_token", stream=True)
+async def astream_next_token_chain(sentence: str, session: str = ""):
+    """
+    Async version of stream_next_token_chain() for the async views.
+    """
+    sentence = build_context(sentence)
+    key = make_key("next_token", sentence)
+    cache = get_cache()
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        for token in cached:
+            yield token
+        return
+
+    async def agenerate():
+        tokens = []
+        async for token in _anext_token_stream(next_token_inputs(sentence, session)):
+            tokens.append(token)
+            yield token
+        if tokens and cache is not None:
+            cache.set(key, tokens)
 
+    produced = False
     try:
-        result = chain.invoke({
-            "sentence": sentence,
-            "partial": partial,
-            "format_instructions": parser.get_format_instructions()
-        })
-        return result.tokens
+        async for token in acoalesced_stream(key, agenerate):
+            produced = True
+            yield token
     except Exception as e:
-        logger.error(f"LangChain completion failed: {e}")
-        # Fallback to returning the partial if fails
-        return [partial]
+        logger.error(f"LangChain streaming prediction failed: {e}")
+    if not produced:
+        for token in fallback_next_tokens(sentence):
+            yield token
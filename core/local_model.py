@@ -0,0 +1,182 @@
+import logging
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .logprobs import rank_words, word_probabilities
+from .parsing import MAX_TOKENS
+
+logger = logging.getLogger(__name__)
+
+_PREFIX_RE = re.compile(r"[a-z]*")
+
+
+class LocalModel:
+    """
+    A small quantised causal LM run inside the worker on CPU through
+    llama.cpp (llama-cpp-python), so predictions need no network or Ollama
+    daemon. Suggestions are read off the next-token logits rather than
+    generated text: word-initial tokens are ranked by probability and the
+    most likely word fragments are finished with a few greedy steps.
+
+    The evaluated prompt stays in the model's context, so the next turn of
+    a conversation only evaluates the newly spoken words. A context serves
+    one call at a time.
+    """
+
+    def __init__(self, path, threads=0, context=512, top_k=100, expansions=3, expansion_tokens=4):
+        # Optional dependencies, only needed for this backend
+        import llama_cpp
+        import numpy
+        self._llama_cpp = llama_cpp
+        self._np = numpy
+        self.llm = llama_cpp.Llama(
+            model_path=path,
+            n_ctx=context,
+            n_threads=threads or None,
+            n_threads_batch=threads or None,
+            verbose=False,
+        )
+        self.context = context
+        self.top_k = top_k
+        self.expansions = expansions
+        self.expansion_tokens = expansion_tokens
+        self._lock = threading.Lock()
+
+    def _text(self, token):
+        return self.llm.detokenize([token]).decode("utf-8", errors="ignore")
+
+    def _eval(self, tokens):
+        """
+        Evaluates tokens and returns the logits for the next one, reusing
+        the longest prefix already in the context.
+        """
+        llm = self.llm
+        common = 0
+        for cached, token in zip(llm.input_ids[:llm.n_tokens], tokens):
+            if cached != token:
+                break
+            common += 1
+        # The last token is always evaluated again so its logits are current
+        common = min(common, len(tokens) - 1)
+        llm.n_tokens = common
+        llm.eval(tokens[common:])
+        metrics.incr("local.prompt_tokens", len(tokens))
+        metrics.incr("local.evaluated_tokens", len(tokens) - common)
+        # Read straight from the context: Llama.scores is only filled with logits_all
+        logits = self._llama_cpp.llama_get_logits_ith(llm.ctx, -1)
+        return self._np.ctypeslib.as_array(logits, shape=(llm.n_vocab(),)).copy()
+
+    def _log_softmax(self, logits):
+        np = self._np
+        shifted = logits - logits.max()
+        return shifted - np.log(np.exp(shifted).sum())
+
+    def _expand(self, prompt, token):
+        """
+        Greedily extends a word fragment until the model starts a new word.
+        """
+        tokens = prompt + [token]
+        text = self._text(token)
+        for _ in range(self.expansion_tokens):
+            following = int(self._eval(tokens).argmax())
+            piece = self._text(following)
+            if following == self.llm.token_eos() or not piece[:1].isalpha():
+                break
+            tokens.append(following)
+            text += piece
+        return text.strip().lower()
+
+    def predict(self, sentence, prefix="", limit=MAX_TOKENS):
+        """
+        Next-word suggestions for sentence; with a prefix, only words that
+        start with it (word completion).
+        """
+        with self._lock:
+            prompt = self.llm.tokenize(sentence.strip().encode("utf-8"), add_bos=True)
+            # Keep the latest words, leaving room for the expansion steps
+            room = self.context - self.expansion_tokens - 2
+            if len(prompt) > room:
+                prompt = prompt[:1] + prompt[-(room - 1):]
+            logprobs = self._log_softmax(self._eval(prompt))
+            top = self._np.argpartition(-logprobs, self.top_k)[:self.top_k]
+            top = top[self._np.argsort(-logprobs[top])]
+
+            entries = []
+            ids = {}
+            for token in top:
+                text = self._text(int(token))
+                word = text.strip().lower()
+                # Only tokens that start a new word; the prompt ends mid-sentence
+                if not text.startswith(" ") or not word:
+                    continue
+                if prefix and not (word.startswith(prefix) or prefix.startswith(word)):
+                    continue
+                entries.append({"token": word, "logprob": float(logprobs[token])})
+                ids.setdefault(word, int(token))
+
+            words, fragments = word_probabilities(entries)
+            expanded = {}
+            for fragment in sorted(fragments, key=fragments.get, reverse=True)[:self.expansions]:
+                word = self._expand(prompt, ids[fragment])
+                if len(word) > len(fragment):
+                    expanded[fragment] = word
+            metrics.incr("local.requests")
+            tokens = rank_words(words, fragments, expanded, limit=self.top_k)
+        if prefix:
+            tokens = [t for t in tokens if t.startswith(prefix)]
+        return tokens[:limit]
+
+
+_model = None
+_model_pid = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """
+    Returns the worker's LocalModel, loading it from settings.LOCAL_MODEL_PATH
+    on first use (once per process).
+    """
+    global _model, _model_pid
+    with _model_lock:
+        if _model is None or _model_pid != os.getpid():
+            start = time.perf_counter()
+            _model = LocalModel(
+                settings.LOCAL_MODEL_PATH,
+                threads=settings.LOCAL_MODEL_THREADS,
+                context=settings.LOCAL_MODEL_CONTEXT,
+                top_k=settings.LOCAL_MODEL_TOP_K,
+                expansions=settings.LLM_LOGPROB_EXPANSIONS,
+                expansion_tokens=settings.LLM_LOGPROB_CONTINUATION_TOKENS,
+            )
+            _model_pid = os.getpid()
+            logger.info(
+                f"Loaded local model {settings.LOCAL_MODEL_PATH} "
+                f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+            )
+        return _model
+
+
+def is_loaded():
+    return _model is not None and _model_pid == os.getpid()
+
+
+def predict(kind, inputs):
+    """
+    Suggestions from the local model for a prediction prompt's inputs.
+    """
+    model = get_model()
+    if kind == "word_completion":
+        return model.predict(inputs["sentence"], prefix=_PREFIX_RE.match(inputs["partial"].lower()).group())
+    return model.predict(inputs["sentence"])
+
+
+metrics.register_gauge(
+    "local.evaluated_per_request",
+    lambda: round(metrics.get("local.evaluated_tokens") / max(1, metrics.get("local.requests")), 1),
+)
@@ -0,0 +1,140 @@
+import math
+import re
+
+from django.conf import settings
+
+from . import metrics
+from .ngram import is_content_word, is_known_word
+from .parsing import MAX_TOKENS, STOPWORDS, clean_tokens
+from .phonetic import get_index
+
+LOGPROB_SYSTEM_PROMPT = (
+    "You help a stroke patient with Anomia finish the sentence they are speaking. "
+    "Reply with only the next word they are most likely to say, preferably a concrete noun or action verb."
+)
+
+_LEADING_WORD_RE = re.compile(r"^[a-z']*")
+
+
+def next_word_messages(sentence):
+    return [("system", LOGPROB_SYSTEM_PROMPT), ("user", sentence)]
+
+
+def _bind(llm, max_tokens, **kwargs):
+    """
+    A short plain-text reply: the JSON schema, stop sequences and token
+    limit of the list mode are dropped (bind() replaces extra_body).
+    """
+    extra_body = {k: v for k, v in (llm.extra_body or {}).items() if k not in ("response_format", "max_tokens")}
+    extra_body["max_tokens"] = max_tokens
+    return llm.bind(stop=[], temperature=0, extra_body=extra_body, **kwargs)
+
+
+def word_probabilities(top_logprobs):
+    """
+    Splits the first-token alternatives into whole words and word fragments,
+    each with its summed probability (' Coffee' and 'coffee' are one word).
+    A token counts as a whole word when the lexicon or n-gram vocabulary
+    knows it (stopwords too, so they are dropped rather than expanded);
+    other alphabetic tokens are fragments to be expanded.
+    """
+    index = get_index()
+    words = {}
+    fragments = {}
+    for entry in top_logprobs:
+        token = entry["token"].strip().lower()
+        if not token.isalpha():
+            continue
+        known = token in index or token in STOPWORDS or is_known_word(token)
+        target = words if known else fragments
+        target[token] = target.get(token, 0.0) + math.exp(entry["logprob"])
+    return words, fragments
+
+
+def _expansion(fragment, text):
+    """
+    The word a continuation completes. A server that does not continue the
+    prefilled reply answers afresh, so a reply that already starts with the
+    fragment is taken as the whole word.
+    """
+    text = text.lower()
+    if not text[:1].isalpha():
+        return fragment
+    if text.startswith(fragment):
+        return _LEADING_WORD_RE.match(text).group()
+    return fragment + _LEADING_WORD_RE.match(text).group()
+
+
+def _expansion_inputs(messages, fragments):
+    """
+    The settings.LLM_LOGPROB_EXPANSIONS most likely fragments, each as a
+    prefilled assistant reply for the model to finish.
+    """
+    chosen = sorted(fragments, key=fragments.get, reverse=True)[:settings.LLM_LOGPROB_EXPANSIONS]
+    return chosen, [messages + [("assistant", fragment)] for fragment in chosen]
+
+
+def rank_words(words, fragments, expanded, limit=MAX_TOKENS):
+    """
+    Merges whole words and expanded fragments, drops non-content words and
+    returns them by probability.
+    """
+    probs = dict(words)
+    for fragment, word in expanded.items():
+        probs[word] = probs.get(word, 0.0) + fragments[fragment]
+    ranked = sorted(probs, key=probs.get, reverse=True)
+    return clean_tokens([w for w in ranked if is_content_word(w)], limit)
+
+
+def _top_logprobs(message):
+    content = (message.response_metadata.get("logprobs") or {}).get("content") or []
+    if not content:
+        raise ValueError("Backend returned no logprobs")
+    return content[0].get("top_logprobs") or []
+
+
+def _expanded(chosen, replies):
+    expanded = {}
+    for fragment, reply in zip(chosen, replies):
+        if isinstance(reply, Exception):
+            continue
+        word = _expansion(fragment, reply.content)
+        if len(word) > len(fragment) or word in get_index() or is_known_word(word):
+            expanded[fragment] = word
+    return expanded
+
+
+def predict_next_words(llm, sentence, limit=MAX_TOKENS):
+    """
+    Next-word suggestions from the model's next-token distribution: one
+    single-token reply with its top alternatives, then one short
+    continuation per likely word fragment, sent together.
+    """
+    messages = next_word_messages(sentence)
+    message = _bind(llm, 1, logprobs=True, top_logprobs=settings.LLM_TOP_LOGPROBS).invoke(messages)
+    words, fragments = word_probabilities(_top_logprobs(message))
+    chosen, inputs = _expansion_inputs(messages, fragments)
+    replies = _bind(llm, settings.LLM_LOGPROB_CONTINUATION_TOKENS).batch(inputs, return_exceptions=True) if inputs else []
+    metrics.incr("logprobs.requests")
+    metrics.incr("logprobs.expansions", len(inputs))
+    return rank_words(words, fragments, _expanded(chosen, replies), limit)
+
+
+async def apredict_next_words(llm, sentence, limit=MAX_TOKENS):
+    """
+    Async version of predict_next_words().
+    """
+    messages = next_word_messages(sentence)
+    message = await _bind(llm, 1, logprobs=True, top_logprobs=settings.LLM_TOP_LOGPROBS).ainvoke(messages)
+    words, fragments = word_probabilities(_top_logprobs(message))
+    chosen, inputs = _expansion_inputs(messages, fragments)
+    replies = await _bind(llm, settings.LLM_LOGPROB_CONTINUATION_TOKENS).abatch(inputs, return_exceptions=True) if inputs else []
+    metrics.incr("logprobs.requests")
+    metrics.incr("logprobs.expansions", len(inputs))
+    return rank_words(words, fragments, _expanded(chosen, replies), limit)
+
+
+metrics.register_gauge(
+    "logprobs.expansions_per_request",
+    lambda: round(metrics.get("logprobs.expansions") / max(1, metrics.get("logprobs.requests")), 2),
+)
@@ -0,0 +1,720 @@
+import io
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from django.conf import global_settings, settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import load_handler
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, RequestFactory, encode_multipart
+from django.test.utils import override_settings
+
+from core import context, hedging, llm_utils, local_model, metrics, ngram, phonetic, transcription, uploads
+
+DEFAULT_SENTENCE = "this morning i would like a cup of"
+
+
+def timed(fn, iterations):
+    """
+    Runs fn() `iterations` times and returns the per-call latencies in ms.
+    """
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summarise(samples):
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return (
+        f"mean {statistics.mean(ordered):8.3f} ms  "
+        f"p50 {statistics.median(ordered):8.3f} ms  "
+        f"p95 {p95:8.3f} ms  p99 {p99:8.3f} ms  (n={len(ordered)})"
+    )
+
+
+def bench_chains(command, options):
+    """
+    Per-request cost of building the LLM client, prompt and fixing parser on
+    every call (the old behaviour) versus reusing the pooled, precompiled chain.
+    """
+    iterations = options['iterations']
+    sentence = options['sentence']
+
+    def legacy_chain():
+        # What every request used to do before the backend registry existed
+        llm = llm_utils.build_llm()
+        prompt = llm_utils.ChatPromptTemplate.from_messages([
+            ("system", llm_utils.NEXT_TOKEN_SYSTEM_PROMPT),
+            ("user", llm_utils.NEXT_TOKEN_USER_PROMPT)
+        ]).partial(seed_hint="", format_instructions=llm_utils.parser.get_format_instructions())
+        return prompt | llm | llm_utils.get_parser(llm)
+
+    def pooled_chain():
+        return llm_utils.get_chain("next_token")
+
+    pooled_chain()  # build once, as warm_chains() does in the WSGI/ASGI entry points
+    command.stdout.write("chain construction")
+    command.stdout.write(f"  per-request build  {summarise(timed(legacy_chain, iterations))}")
+    command.stdout.write(f"  pooled registry    {summarise(timed(pooled_chain, iterations))}")
+
+    if not options['live']:
+        return
+
+    inputs = {"sentence": sentence}
+    command.stdout.write(f"live round trip against '{llm_utils.default_backend()}'")
+    command.stdout.write(f"  per-request build  {summarise(timed(lambda: legacy_chain().invoke(inputs), iterations))}")
+    command.stdout.write(f"  pooled registry    {summarise(timed(lambda: pooled_chain().invoke(inputs), iterations))}")
+
+
+def bench_generation(command, options):
+    """
+    Generated tokens and latency for an unbounded generation (no stop
+    sequences or token limit, waits for the whole reply) versus the bounded,
+    early-stopping stream. Needs --live.
+    """
+    if not options['live']:
+        raise CommandError("The generation suite calls the model; rerun with --live.")
+    iterations = options['iterations']
+    inputs = {"sentence": options['sentence']}
+
+    with override_settings(LLM_LIMIT_GENERATION=False):
+        unbounded = llm_utils.build_prompt("next_token") | llm_utils.build_llm(http_client=llm_utils.get_http_client())
+    before_tokens = []
+
+    def run_unbounded():
+        message = unbounded.invoke(inputs)
+        usage = message.usage_metadata or {}
+        before_tokens.append(usage.get("output_tokens") or len(message.content) // 4)
+
+    before_chunks = metrics.get("generation.chunks")
+
+    def run_bounded():
+        list(llm_utils.iter_tokens("next_token", inputs))
+
+    command.stdout.write(f"generation against '{llm_utils.default_backend()}'")
+    command.stdout.write(f"  unbounded          {summarise(timed(run_unbounded, iterations))}")
+    bounded = timed(run_bounded, iterations)
+    after_tokens = (metrics.get("generation.chunks") - before_chunks) / iterations
+    command.stdout.write(f"  early stop         {summarise(bounded)}")
+    command.stdout.write(
+        f"  generated tokens per request: {statistics.mean(before_tokens):.1f} before, "
+        f"~{after_tokens:.1f} after (streamed chunks)"
+    )
+
+
+SESSION_SENTENCES = [
+    "i went to the garden this morning.",
+    "the tomatoes are nearly ready to pick.",
+    "my daughter is coming for lunch on sunday.",
+    "we might have roast chicken with potatoes.",
+    "after that we could walk down to the river.",
+]
+
+
+def bench_context(command, options):
+    """
+    Prompt size as a session grows: the raw conversation the client sends
+    versus the bounded context actually sent to the LLM. With --live, also
+    the prediction latency at each session length.
+    """
+    command.stdout.write("session length -> raw tokens / bounded tokens")
+    for length in (1, 5, 20, 50, 100, 200):
+        history = " ".join(SESSION_SENTENCES[i % len(SESSION_SENTENCES)] for i in range(length))
+        text = f"{history} {options['sentence']}"
+        built = context.build_context(text)
+        line = f"  {length:4d} sentences  {context.count_tokens(text):6d} / {context.count_tokens(built):4d}"
+        if options['live']:
+            chain = llm_utils.get_chain("next_token")
+            raw = summarise(timed(lambda: chain.invoke({"sentence": text}), options['iterations']))
+            bounded = summarise(timed(lambda: chain.invoke({"sentence": built}), options['iterations']))
+            line += f"\n      raw      {raw}\n      bounded  {bounded}"
+        command.stdout.write(line)
+
+    long_text = " ".join(SESSION_SENTENCES * 40)
+    cost = summarise(timed(lambda: context.build_context(long_text), options['iterations']))
+    command.stdout.write(f"build_context on 200 sentences  {cost}")
+
+
+def bench_ngram(command, options):
+    """
+    Training time and per-call latency of the local n-gram engine.
+    """
+    start = time.perf_counter()
+    model = ngram.NgramModel()
+    for line in ngram.read_corpus_lines(settings.NGRAM_CORPUS_PATH):
+        model.update(line)
+    command.stdout.write(
+        f"trained on bundled corpus ({model.vocabulary_size} words) in "
+        f"{(time.perf_counter() - start) * 1000:.1f} ms"
+    )
+    sentence = options['sentence']
+    command.stdout.write(f"  next word   {summarise(timed(lambda: model.predict(sentence), options['iterations']))}")
+    command.stdout.write(f"  completion  {summarise(timed(lambda: model.predict(sentence, prefix='t'), options['iterations']))}")
+    command.stdout.write(f"  update      {summarise(timed(lambda: model.update(sentence + ' tea.'), options['iterations']))}")
+    command.stdout.write(f"  '{sentence}' -> {', '.join(model.predict(sentence, k=8))}")
+
+
+PHONETIC_QUERIES = ["hostipal", "hos", "nife", "sandwitch", "choclate", "garding", "umbrela", "fone"]
+SYLLABLES = [
+    "ba", "ber", "bo", "ca", "cher", "da", "del", "fa", "fin", "ga", "gar", "ha", "hos", "ka",
+    "la", "lin", "ma", "mer", "na", "nel", "pa", "pi", "po", "ra", "ri", "sa", "sha", "sto",
+    "ta", "ter", "ti", "tho", "va", "wa", "win", "ya", "zo",
+]
+
+
+def bench_phonetic(command, options):
+    """
+    Lookup latency of the phonetic index as the lexicon grows: the bundled
+    lexicon, then padded with generated pseudo-words. Compares the BK-tree
+    against a linear scan over every key.
+    """
+    rng = random.Random(0)
+    base = phonetic.read_lexicon(settings.PHONETIC_LEXICON_PATH)
+    iterations = max(1, options['iterations'] // len(PHONETIC_QUERIES))
+
+    for size in (len(base), 2000, 10000, 50000):
+        words = dict.fromkeys(base)
+        while len(words) < size:
+            words["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))] = None
+        start = time.perf_counter()
+        index = phonetic.PhoneticIndex(words)
+        built = (time.perf_counter() - start) * 1000
+
+        keys = [phonetic.metaphone(query) for query in PHONETIC_QUERIES]
+
+        def tree():
+            for key in keys:
+                index.tree.search(key, 2)
+
+        def linear():
+            for key in keys:
+                pattern = phonetic.EditPattern(key)
+                [k for k in index.by_key if pattern.distance(k) <= 2]
+
+        def ranked():
+            for query in PHONETIC_QUERIES:
+                index.search(query)
+
+        command.stdout.write(f"{len(index):6d} words, {index.tree.size:6d} keys (built in {built:.0f} ms)")
+        for label, fn in (("bk-tree keys ", tree), ("linear keys  ", linear), ("ranked search", ranked)):
+            per_query = [s / len(PHONETIC_QUERIES) for s in timed(fn, iterations)]
+            command.stdout.write(f"  {label}  {summarise(per_query)}")
+
+    index = phonetic.PhoneticIndex(base)
+    for query in PHONETIC_QUERIES[:4]:
+        command.stdout.write(f"  '{query}' -> {', '.join(index.search(query, k=5))}")
+
+
+def bench_hedging(command, options):
+    """
+    Tail latency and upstream load of next-token generation without and
+    with hedging (against LLM_HEDGE_BACKEND or the second backend). Needs --live.
+    """
+    if not options['live']:
+        raise CommandError("The hedging suite calls the model; rerun with --live.")
+    iterations = options['iterations']
+
+    for enabled in (False, True):
+        hedging._policy = None  # fresh latency window per run
+        before = metrics.get("hedge.fired")
+        counter = iter(range(iterations))
+        with override_settings(LLM_HEDGE_ENABLED=enabled):
+            if enabled and not llm_utils.hedge_backend():
+                raise CommandError("No hedge target: set LLM_HEDGE_BACKEND or a second backend in LLM_BACKEND_ORDER.")
+            samples = timed(
+                lambda: llm_utils.generate_tokens("next_token", {"sentence": f"{options['sentence']} {next(counter)}"}),
+                iterations,
+            )
+        extra = metrics.get("hedge.fired") - before
+        command.stdout.write(f"  {'hedged  ' if enabled else 'unhedged'}  {summarise(samples)}")
+        command.stdout.write(f"            upstream calls {iterations + extra} ({extra / iterations:.0%} extra)")
+
+
+BATCH_CONFIGS = [
+    ("unbatched", dict(LLM_BATCH_ENABLED=False)),
+    ("packed 2ms", dict(LLM_BATCH_ENABLED=True, LLM_BATCH_MODE="packed", LLM_BATCH_WINDOW_MS=2)),
+    ("packed 10ms", dict(LLM_BATCH_ENABLED=True, LLM_BATCH_MODE="packed", LLM_BATCH_WINDOW_MS=10)),
+    ("parallel 10ms", dict(LLM_BATCH_ENABLED=True, LLM_BATCH_MODE="parallel", LLM_BATCH_WINDOW_MS=10)),
+]
+
+
+def bench_batching(command, options):
+    """
+    Throughput versus latency of next-token generation with `--concurrency`
+    callers, unbatched and with each micro-batching mode. Needs --live.
+    """
+    if not options['live']:
+        raise CommandError("The batching suite calls the model; rerun with --live.")
+    iterations = options['iterations']
+    concurrency = options['concurrency']
+    command.stdout.write(f"{iterations} requests, {concurrency} concurrent, max batch {settings.LLM_BATCH_MAX_SIZE}")
+
+    for label, overrides in BATCH_CONFIGS:
+        llm_utils._batcher = None
+        batches = metrics.get("batch.batches")
+        with override_settings(**overrides):
+            def one(i):
+                start = time.perf_counter()
+                llm_utils.generate_tokens("next_token", {"sentence": f"{options['sentence']} {i}"})
+                return (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                samples = list(pool.map(one, range(iterations)))
+            elapsed = time.perf_counter() - start
+        batches = metrics.get("batch.batches") - batches
+        size = f", mean batch {iterations / batches:.1f}" if batches else ""
+        command.stdout.write(f"  {label:14s} {iterations / elapsed:6.1f} req/s{size}")
+        command.stdout.write(f"  {'':14s} {summarise(samples)}")
+    llm_utils._batcher = None
+
+
+PROMPT_CACHE_SESSIONS = 4
+
+
+def prompt_eval(data):
+    """
+    (evaluated prompt tokens, prompt-eval ms) from a llama.cpp response
+    ('timings') or an Ollama native one, or None if the server does not say.
+    """
+    if "timings" in data:
+        return data["timings"].get("prompt_n", 0), data["timings"].get("prompt_ms", 0.0)
+    if "prompt_eval_count" in data:
+        return data["prompt_eval_count"], data.get("prompt_eval_duration", 0) / 1e6
+    return None
+
+
+def post_prompt(llm, messages, fields, native):
+    """
+    Sends one prediction prompt as the chain would, plus the cache fields,
+    and returns the raw JSON reply. With native=True it goes to Ollama's
+    /api/chat, the only Ollama endpoint that reports prompt-eval time.
+    """
+    payload = llm._get_request_payload(messages)
+    extra_body = {**payload.pop("extra_body", {}), **fields}
+    base = llm.openai_api_base.rstrip("/")
+    client = llm_utils.get_http_client()
+    if native:
+        body = {
+            "model": payload["model"],
+            "messages": payload["messages"],
+            "stream": False,
+            "options": {"num_predict": extra_body.get("max_tokens"), "stop": payload.get("stop"), "temperature": payload.get("temperature")},
+        }
+        response = client.post(f"{base.removesuffix('/v1')}/api/chat", json=body, timeout=60)
+    else:
+        response = client.post(f"{base}/chat/completions", json={**payload, **extra_body}, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+def bench_prompt_cache(command, options):
+    """
+    Prompt-eval work per turn on the local backend while PROMPT_CACHE_SESSIONS
+    sessions speak word by word, interleaved, each turn asking for the next
+    word and completing the following one. Compares no prompt cache,
+    cache_prompt with the server choosing slots, and slots pinned per
+    session (LLM_PROMPT_CACHE_SLOTS, default 8). Ollama ignores both fields
+    and caches prefixes itself, so there the rows only differ by chance.
+    Needs --live.
+    """
+    if not options['live']:
+        raise CommandError("The prompt_cache suite calls the model; rerun with --live.")
+    backend = next((b for b in llm_utils.backend_order() if b in llm_utils.PROMPT_CACHE_BACKENDS), None)
+    if backend is None:
+        raise CommandError("No local backend in LLM_BACKEND_ORDER.")
+    llm = llm_utils.get_llm(backend)
+    slots = settings.LLM_PROMPT_CACHE_SLOTS or 8
+    words = [" ".join(SESSION_SENTENCES[(i + j) % len(SESSION_SENTENCES)] for j in range(len(SESSION_SENTENCES))).split()
+             for i in range(PROMPT_CACHE_SESSIONS)]
+    turns = min(options['iterations'], len(words[0]) - 1)
+
+    probe = llm_utils.build_prompt("next_token").invoke({"sentence": options['sentence']}).to_messages()
+    native = prompt_eval(post_prompt(llm, probe, {}, False)) is None and backend.startswith("ollama")
+    command.stdout.write(
+        f"{PROMPT_CACHE_SESSIONS} sessions x {turns} turns against '{backend}'"
+        f"{' (Ollama /api/chat for timings)' if native else ''}"
+    )
+
+    for label, overrides in (
+        ("no cache", dict(LLM_PROMPT_CACHE=False, LLM_PROMPT_CACHE_SLOTS=0)),
+        ("cache_prompt", dict(LLM_PROMPT_CACHE=True, LLM_PROMPT_CACHE_SLOTS=0)),
+        (f"pinned {slots} slots", dict(LLM_PROMPT_CACHE=True, LLM_PROMPT_CACHE_SLOTS=slots)),
+    ):
+        latencies, evaluated, eval_ms, prompt_tokens = [], [], [], []
+        for turn in range(turns):
+            for i, session_words in enumerate(words):
+                session = f"bench-{label}-{i}"
+                sentence = context.build_context(" ".join(session_words[:turn + 1]))
+                partial = session_words[turn + 1][:3]
+                for kind, inputs in (
+                    ("next_token", llm_utils.next_token_inputs(sentence, session)),
+                    ("word_completion", llm_utils.completion_inputs(sentence, partial, phonetic.sound_alike_words(partial), session)),
+                ):
+                    messages = llm_utils.build_prompt(kind).invoke(inputs).to_messages()
+                    with override_settings(**overrides):
+                        fields = {"cache_prompt": settings.LLM_PROMPT_CACHE}
+                        slot = llm_utils.prompt_slot(kind, inputs, backend)
+                    if slot is not None:
+                        fields["id_slot"] = slot
+                    start = time.perf_counter()
+                    data = post_prompt(llm, messages, fields, native)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    prompt_tokens.append(context.count_tokens(" ".join(m.content for m in messages)))
+                    stats = prompt_eval(data)
+                    if stats is not None:
+                        evaluated.append(stats[0])
+                        eval_ms.append(stats[1])
+        command.stdout.write(f"  {label:16s} {summarise(latencies)}")
+        if evaluated:
+            command.stdout.write(
+                f"  {'':16s} prompt ~{statistics.mean(prompt_tokens):.0f} tokens, evaluated "
+                f"{statistics.mean(evaluated):.0f} tokens in {statistics.mean(eval_ms):.1f} ms per turn"
+            )
+        else:
+            command.stdout.write(f"  {'':16s} (server did not report prompt-eval timings)")
+
+
+CANNED_REPLY = json.dumps({"tokens": ["coffee", "tea", "bread", "garden", "walk", "milk", "jam", "toast",
+                                      "eggs", "juice", "water", "butter", "cheese", "apple", "honey"]})
+
+
+def canned_transport():
+    """
+    Answers chat completions instantly with CANNED_REPLY (streamed in
+    4-character chunks when asked), so only client overhead is measured.
+    """
+    def handle(request):
+        if json.loads(request.content).get("stream"):
+            chunks = [CANNED_REPLY[i:i + 4] for i in range(0, len(CANNED_REPLY), 4)]
+            events = "".join(
+                f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': c}}]})}\n\n" for c in chunks
+            )
+            return httpx.Response(200, text=events + "data: [DONE]\n\n", headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={
+            "id": "x", "object": "chat.completion", "created": 0, "model": "m",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": CANNED_REPLY}, "finish_reason": "stop"}],
+        })
+    return httpx.MockTransport(handle)
+
+
+def bench_client(command, options):
+    """
+    Per-call overhead of the LangChain chain versus the direct client
+    (settings.LLM_CLIENT), both against an in-process endpoint that answers
+    instantly; with --live also against the configured backend.
+    """
+    iterations = options['iterations']
+    inputs = llm_utils.next_token_inputs(options['sentence'])
+    backend = next((b for b in llm_utils.backend_order() if b in llm_utils.BACKENDS), "ollama")
+    llm = llm_utils.build_llm(backend, http_client=httpx.Client(transport=canned_transport()))
+    chain = llm_utils.build_prompt("next_token") | llm
+    parsed = chain | llm_utils.TokenListParser()
+    direct = llm_utils.build_direct_client("next_token", llm)
+    cases = [
+        ("langchain invoke", lambda: parsed.invoke(inputs).tokens),
+        ("direct invoke", lambda: llm_utils.repair_token_list(direct.invoke(inputs))),
+        ("langchain stream", lambda: [c.content for c in chain.stream(inputs)]),
+        ("direct stream", lambda: list(direct.stream(inputs))),
+    ]
+    command.stdout.write(f"client overhead ({backend} request, instant in-process endpoint)")
+    means = {}
+    for label, fn in cases:
+        fn()
+        samples = timed(fn, iterations)
+        means[label] = statistics.mean(samples)
+        command.stdout.write(f"  {label:18s} {summarise(samples)}")
+    for mode in ("invoke", "stream"):
+        command.stdout.write(
+            f"  {mode}: {means[f'langchain {mode}'] - means[f'direct {mode}']:.3f} ms less per call "
+            f"({means[f'langchain {mode}'] / means[f'direct {mode}']:.1f}x)"
+        )
+    if options['live']:
+        command.stdout.write(f"live against '{backend}'")
+        for label, mode in (("langchain", "langchain"), ("direct", "direct")):
+            with override_settings(LLM_CLIENT=mode):
+                samples = timed(lambda: llm_utils.generate_tokens("next_token", inputs, backend), iterations)
+            command.stdout.write(f"  {label:18s} {summarise(samples)}")
+
+
+def proc_io():
+    """
+    This process's read/write syscall and byte counters, or None off Linux.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f)}
+    except OSError:
+        return None
+
+
+_file_ops = {"open": 0, "os.remove": 0}
+_file_ops_lock = threading.Lock()
+
+
+def _count_file_ops(event, args):
+    if event in _file_ops:
+        with _file_ops_lock:
+            _file_ops[event] += 1
+
+
+def bench_uploads(command, options):
+    """
+    Concurrent clip uploads through Django's default upload handlers plus
+    the old copy to a NamedTemporaryFile (reopened for the client, then
+    unlinked) versus the spooled handler handing its buffer over as it is.
+    Each upload is parsed and read once, as the transcription client would.
+    """
+    size = options['upload_kb'] * 1024
+    body = encode_multipart(BOUNDARY, {"audio": SimpleUploadedFile("blob", os.urandom(size), "audio/webm")})
+    factory = RequestFactory()
+    sys.addaudithook(_count_file_ops)
+
+    def parse(handlers):
+        request = factory.generic("POST", "/transcribe_audio/", body, content_type=MULTIPART_CONTENT)
+        request.upload_handlers = [load_handler(h, request) for h in handlers]
+        return request.FILES["audio"]
+
+    def temp_file_copy():
+        upload = parse(global_settings.FILE_UPLOAD_HANDLERS)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=uploads.UPLOAD_SUFFIX) as temp_audio:
+            for chunk in upload.chunks():
+                temp_audio.write(chunk)
+        with open(temp_audio.name, "rb") as audio:
+            audio.read()
+        os.remove(temp_audio.name)
+        upload.close()
+
+    def spooled():
+        upload = parse(["core.uploads.SpooledUploadHandler"])
+        uploads.audio_file(upload)[1].read()
+        upload.close()
+
+    iterations = options['iterations']
+    command.stdout.write(
+        f"{iterations} uploads of {options['upload_kb']} KB, {options['concurrency']} at a time "
+        f"(spool threshold {settings.AUDIO_SPOOL_MAX_BYTES // 1024} KB)"
+    )
+    for label, upload in (("temp file copy", temp_file_copy), ("spooled", spooled)):
+        upload()
+        io_before = proc_io()
+        ops_before = dict(_file_ops)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            list(pool.map(lambda _: upload(), range(iterations)))
+        elapsed = time.perf_counter() - start
+        line = f"  {label:15s} {iterations / elapsed:8.0f} uploads/s"
+        line += f"  opens {(_file_ops['open'] - ops_before['open']) / iterations:.1f}"
+        line += f"  unlinks {(_file_ops['os.remove'] - ops_before['os.remove']) / iterations:.1f}"
+        io_after = proc_io()
+        if io_before and io_after:
+            line += (
+                f"  read/write syscalls {(io_after['syscr'] + io_after['syscw'] - io_before['syscr'] - io_before['syscw']) / iterations:.1f}"
+                f"  bytes written {(io_after['wchar'] - io_before['wchar']) / iterations / 1024:.1f} KB"
+            )
+        command.stdout.write(line + "  (per upload)")
+
+
+def synthetic_clip(seconds, rate=16000):
+    """
+    A mono 16-bit WAV of a voice-like warbling tone, for when no recorded
+    clips are given.
+    """
+    frames = bytearray()
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        sample = 0.3 * math.sin(2 * math.pi * (180 + 40 * math.sin(2 * math.pi * 3 * t)) * t)
+        frames += int(sample * 32767).to_bytes(2, "little", signed=True)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as clip:
+        clip.setnchannels(1)
+        clip.setsampwidth(2)
+        clip.setframerate(rate)
+        clip.writeframes(bytes(frames))
+    return buffer.getvalue()
+
+
+def bench_transcription(command, options):
+    """
+    Per-clip latency of each transcription engine on one- to three-second
+    clips: recorded ones from --audio (files or a directory), otherwise
+    synthetic tones. Each clip is sent as uploaded and through the
+    transcoding stage (settings.AUDIO_TRANSCODE), end to end, then as a
+    repeat answered from the transcription cache. The local engine needs
+    WHISPER_MODEL_PATH; the API is only called with --live.
+    """
+    if options['audio']:
+        paths = options['audio']
+        if len(paths) == 1 and os.path.isdir(paths[0]):
+            paths = sorted(os.path.join(paths[0], name) for name in os.listdir(paths[0]))
+        clips = []
+        for path in paths:
+            with open(path, "rb") as f:
+                clips.append((os.path.basename(path), f.read()))
+    else:
+        clips = [(f"{seconds} s tone.wav", synthetic_clip(seconds)) for seconds in (1, 2, 3)]
+    engines = []
+    if settings.WHISPER_MODEL_PATH:
+        start = time.perf_counter()
+        engines.append(transcription.get_engine("local"))
+        command.stdout.write(f"loaded {settings.WHISPER_MODEL_PATH} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    if options['live']:
+        engines.append(transcription.get_engine("openai"))
+    if not engines:
+        raise CommandError("Set WHISPER_MODEL_PATH and/or pass --live to call the API.")
+    # numpy and PyAV are only needed for this suite
+    from core import audio
+
+    iterations = options['iterations']
+    for name, data in clips:
+        pcm = audio.decode(io.BytesIO(data))
+        encoded = audio.encode(pcm, bitrate=settings.AUDIO_TRANSCODE_BITRATE)
+        command.stdout.write(
+            f"{name}: {len(data) / 1024:.1f} KB uploaded, {len(encoded) / 1024:.1f} KB as 16 kHz mono Opus "
+            f"({audio.duration_ms(pcm) / 1000:.1f} s)"
+        )
+        for engine in engines:
+            for stage in (False, True):
+                def run():
+                    return transcription.transcribe((name, io.BytesIO(data)), engine)
+                with override_settings(AUDIO_TRANSCODE=stage, VAD_ENABLED=False, TRANSCRIPTION_CACHE_ENABLED=False):
+                    result = run()
+                    samples = timed(run, iterations)
+                label = f"{engine.name} {'transcoded' if stage else 'as uploaded'}"
+                command.stdout.write(f"  {label:22s} {summarise(samples)}  {result['text']!r}")
+            with override_settings(TRANSCRIPTION_CACHE_ENABLED=True):
+                transcription.transcribe((name, io.BytesIO(data)), engine)
+                samples = timed(lambda: transcription.transcribe((name, io.BytesIO(data)), engine), iterations)
+            command.stdout.write(f"  {engine.name + ' cached':22s} {summarise(samples)}")
+
+
+def bench_local(command, options):
+    """
+    The in-process model: load time, then next-word and completion latency
+    per turn while a session is spoken word by word, with the prompt tokens
+    evaluated per turn (the rest is reused from the context).
+    """
+    if not settings.LOCAL_MODEL_PATH:
+        raise CommandError("Set LOCAL_MODEL_PATH to a GGUF model.")
+    start = time.perf_counter()
+    model = local_model.get_model()
+    command.stdout.write(
+        f"loaded {settings.LOCAL_MODEL_PATH} in {(time.perf_counter() - start) * 1000:.0f} ms "
+        f"({settings.LOCAL_MODEL_THREADS or 'default'} threads)"
+    )
+    words = " ".join(SESSION_SENTENCES).split()
+    turns = min(options['iterations'], len(words) - 1)
+    for label, predict in (
+        ("next word", lambda sentence, following: model.predict(sentence)),
+        ("completion", lambda sentence, following: model.predict(sentence, prefix=following[:2])),
+    ):
+        evaluated = metrics.get("local.evaluated_tokens")
+        samples = []
+        for turn in range(1, turns + 1):
+            sentence = context.build_context(" ".join(words[:turn]))
+            samples.extend(timed(lambda: predict(sentence, words[turn]), 1))
+        command.stdout.write(f"  {label:10s} {summarise(samples)}")
+        command.stdout.write(f"  {'':10s} {(metrics.get('local.evaluated_tokens') - evaluated) / turns:.1f} tokens evaluated per turn")
+    command.stdout.write(f"  '{options['sentence']}' -> {', '.join(model.predict(options['sentence'], limit=8))}")
+
+
+def hit_rate_cases(limit):
+    """
+    (context, next word) pairs from the bundled corpus, one per sentence:
+    the last content word, with at least three words of context before it.
+    """
+    cases = []
+    for line in ngram.read_corpus_lines(settings.NGRAM_CORPUS_PATH):
+        for sentence in context.split_sentences(line):
+            words = ngram.tokenize(sentence)
+            positions = [i for i in range(3, len(words)) if ngram.is_content_word(words[i])]
+            if positions:
+                cases.append((" ".join(words[:positions[-1]]), words[positions[-1]]))
+    return random.Random(0).sample(cases, min(limit, len(cases)))
+
+
+def bench_logprobs(command, options):
+    """
+    Latency and top-k hit rate of next-word prediction from a generated JSON
+    list versus the logprob mode, on held-out words of the bundled corpus.
+    Needs --live and a backend that returns logprobs.
+    """
+    if not options['live']:
+        raise CommandError("The logprobs suite calls the model; rerun with --live.")
+    backend = next((b for b in llm_utils.backend_order() if b in llm_utils.LOGPROB_BACKENDS), None)
+    if backend is None:
+        raise CommandError("No backend in LLM_BACKEND_ORDER returns logprobs.")
+    cases = hit_rate_cases(options['iterations'])
+    command.stdout.write(f"{len(cases)} held-out next words against '{backend}'")
+
+    for label, predict in (
+        ("json list", lambda sentence: llm_utils._generate("next_token", {"sentence": sentence}, backend)),
+        ("logprobs", lambda sentence: llm_utils._generate_logprobs({"sentence": sentence}, backend)),
+    ):
+        latencies, ranks, sizes = [], [], []
+        for sentence, target in cases:
+            start = time.perf_counter()
+            try:
+                tokens = predict(sentence)
+            except Exception as e:
+                command.stderr.write(f"  {label}: {e}")
+                tokens = []
+            latencies.append((time.perf_counter() - start) * 1000)
+            sizes.append(len(tokens))
+            ranks.append(tokens.index(target) + 1 if target in tokens else None)
+        hits = "  ".join(f"hit@{k} {sum(1 for r in ranks if r and r <= k) / len(ranks):.0%}" for k in (1, 5, 15))
+        command.stdout.write(f"  {label:10s} {summarise(latencies)}")
+        command.stdout.write(f"  {'':10s} {hits}  ({statistics.mean(sizes):.1f} suggestions)")
+
+
+SUITES = {
+    'batching': bench_batching,
+    'chains': bench_chains,
+    'client': bench_client,
+    'context': bench_context,
+    'generation': bench_generation,
+    'hedging': bench_hedging,
+    'local': bench_local,
+    'logprobs': bench_logprobs,
+    'ngram': bench_ngram,
+    'phonetic': bench_phonetic,
+    'prompt_cache': bench_prompt_cache,
+    'transcription': bench_transcription,
+    'uploads': bench_uploads,
+}
+
+
+class Command(BaseCommand):
+    help = "Runs latency micro-benchmarks for the prediction and transcription paths."
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=sorted(SUITES))
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--sentence', default=DEFAULT_SENTENCE)
+        parser.add_argument('--concurrency', type=int, default=16, help="Concurrent callers (batching and uploads suites).")
+        parser.add_argument('--audio', nargs='*', default=[], help="Clips or a directory of clips (transcription suite).")
+        parser.add_argument('--upload-kb', type=int, default=48, help="Clip size (uploads suite).")
+        parser.add_argument(
+            '--live', action='store_true',
+            help="Also call the configured backend (needs a running model server / API key).",
+        )
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError("--iterations must be at least 1")
+        SUITES[options['suite']](self, options)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from .benchmark import summarise
+
+
+class Command(BaseCommand):
+    help = (
+        "Fires many concurrent /predict_next_token/ requests at a running server "
+        "and reports how many it held open at once, polled from the route's "
+        "in_flight gauge at /metrics/ (so run the server as a single worker). "
+        "Each request uses a distinct sentence so the prediction cache and request "
+        "coalescing do not hide the load. Start the server with PREDICTION_DEADLINE_MS=0: "
+        "under a deadline it answers from the local sources once that passes, so the "
+        "requests it holds open no longer wait on the LLM."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--concurrency', type=int, default=300)
+        parser.add_argument('--requests', type=int, default=600)
+        parser.add_argument('--timeout', type=float, default=120.0)
+        parser.add_argument('--poll-interval', type=float, default=0.05, help='Seconds between /metrics/ polls')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        base = options['url'].rstrip('/')
+        url = base + '/predict_next_token/'
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        latencies = []
+        errors = 0
+        peak = None
+
+        # One extra connection so the metrics polls never queue behind the load
+        limits = httpx.Limits(max_connections=options['concurrency'] + 1, max_keepalive_connections=options['concurrency'] + 1)
+        async with httpx.AsyncClient(timeout=options['timeout'], limits=limits) as client:
+
+            async def one(i):
+                nonlocal errors
+                async with semaphore:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.post(url, json={'sentence': f'load test sentence number {i} i would like'})
+                        response.raise_for_status()
+                        latencies.append((time.perf_counter() - start) * 1000)
+                    except httpx.HTTPError:
+                        errors += 1
+
+            async def poll():
+                nonlocal peak
+                while True:
+                    try:
+                        response = await client.get(base + '/metrics/')
+                        in_flight = response.json().get('route', {}).get('next_token.in_flight')
+                    except (httpx.HTTPError, ValueError):
+                        in_flight = None
+                    if in_flight is not None:
+                        peak = max(peak or 0, in_flight)
+                    await asyncio.sleep(options['poll_interval'])
+
+            poller = asyncio.create_task(poll())
+            start = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(options['requests'])))
+            elapsed = time.perf_counter() - start
+            poller.cancel()
+
+        self.stdout.write(f"{options['requests']} requests in {elapsed:.2f}s ({options['requests'] / elapsed:.1f} req/s)")
+        self.stdout.write(f"peak requests in flight on the server: {'unknown' if peak is None else peak}, errors: {errors}")
+        if latencies:
+            self.stdout.write(f"latency  {summarise(latencies)}")
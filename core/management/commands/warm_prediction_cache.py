@@ -0,0 +1,85 @@
+import re
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import llm_utils
+from core.context import build_context
+from core.prediction_cache import get_cache, make_key
+
+# Matches the INFO lines written by core.views
+NEXT_TOKEN_LOG_RE = re.compile(r"Predicting next token for sentence: '(.*)'\s*$")
+COMPLETION_LOG_RE = re.compile(r"Predicting word completion for partial: '(.*)' in sentence: '(.*)'\s*$")
+
+
+class Command(BaseCommand):
+    help = (
+        "Warms the prediction cache from logged contexts. Reads server log files "
+        "(the 'Predicting ...' lines written by core.views) or, with --plain, "
+        "files containing one sentence per line."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--plain', action='store_true', help="Treat each line as a next-token sentence.")
+        parser.add_argument('--min-count', type=int, default=1, help="Only warm contexts seen at least this often.")
+        parser.add_argument('--limit', type=int, default=500, help="Maximum number of contexts to warm.")
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        cache = get_cache()
+        if cache is None:
+            raise CommandError("Prediction cache is disabled (PREDICTION_CACHE_ENABLED).")
+        if cache.disk is None and not options['dry_run']:
+            # The in-memory tier dies with this process, so only SQLite is worth warming
+            raise CommandError("Set PREDICTION_CACHE_SQLITE_PATH so the warmed entries outlive this command.")
+
+        contexts = Counter()
+        for path in options['files']:
+            try:
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    for line in f:
+                        context = self.parse_line(line, options['plain'])
+                        if context:
+                            contexts[context] += 1
+            except OSError as e:
+                raise CommandError(f"Could not read {path}: {e}")
+
+        # Most frequent first, so the limit keeps the phrases that matter
+        selected = [c for c, n in contexts.most_common() if n >= options['min_count']][:options['limit']]
+        self.stdout.write(f"{len(contexts)} distinct contexts found, warming {len(selected)}")
+
+        warmed = skipped = uncached = 0
+        for kind, sentence, partial in selected:
+            # Predictions are cached under the context the chains build
+            key = make_key(kind, build_context(sentence), partial)
+            if cache.get(key) is not None:
+                skipped += 1
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"  {kind}: '{sentence}' '{partial}'")
+                continue
+            try:
+                llm_utils.warm_prediction(kind, sentence, partial)
+            except Exception as e:
+                self.stderr.write(f"  {kind}: '{sentence}' '{partial}' failed: {e}")
+            # Empty answers and completions the phonetic index serves are not cached
+            if cache.get(key) is not None:
+                warmed += 1
+            else:
+                uncached += 1
+        self.stdout.write(self.style.SUCCESS(f"Warmed {warmed}, already cached {skipped}, not cached {uncached}"))
+
+    def parse_line(self, line, plain):
+        """
+        Returns a (kind, sentence, partial) tuple for a log line, or None.
+        """
+        match = COMPLETION_LOG_RE.search(line)
+        if match:
+            return ("word_completion", match.group(2), match.group(1))
+        match = NEXT_TOKEN_LOG_RE.search(line)
+        if match:
+            return ("next_token", match.group(1), "")
+        if plain and line.strip():
+            return ("next_token", line.strip(), "")
+        return None
@@ -0,0 +1,116 @@
+import bisect
+import threading
+from collections import defaultdict, deque
+
+# Simple in-process counters for the prediction pipeline.
+# Each worker keeps its own numbers; they are exposed at /metrics/.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def register_gauge(name, fn):
+    """
+    Registers fn() to be evaluated at snapshot time, for derived values such
+    as rates or state that lives elsewhere.
+    """
+    with _lock:
+        _gauges[name] = fn
+
+
+def snapshot():
+    """
+    Returns a copy of every counter and gauge, grouped by the prefix before
+    the first dot.
+    """
+    grouped = defaultdict(dict)
+    with _lock:
+        values = dict(_counters)
+        gauges = list(_gauges.items())
+    for name, fn in gauges:
+        values[name] = fn()
+    for name, value in values.items():
+        group, _, key = name.partition(".")
+        grouped[group][key or group] = value
+    return dict(grouped)
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def ratio(part, *names):
+    """
+    Returns counter `part` as a fraction of the sum of counters `names`.
+    """
+    total = sum(get(n) for n in names)
+    return round(get(part) / total, 4) if total else 0.0
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+
+class LatencyWindow:
+    """
+    The most recent `size` latencies (ms), for percentile gauges.
+    """
+
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, ms):
+        with self._lock:
+            self._samples.append(ms)
+
+    def percentile(self, p):
+        """
+        Returns the p-th percentile (0-100) of the window, or 0.0 when empty.
+        """
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return 0.0
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 1)
+
+
+class LatencyHistogram:
+    """
+    Latency counts (ms) per bucket, cumulative like Prometheus' `le` buckets,
+    plus a LatencyWindow of recent samples for percentiles.
+    """
+
+    def __init__(self, buckets, window=500):
+        self.buckets = tuple(sorted(buckets))
+        self.recent = LatencyWindow(window)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+
+    def add(self, ms):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.recent.add(ms)
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+        result = {}
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            result[f"le_{bound}"] = total
+        result["count"] = total + counts[-1]
+        for p in (50, 95, 99):
+            result[f"p{p}"] = self.recent.percentile(p)
+        return result
@@ -0,0 +1,254 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+
+from . import metrics
+from .context import split_sentences
+from .parsing import FILLER_WORDS, STOPWORDS, normalise_context
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not locked across workers
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+START = "<s>"
+DISCOUNT = 0.75
+_WORD_RE = re.compile(r"[a-z][a-z']*")
+
+
+def tokenize(text):
+    return [w for w in _WORD_RE.findall((text or "").lower()) if w not in FILLER_WORDS]
+
+
+def is_content_word(word):
+    """
+    Same rule the system prompt gives the LLM: no articles, prepositions,
+    conjunctions, pronouns or fillers.
+    """
+    return len(word) > 1 and word != START and word not in STOPWORDS
+
+
+class NgramModel:
+    """
+    Word n-gram model with interpolated Kneser-Ney smoothing, small enough to
+    answer in well under a millisecond and updatable one sentence at a time.
+
+    The highest order uses raw counts; lower orders use continuation counts
+    (how many distinct words precede an n-gram), so a word that only ever
+    follows one phrase does not dominate the backoff distribution.
+    """
+
+    def __init__(self, order=3):
+        self.order = order
+        self.counts = defaultdict(int)       # ngram -> count
+        self.context_total = defaultdict(int)  # context -> sum of counts
+        self.followers = defaultdict(set)    # context -> distinct next words
+        self.left = defaultdict(set)         # ngram -> distinct preceding words
+        self.cont_total = defaultdict(int)   # context -> sum of continuation counts
+        self.cont_types = defaultdict(int)   # context -> words with a continuation count
+        self._top_unigrams = None
+        self._lock = threading.Lock()
+
+    @property
+    def vocabulary_size(self):
+        return len(self.followers.get((), ()))
+
+    def update(self, sentence):
+        words = tokenize(sentence)
+        if not words:
+            return
+        padded = [START] * (self.order - 1) + words
+        with self._lock:
+            for i in range(self.order - 1, len(padded)):
+                for n in range(1, self.order + 1):
+                    ngram = tuple(padded[i - n + 1:i + 1])
+                    context = ngram[:-1]
+                    if self.counts[ngram] == 0:
+                        self.followers[context].add(ngram[-1])
+                    self.counts[ngram] += 1
+                    self.context_total[context] += 1
+                    if i - n >= 0:
+                        preceding = padded[i - n]
+                        extensions = self.left[ngram]
+                        if preceding not in extensions:
+                            if not extensions:
+                                self.cont_types[context] += 1
+                            extensions.add(preceding)
+                            self.cont_total[context] += 1
+            self._top_unigrams = None
+
+    def _prob(self, word, context, highest):
+        if context is None:
+            return 1.0 / max(1, self.vocabulary_size)
+        lower = self._prob(word, context[1:] if context else None, False)
+        ngram = context + (word,)
+        if highest:
+            total = self.context_total.get(context, 0)
+            count = self.counts.get(ngram, 0)
+            types = len(self.followers.get(context, ()))
+        else:
+            total = self.cont_total.get(context, 0)
+            count = len(self.left.get(ngram, ()))
+            types = self.cont_types.get(context, 0)
+        if total == 0:
+            return lower
+        return max(count - DISCOUNT, 0) / total + DISCOUNT * types / total * lower
+
+    def _unigram_candidates(self, limit=100):
+        if self._top_unigrams is None:
+            words = [w for w in self.followers.get((), ()) if is_content_word(w)]
+            words.sort(key=lambda w: len(self.left.get((w,), ())), reverse=True)
+            self._top_unigrams = words[:limit]
+        return self._top_unigrams
+
+    def predict(self, text, k=15, prefix=""):
+        """
+        Returns up to k content words most likely to follow text, optionally
+        restricted to words starting with prefix.
+        """
+        words = tokenize(text)
+        context = tuple(([START] * (self.order - 1) + words)[-(self.order - 1):])
+        with self._lock:
+            candidates = set(self._unigram_candidates())
+            for n in range(len(context) + 1):
+                candidates.update(self.followers.get(context[n:], ()))
+            if prefix:
+                candidates = {w for w in candidates if w.startswith(prefix)}
+                if len(candidates) < k:
+                    candidates.update(w for w in self.followers.get((), ()) if w.startswith(prefix))
+            scored = [
+                (self._prob(w, context, True), w)
+                for w in candidates if is_content_word(w)
+            ]
+        scored.sort(reverse=True)
+        return [w for _, w in scored[:k]]
+
+
+_model = None
+_model_lock = threading.Lock()
+_learned = OrderedDict()
+_LEARNED_LIMIT = 10000
+
+
+def read_corpus_lines(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    except OSError as e:
+        logger.warning(f"Could not read n-gram corpus {path}: {e}")
+        return []
+
+
+def get_model():
+    """
+    Returns the worker-wide model, training it on first use from the bundled
+    corpus plus the conversation history file.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                start = time.perf_counter()
+                model = NgramModel(order=settings.NGRAM_ORDER)
+                sources = [settings.NGRAM_CORPUS_PATH]
+                if settings.NGRAM_HISTORY_PATH:
+                    history = settings.NGRAM_HISTORY_PATH
+                    sources += [p for p in (f"{history}.1", history) if os.path.exists(p)]
+                for path in sources:
+                    for line in read_corpus_lines(path):
+                        for sentence in split_sentences(line):
+                            model.update(sentence)
+                logger.info(
+                    f"Trained n-gram model on {model.vocabulary_size} words "
+                    f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+                )
+                _model = model
+    return _model
+
+
+def suggest_next_words(text, k=15, prefix=""):
+    """
+    Local next-word (or, with prefix, word-completion) suggestions.
+    Returns [] when the n-gram engine is disabled.
+    """
+    if not settings.NGRAM_ENABLED:
+        return []
+    metrics.incr("ngram.predictions")
+    return get_model().predict(text, k=k, prefix=prefix)
+
+
+def is_known_word(word):
+    """
+    Whether the n-gram engine has seen word. False when it is disabled.
+    """
+    return settings.NGRAM_ENABLED and word in get_model().followers.get((), ())
+
+
+def learn_conversation(text, session=""):
+    """
+    Adds the conversation's completed sentences that the model has not
+    learned yet, and appends them to the history file so they survive
+    restarts. Each request carries the whole conversation, so a sentence is
+    learned once per time it was said in the session: a phrase the user
+    repeats keeps gaining counts, a resent conversation adds nothing.
+    """
+    if not settings.NGRAM_ENABLED:
+        return
+    said = Counter()
+    sentences = {}
+    for sentence in split_sentences(text):
+        if not sentence.endswith((".", "!", "?")):
+            continue
+        key = normalise_context(sentence)
+        if key:
+            said[key] += 1
+            sentences.setdefault(key, sentence)
+    new = []
+    with _model_lock:
+        for key, count in said.items():
+            learned = _learned.get((session, key), 0)
+            if count > learned:
+                new += [sentences[key]] * (count - learned)
+                _learned[(session, key)] = count
+            _learned.move_to_end((session, key))
+        while len(_learned) > _LEARNED_LIMIT:
+            _learned.popitem(last=False)
+    if not new:
+        return
+
+    model = get_model()
+    for sentence in new:
+        model.update(sentence)
+    metrics.incr("ngram.learned_sentences", len(new))
+
+    if settings.NGRAM_HISTORY_PATH:
+        try:
+            append_history(settings.NGRAM_HISTORY_PATH, new)
+        except OSError as e:
+            logger.warning(f"Could not append to n-gram history: {e}")
+
+
+def append_history(path, sentences):
+    """
+    Appends sentences to the history file under an exclusive lock, as every
+    worker writes to it, and rotates it to `path`.1 once it outgrows
+    settings.NGRAM_HISTORY_MAX_BYTES (the model trains on both files).
+    """
+    with open(path, "a", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.writelines(f"{s}\n" for s in sentences)
+        f.flush()
+        if settings.NGRAM_HISTORY_MAX_BYTES and f.tell() > settings.NGRAM_HISTORY_MAX_BYTES:
+            os.replace(path, f"{path}.1")
+            metrics.incr("ngram.history_rotated")
+
+
+metrics.register_gauge("ngram.vocabulary", lambda: _model.vocabulary_size if _model else 0)
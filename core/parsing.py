@@ -0,0 +1,304 @@
+import ast
+import json
+import re
+
+from . import metrics
+
+MAX_TOKENS = 15
+
+# Words the system prompt tells the model to avoid: articles, prepositions,
+# conjunctions, pronouns, auxiliaries and fillers. Mirrors COMMON_WORDS in speech.js.
+STOPWORDS = frozenset("""
+    a an the and or but nor so yet if then than as
+    in on at to for of with by from into onto up out about over under off
+    is are was were be been being am do does did has have had will would can could should
+    it its this that these those there here
+    i me my we us our you your he him his she her they them their
+    just like well um uh er erm hmm very really oh yes no ok okay
+""".split())
+
+# Hesitation sounds that carry no meaning for prediction
+FILLER_WORDS = frozenset(["um", "uh", "uhm", "umm", "er", "erm", "ah", "hmm", "mm"])
+
+_CONTEXT_WORD_RE = re.compile(r"[a-z0-9']+")
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_JSON_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_ITEM_SPLIT_RE = re.compile(r"[\n,;]+")
+_ITEM_PREFIX_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+# One word, with at most one inner hyphen or apostrophe ("don't", "x-ray")
+_WORD_RE = re.compile(r"^[a-z]+(?:['-][a-z]+)?$")
+# Literals a model emits in place of a list; never suggestions
+JSON_LITERALS = frozenset(["null", "true", "false", "none"])
+
+
+def normalise_context(text):
+    """
+    Canonical form of a spoken context, used to key caches and coalesce requests:
+    lowercase, punctuation removed, fillers dropped and whitespace collapsed.
+    """
+    words = _CONTEXT_WORD_RE.findall((text or "").lower())
+    return " ".join(w for w in words if w not in FILLER_WORDS)
+
+
+def _load(text):
+    """
+    Parses JSON, falling back to Python literal syntax for the single-quoted
+    dicts small models like to emit. Returns None if neither works.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def _embedded(text):
+    """
+    Returns the first {...} or [...] span in text, if any.
+    """
+    for open_ch, close_ch in (("{", "}"), ("[", "]")):
+        start = text.find(open_ch)
+        end = text.rfind(close_ch)
+        if start != -1 and end > start:
+            return text[start:end + 1]
+    return None
+
+
+def _items(data):
+    """
+    Pulls the candidate list out of whatever structure the model returned.
+    """
+    if isinstance(data, dict):
+        if "tokens" in data:
+            return _items(data["tokens"])
+        for value in data.values():
+            if isinstance(value, list):
+                return value
+        return []
+    if isinstance(data, list):
+        return data
+    if isinstance(data, str):
+        return _ITEM_SPLIT_RE.split(data)
+    return []
+
+
+def _word(item):
+    """
+    The candidate as a normalised single word, None for prose, or "" when
+    nothing is left of it.
+    """
+    item = _ITEM_PREFIX_RE.sub("", item).strip()
+    if item.endswith(":"):
+        # A heading or lead-in line, not a suggestion
+        return None
+    word = item.strip("\"'`.!?").strip().lower()
+    if word and (not _WORD_RE.match(word) or word in JSON_LITERALS):
+        return None
+    return word
+
+
+def clean_tokens(items, limit=MAX_TOKENS):
+    """
+    Normalises candidate words: lowercase, strips numbering/quotes/punctuation,
+    drops stopwords and anything that is not a single word (prose such as
+    "here you go:", phrases, JSON literals), dedupes preserving order and
+    trims to limit.
+    """
+    tokens = []
+    seen = set()
+    for item in items:
+        if not isinstance(item, str):
+            continue
+        word = _word(item)
+        if word is None:
+            metrics.incr("parse.prose_dropped")
+            continue
+        if not word:
+            continue
+        if word in STOPWORDS:
+            metrics.incr("parse.stopword_dropped")
+            continue
+        if word in seen:
+            metrics.incr("parse.duplicate_dropped")
+            continue
+        seen.add(word)
+        tokens.append(word)
+    if len(tokens) > limit:
+        metrics.incr("parse.trimmed")
+    return tokens[:limit]
+
+
+def repair_token_list(text, limit=MAX_TOKENS):
+    """
+    Tolerantly extracts a token list from raw model output without another LLM call.
+
+    Tries, in order: the output as-is, the contents of a ``` fence, the first
+    embedded JSON object/array, the complete strings of a truncated array,
+    and finally splitting it as a bare list.
+    Each path that succeeds is counted in metrics under parse.<path>.
+    """
+    text = (text or "").strip()
+    candidates = [("json", text)]
+    fence = _FENCE_RE.search(text)
+    if fence:
+        candidates.append(("fenced", fence.group(1)))
+    embedded = _embedded(text)
+    if embedded and embedded != text:
+        candidates.append(("embedded", embedded))
+
+    for path, candidate in candidates:
+        data = _load(candidate)
+        if data is not None and not isinstance(data, (int, float)):
+            items = _items(data)
+            if items:
+                metrics.incr(f"parse.{path}")
+                return clean_tokens(items, limit)
+
+    # A list cut off by a stop sequence or token limit: take its complete strings
+    start = text.find("[")
+    if start != -1:
+        items = _JSON_STRING_RE.findall(text[start:])
+        if items:
+            metrics.incr("parse.truncated")
+            return clean_tokens(items, limit)
+
+    # No usable structure at all: treat it as a bare comma/newline separated list
+    tokens = clean_tokens(_ITEM_SPLIT_RE.split(_FENCE_RE.sub(r"\1", text)), limit)
+    metrics.incr("parse.split" if tokens else "parse.empty")
+    return tokens
+
+
+def repair_batch_results(text, count, limit=MAX_TOKENS):
+    """
+    Extracts the per-request token lists from a packed batch reply,
+    {"results": [{"id": 1, "tokens": [...]}, ...]}. Returns `count` lists in
+    request order; a request the model skipped gets an empty list.
+    """
+    text = (text or "").strip()
+    data = None
+    for candidate in (text, (_FENCE_RE.search(text) or [None, None])[1], _embedded(text)):
+        if candidate:
+            data = _load(candidate)
+            if isinstance(data, (dict, list)):
+                break
+    if isinstance(data, dict):
+        data = data.get("results", [])
+    results = [[] for _ in range(count)]
+    if not isinstance(data, list):
+        metrics.incr("parse.batch_empty")
+        return results
+    for position, entry in enumerate(data):
+        index = position
+        if isinstance(entry, dict) and isinstance(entry.get("id"), int):
+            index = entry["id"] - 1
+        if 0 <= index < count:
+            results[index] = clean_tokens(_items(entry), limit)
+    return results
+
+
+class TokenStreamParser:
+    """
+    Incremental counterpart of repair_token_list() for streamed model output.
+
+    feed() takes each chunk of text as it arrives and returns the suggestions
+    completed by it: a JSON string closing inside the list, or (for output
+    that is not JSON) a line/comma separated item. Bare items are held until
+    their line is known to be part of the list (it ends without a ':', or
+    already holds two single words), so a lead-in such as "Sure, here are
+    some words:" is never sent. finish() flushes whatever is left, running
+    the full repair step over the whole text as a last resort.
+    """
+
+    def __init__(self, limit=MAX_TOKENS):
+        self.limit = limit
+        self.text = ""
+        self.tokens = []
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current = []
+        self._structured = False
+        # Bare items on the current line, until it is known to be a list line
+        self._line_items = []
+        self._line_listed = False
+
+    @property
+    def done(self):
+        return len(self.tokens) >= self.limit
+
+    def _accept(self, items):
+        new = []
+        for word in clean_tokens(items, self.limit):
+            if word not in self.tokens and not self.done:
+                self.tokens.append(word)
+                new.append(word)
+        return new
+
+    def feed(self, chunk):
+        self.text += chunk
+        items = []
+        while self._pos < len(self.text):
+            ch = self.text[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._current.append(ch)
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth > 0:
+                        items.append("".join(self._current))
+                else:
+                    self._current.append(ch)
+            elif ch == '"':
+                self._in_string = True
+                self._current = []
+            elif ch in "[{":
+                self._structured = True
+                self._depth += ch == "["
+            elif ch == "]":
+                self._depth = max(0, self._depth - 1)
+            elif not self._structured and ch in "\n,;":
+                # Bare list: the item before the delimiter is complete
+                start = max(self.text.rfind(d, 0, self._pos - 1) for d in "\n,;") + 1
+                item = self.text[start:self._pos - 1]
+                if not item.strip().startswith("```"):
+                    self._line_items.append(item)
+                items.extend(self._line_end(item) if ch == "\n" else self._line_item())
+        return self._accept(items)
+
+    def _line_item(self):
+        # A comma separated line is a list once it holds two single words
+        if not self._line_listed and len(self._line_items) >= 2:
+            self._line_listed = all(_word(i) for i in self._line_items)
+        if not self._line_listed:
+            return []
+        items, self._line_items = self._line_items, []
+        return items
+
+    def _line_end(self, last):
+        # A line ending in ':' introduces the list; none of its items are words
+        items = [] if last.strip().endswith(":") else self._line_items
+        self._line_items = []
+        self._line_listed = False
+        return items
+
+    def finish(self):
+        """
+        Returns any remaining suggestions once the stream has ended.
+        """
+        if not self._structured:
+            start = max(self.text.rfind(d) for d in "\n,;") + 1
+            self._line_items.append(self.text[start:])
+            new = self._accept(self._line_end(self.text[start:]))
+        else:
+            new = []
+        if not self.tokens:
+            new = self._accept(repair_token_list(self.text, self.limit))
+        return new
@@ -0,0 +1,353 @@
+import bisect
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_LETTERS_RE = re.compile(r"[^a-z]")
+_VOWELS = "aeiou"
+_FRONT_VOWELS = "eiy"
+
+
+def metaphone(word):
+    """
+    Simplified Metaphone key: a consonant skeleton of how a word sounds, so
+    'hostipal' and 'hospital' or 'nife' and 'knife' land near each other.
+    Vowels are dropped except at the start, and letters that sound alike
+    share a code ('0' is 'th', 'X' is 'sh'/'ch').
+    """
+    w = _LETTERS_RE.sub("", (word or "").lower())
+    if not w:
+        return ""
+    if w[:2] in ("kn", "gn", "pn", "ae", "wr"):
+        w = w[1:]
+    elif w[0] == "x":
+        w = "s" + w[1:]
+    elif w.startswith("wh"):
+        w = "w" + w[2:]
+
+    out = []
+    n = len(w)
+    i = 0
+    while i < n:
+        c = w[i]
+        prev = w[i - 1] if i else ""
+        nxt = w[i + 1] if i + 1 < n else ""
+        nxt2 = w[i + 2] if i + 2 < n else ""
+        if c == prev and c != "c":
+            i += 1
+            continue
+        if c in _VOWELS:
+            if i == 0:
+                out.append(c.upper())
+        elif c == "b":
+            if not (prev == "m" and i == n - 1):
+                out.append("B")
+        elif c == "c":
+            if nxt == "i" and nxt2 == "a":
+                out.append("X")
+            elif nxt == "h":
+                out.append("K" if prev == "s" else "X")
+                i += 1
+            elif nxt in _FRONT_VOWELS and nxt:
+                if prev != "s":
+                    out.append("S")
+            else:
+                out.append("K")
+        elif c == "d":
+            if nxt == "g" and nxt2 and nxt2 in _FRONT_VOWELS:
+                out.append("J")
+                i += 1
+            else:
+                out.append("T")
+        elif c == "g":
+            if nxt == "h" and (not nxt2 or nxt2 not in _VOWELS):
+                i += 1  # silent, as in 'night'
+            elif nxt == "n" and (i + 2 == n or w[i + 2:] == "ed"):
+                pass  # silent, as in 'sign'
+            elif nxt and nxt in _FRONT_VOWELS:
+                out.append("J")
+            else:
+                out.append("K")
+        elif c == "h":
+            if (not prev or prev not in "cgpst") and nxt and nxt in _VOWELS:
+                out.append("H")
+        elif c == "k":
+            if prev != "c":
+                out.append("K")
+        elif c == "p":
+            if nxt == "h":
+                out.append("F")
+                i += 1
+            else:
+                out.append("P")
+        elif c == "q":
+            out.append("K")
+        elif c == "s":
+            if nxt == "h" or (nxt == "i" and nxt2 in ("o", "a")):
+                out.append("X")
+                i += 1 if nxt == "h" else 0
+            else:
+                out.append("S")
+        elif c == "t":
+            if nxt == "i" and nxt2 in ("o", "a"):
+                out.append("X")
+            elif nxt == "h":
+                out.append("0")
+                i += 1
+            elif not (nxt == "c" and nxt2 == "h"):
+                out.append("T")
+        elif c == "v":
+            out.append("F")
+        elif c in "wy":
+            if nxt and nxt in _VOWELS:
+                out.append(c.upper())
+        elif c == "x":
+            out.append("KS")
+        elif c == "z":
+            out.append("S")
+        else:
+            out.append(c.upper())
+        i += 1
+    return "".join(out)
+
+
+def levenshtein(a, b):
+    return EditPattern(a).distance(b)
+
+
+def transposition_distance(a, b):
+    """
+    Edit distance that also counts swapping two adjacent letters as one edit
+    (optimal string alignment), the commonest phonemic slip: 'recieve'.
+    """
+    rows = [list(range(len(b) + 1))]
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            row[j] = min(rows[i - 1][j] + 1, row[j - 1] + 1, rows[i - 1][j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], rows[i - 2][j - 2] + 1)
+        rows.append(row)
+    return rows[-1][-1]
+
+
+class EditPattern:
+    """
+    Query string prepared for bit-parallel Levenshtein distance (Myers /
+    Hyyrö): one bitmask per character, then a handful of integer operations
+    per character of each compared string instead of a DP row.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+        self.mask = (1 << self.length) - 1
+        self.last = 1 << (self.length - 1) if text else 0
+        self.peq = {}
+        for i, ch in enumerate(text):
+            self.peq[ch] = self.peq.get(ch, 0) | (1 << i)
+
+    def distance(self, other):
+        if not self.length:
+            return len(other)
+        mask, last, peq = self.mask, self.last, self.peq
+        pv, mv, score = mask, 0, self.length
+        for ch in other:
+            eq = peq.get(ch, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = (mv | ~(xh | pv)) & mask
+            mh = pv & xh
+            if ph & last:
+                score += 1
+            elif mh & last:
+                score -= 1
+            ph = ((ph << 1) | 1) & mask
+            mh = (mh << 1) & mask
+            pv = (mh | ~(xv | ph)) & mask
+            mv = ph & xv
+        return score
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over strings with Levenshtein distance. A search
+    with radius r only descends into children whose edge distance is within
+    r of the query's distance to the node, so most of the tree is skipped.
+    """
+
+    def __init__(self):
+        self.root = None  # (key, {distance: child})
+        self.size = 0
+
+    def add(self, key):
+        if self.root is None:
+            self.root = (key, {})
+            self.size = 1
+            return
+        pattern = EditPattern(key)
+        node = self.root
+        while True:
+            distance = pattern.distance(node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (key, {})
+                self.size += 1
+                return
+            node = child
+
+    def search(self, key, radius):
+        """
+        Returns [(key, distance)] for every stored key within radius.
+        """
+        pattern = EditPattern(key)
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_key, children = stack.pop()
+            distance = pattern.distance(node_key)
+            if distance <= radius:
+                found.append((node_key, distance))
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class PhoneticIndex:
+    """
+    Sound-alike lookup for word completion: words are grouped by Metaphone
+    key, keys live in a BK-tree, and a partial is matched both on sound
+    (keys within a small edit distance, or keys it is the start of) and on
+    spelling (words it is a prefix of).
+    """
+
+    def __init__(self, words=()):
+        self.tree = BKTree()
+        self.by_key = {}
+        self.rank = {}  # word -> position, earlier words win ties
+        self._sorted_words = []
+        self._sorted_keys = []
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.rank)
+
+    def __contains__(self, word):
+        return word in self.rank
+
+    def add(self, word):
+        word = word.strip().lower().replace("-", " ")
+        key = metaphone(word)
+        if not key or word in self.rank:
+            return
+        self.rank[word] = len(self.rank)
+        if key not in self.by_key:
+            self.by_key[key] = []
+            self.tree.add(key)
+            bisect.insort(self._sorted_keys, key)
+        self.by_key[key].append(word)
+        bisect.insort(self._sorted_words, _LETTERS_RE.sub("", word) + " " + word)
+
+    def _prefixed(self, items, prefix, limit):
+        start = bisect.bisect_left(items, prefix)
+        found = []
+        for item in items[start:start + limit]:
+            if not item.startswith(prefix):
+                break
+            found.append(item)
+        return found
+
+    def search(self, partial, k=15, max_distance=2):
+        """
+        Returns up to k words that sound like (or start like) partial, closest
+        first: phonetic key distance, then spelling distance, then lexicon order.
+        """
+        spelled = _LETTERS_RE.sub("", (partial or "").lower())
+        key = metaphone(spelled)
+        if not key:
+            return []
+        radius = 1 if len(key) <= 2 else max_distance
+
+        sound = {}
+        for word_key, distance in self.tree.search(key, radius):
+            sound[word_key] = transposition_distance(key, word_key)
+        # A fragment ('hos') sounds like the start of the word it belongs to
+        for word_key in self._prefixed(self._sorted_keys, key, 200):
+            sound[word_key] = min(sound.get(word_key, radius + 1), 0.5 if word_key != key else 0)
+
+        scores = {}
+        for word_key, distance in sound.items():
+            for word in self.by_key[word_key]:
+                scores[word] = distance
+        for item in self._prefixed(self._sorted_words, spelled, 200):
+            word = item.split(" ", 1)[1]
+            scores[word] = min(scores.get(word, radius + 1), 0.5)
+
+        def spelling(word):
+            letters = _LETTERS_RE.sub("", word)[:len(spelled)]
+            return transposition_distance(spelled, letters) / len(spelled)
+
+        ranked = sorted(scores, key=lambda w: (scores[w] + spelling(w), self.rank[w]))
+        return ranked[:k]
+
+
+def read_lexicon(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [w for line in f if not line.startswith("#") for w in line.split()]
+    except OSError as e:
+        logger.warning(f"Could not read phonetic lexicon {path}: {e}")
+        return []
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the worker-wide index, built on first use from the bundled
+    lexicon. The n-gram vocabulary is left out: common words like "some"
+    or "after" would otherwise compete as completions.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                start = time.perf_counter()
+                index = PhoneticIndex(read_lexicon(settings.PHONETIC_LEXICON_PATH))
+                logger.info(
+                    f"Built phonetic index of {len(index)} words ({index.tree.size} keys) "
+                    f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+                )
+                _index = index
+    return _index
+
+
+def sound_alike_words(partial, k=15):
+    """
+    Local word-completion candidates for partial. Returns [] when the
+    phonetic index is disabled.
+    """
+    if not settings.PHONETIC_ENABLED:
+        return []
+    metrics.incr("phonetic.lookups")
+    words = get_index().search(partial, k=k, max_distance=settings.PHONETIC_MAX_DISTANCE)
+    if not words:
+        metrics.incr("phonetic.no_match")
+    return words
+
+
+metrics.register_gauge("phonetic.lexicon", lambda: len(_index) if _index else 0)
@@ -0,0 +1,216 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+from .parsing import normalise_context
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU with a per-entry TTL. Expiries and evictions
+    are counted under the `prefix` metric namespace.
+    """
+
+    def __init__(self, max_size, ttl, prefix="cache"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.prefix = prefix
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                metrics.incr(f"{self.prefix}.expired")
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                metrics.incr(f"{self.prefix}.evicted")
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """
+    Persistent second tier so cached predictions survive restarts.
+    Uses one connection per thread; SQLite handles cross-process locking.
+    Values are stored as JSON in `table`.
+    """
+
+    def __init__(self, path, ttl, table="predictions", prefix="cache"):
+        self.path = str(path)
+        self.ttl = ttl
+        self.table = table
+        self.prefix = prefix
+        self._local = threading.local()
+        self._connection().execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " key TEXT PRIMARY KEY, tokens TEXT NOT NULL, created REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            f"SELECT tokens, created FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        tokens, created = row
+        if created + self.ttl < time.time():
+            self._connection().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            metrics.incr(f"{self.prefix}.expired")
+            return None
+        return json.loads(tokens)
+
+    def set(self, key, value):
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, tokens, created) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time()),
+        )
+
+    def clear(self):
+        self._connection().execute(f"DELETE FROM {self.table}")
+
+
+def make_key(kind, sentence, partial=""):
+    return "\x1f".join((kind, normalise_context(sentence), normalise_context(partial)))
+
+
+class PredictionCache:
+    """
+    Two-tier cache in front of the prediction chains: an in-process LRU and an
+    optional SQLite tier. Hits, misses and evictions are counted in metrics
+    under `prefix` ("cache" for predictions).
+    """
+
+    def __init__(self, max_size, ttl, sqlite_path=None, sqlite_ttl=None, table="predictions", prefix="cache"):
+        self.prefix = prefix
+        self.memory = LRUCache(max_size, ttl, prefix=prefix)
+        self.disk = None
+        if sqlite_path:
+            try:
+                self.disk = SQLiteCache(sqlite_path, sqlite_ttl or ttl, table=table, prefix=prefix)
+            except sqlite3.Error as e:
+                logger.warning(f"Cache {table} SQLite tier disabled: {e}")
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            metrics.incr(f"{self.prefix}.hit_memory")
+            return value
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error as e:
+                logger.warning(f"Cache {self.disk.table} read failed: {e}")
+                value = None
+            if value is not None:
+                metrics.incr(f"{self.prefix}.hit_sqlite")
+                self.memory.set(key, value)
+                return value
+        metrics.incr(f"{self.prefix}.miss")
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                logger.warning(f"Cache {self.disk.table} write failed: {e}")
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the worker-wide PredictionCache, or None if caching is disabled.
+    """
+    global _cache
+    if not settings.PREDICTION_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PredictionCache(
+                    max_size=settings.PREDICTION_CACHE_SIZE,
+                    ttl=settings.PREDICTION_CACHE_TTL,
+                    sqlite_path=settings.PREDICTION_CACHE_SQLITE_PATH,
+                    sqlite_ttl=settings.PREDICTION_CACHE_SQLITE_TTL,
+                )
+    return _cache
+
+
+def cached_prediction(kind, sentence, partial, compute):
+    """
+    Returns the cached tokens for this context, or calls compute() and caches
+    its result. Empty results are not cached so a failed call is retried.
+    """
+    cache = get_cache()
+    if cache is None:
+        return compute()
+    key = make_key(kind, sentence, partial)
+    tokens = cache.get(key)
+    if tokens is not None:
+        return list(tokens)
+    tokens = compute()
+    if tokens:
+        cache.set(key, list(tokens))
+    return tokens
+
+
+async def acached_prediction(kind, sentence, partial, compute):
+    """
+    Async version of cached_prediction(); compute is a coroutine function.
+    Cache lookups stay synchronous as both tiers are local and fast.
+    """
+    cache = get_cache()
+    if cache is None:
+        return await compute()
+    key = make_key(kind, sentence, partial)
+    tokens = cache.get(key)
+    if tokens is not None:
+        return list(tokens)
+    tokens = await compute()
+    if tokens:
+        cache.set(key, list(tokens))
+    return tokens
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+
+from . import metrics
+from .context import split_sentences
+from .ngram import tokenize
+from .parsing import FILLER_WORDS, MAX_TOKENS, STOPWORDS
+from .phonetic import metaphone
+
+logger = logging.getLogger(__name__)
+
+# How much a suggestion's rank in each source counts towards the merged
+# order (reciprocal rank fusion). The LLM sees the whole context so it leads
+# when it answers in time; the local sources fill in and break ties.
+SOURCE_WEIGHTS = {
+    "llm": 1.0,
+    "lexicon": 0.8,
+    "history": 0.5,
+    "ngram": 0.6,
+}
+RANK_OFFSET = 5
+
+_WORD_RE = re.compile(r"[a-z][a-z']+")
+
+
+class Suggestions(list):
+    """
+    A ranked list of words. `pending` is True when the LLM missed the
+    deadline and is still running; its answer lands in the prediction cache,
+    so asking again shortly returns the refined list.
+    """
+    pending = False
+
+
+def merge_ranked(sources, limit=MAX_TOKENS):
+    """
+    Merges {source: [words, best first]} into one deduplicated list by
+    weighted reciprocal rank: a word scores weight / (RANK_OFFSET + rank) in
+    every source that suggests it.
+    """
+    scores = {}
+    for source, words in sources.items():
+        weight = SOURCE_WEIGHTS.get(source, 0.5)
+        for rank, word in enumerate(words):
+            word = word.strip().lower()
+            if word:
+                scores[word] = scores.get(word, 0.0) + weight / (RANK_OFFSET + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+def history_words(text, partial="", limit=MAX_TOKENS):
+    """
+    Content words the patient has already used this session, most recent
+    first. Without partial, only words that followed the word just said
+    (so "a cup of" recalls "tea" from "a cup of tea.", not every earlier
+    word); with partial, those that start like it or sound like it.
+    The unfinished sentence is left out: the patient has just said it.
+    """
+    sentences = split_sentences(text)
+    if sentences and not sentences[-1].endswith((".", "!", "?")):
+        sentences = sentences[:-1]
+    if partial:
+        spelled = re.sub(r"[^a-z]", "", partial.lower())
+        if not spelled:
+            return []
+        key = metaphone(spelled)
+        words = _WORD_RE.findall(" ".join(sentences).lower())
+        words = [
+            w for w in reversed(words)
+            if w not in STOPWORDS and w not in FILLER_WORDS and w != spelled
+            and (w.startswith(spelled) or metaphone(w).startswith(key))
+        ]
+        return list(dict.fromkeys(words))[:limit]
+    spoken = tokenize(text)
+    if not spoken:
+        return []
+    previous = spoken[-1]
+    words = []
+    for sentence in reversed(sentences):
+        sentence_words = tokenize(sentence)
+        for before, word in reversed(list(zip(sentence_words, sentence_words[1:]))):
+            if before == previous and len(word) > 1 and word not in STOPWORDS:
+                words.append(word)
+    return list(dict.fromkeys(words))[:limit]
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_background = set()
+
+
+def get_executor():
+    """
+    Pool that runs LLM calls so a request can stop waiting at its deadline
+    while the call carries on. Rebuilt after a fork, like the HTTP clients.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.PREDICTION_DEADLINE_WORKERS,
+                thread_name_prefix="llm-deadline",
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _run_local(local):
+    results = {}
+    for source, fn in local.items():
+        try:
+            results[source] = fn()
+        except Exception as e:
+            logger.warning(f"Local {source} suggestions failed: {e}")
+            results[source] = []
+    return results
+
+
+def _merge(results, llm_tokens, pending):
+    if llm_tokens:
+        results = dict(results, llm=llm_tokens)
+    suggestions = Suggestions(merge_ranked(results))
+    suggestions.pending = pending
+    return suggestions
+
+
+def _record(start, llm_tokens, pending):
+    metrics.incr("ranking.requests")
+    if pending:
+        metrics.incr("ranking.llm_late")
+    elif llm_tokens:
+        metrics.incr("ranking.llm_in_time")
+    metrics.incr("ranking.latency_ms", round((time.perf_counter() - start) * 1000))
+
+
+def rank_with_deadline(llm, local, deadline_ms):
+    """
+    Starts llm() on the deadline pool, computes the local sources
+    ({source: fn}) meanwhile, and waits for the LLM only until deadline_ms
+    after the call began. Returns the merged Suggestions of whatever has
+    answered; llm may be None to use local sources only.
+    """
+    start = time.perf_counter()
+    future = get_executor().submit(llm) if llm else None
+    results = _run_local(local)
+
+    llm_tokens = []
+    pending = False
+    if future is not None:
+        remaining = deadline_ms / 1000 - (time.perf_counter() - start)
+        try:
+            llm_tokens = future.result(timeout=max(0.0, remaining))
+        except FutureTimeoutError:
+            pending = True
+        except Exception as e:
+            logger.error(f"LLM source failed: {e}")
+    _record(start, llm_tokens, pending)
+    return _merge(results, llm_tokens, pending)
+
+
+def _keep_running(task):
+    # Late LLM calls finish in the background to fill the prediction cache
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def arank_with_deadline(allm, local, deadline_ms):
+    """
+    Async version of rank_with_deadline(): allm() is a coroutine function
+    run as a task that keeps going after the deadline.
+    """
+    start = time.perf_counter()
+    task = asyncio.ensure_future(allm()) if allm else None
+    if task is not None:
+        await asyncio.sleep(0)  # let the LLM request go out before the local work
+    results = _run_local(local)
+
+    llm_tokens = []
+    pending = False
+    if task is not None:
+        remaining = deadline_ms / 1000 - (time.perf_counter() - start)
+        done, _ = await asyncio.wait({task}, timeout=max(0.0, remaining))
+        if not done:
+            pending = True
+            _keep_running(task)
+        elif task.exception() is not None:
+            logger.error(f"LLM source failed: {task.exception()}")
+        else:
+            llm_tokens = task.result()
+    _record(start, llm_tokens, pending)
+    return _merge(results, llm_tokens, pending)
+
+
+metrics.register_gauge(
+    "ranking.llm_in_time_rate",
+    lambda: metrics.ratio("ranking.llm_in_time", "ranking.requests"),
+)
+metrics.register_gauge(
+    "ranking.latency_ms_per_request",
+    lambda: round(metrics.get("ranking.latency_ms") / max(1, metrics.get("ranking.requests")), 1),
+)
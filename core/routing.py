@@ -0,0 +1,167 @@
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from . import metrics
+
+LATENCY_BUCKETS_MS = (25, 50, 100, 200, 300, 500, 800, 1200, 2000, 5000)
+
+
+def get_route(kind):
+    """
+    settings.LLM_ROUTES entry for an endpoint kind ('next_token' or
+    'word_completion'); {} for anything else, which uses the global settings.
+    """
+    return settings.LLM_ROUTES.get(kind, {})
+
+
+def route_model(kind, backend):
+    """
+    Model this route uses on a backend, or None for the backend's default.
+    """
+    return get_route(kind).get("models", {}).get(backend)
+
+
+def is_customised(kind):
+    """
+    True when the route changes the backends or how the LLM is called.
+    """
+    route = get_route(kind)
+    return bool(route.get("backends") or route.get("models")) or any(
+        route.get(field) is not None for field in ("temperature", "max_tokens")
+    )
+
+
+def llm_overrides(kind, backend):
+    """
+    ChatOpenAI settings this route changes on a backend: model, temperature
+    and output token budget (max_tokens).
+    """
+    route = get_route(kind)
+    overrides = {"model": route_model(kind, backend)}
+    overrides["temperature"] = route.get("temperature")
+    overrides["max_tokens"] = route.get("max_tokens")
+    return {k: v for k, v in overrides.items() if v is not None}
+
+
+def deadline_ms(kind):
+    deadline = get_route(kind).get("deadline_ms")
+    return settings.PREDICTION_DEADLINE_MS if deadline is None else deadline
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def _histogram(name, kind):
+    with _histograms_lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = metrics.LatencyHistogram(LATENCY_BUCKETS_MS)
+            _histograms[name] = histogram
+            metrics.register_gauge(f"route.{name}.latency_ms", histogram.snapshot)
+            metrics.register_gauge(f"route.{name}.slo_ms", lambda: get_route(kind).get("slo_ms", 0))
+            metrics.register_gauge(
+                f"route.{name}.slo_met_rate",
+                lambda: metrics.ratio(f"route.{name}.within_slo", f"route.{name}.requests"),
+            )
+        return histogram
+
+
+def observe(kind, ms, stream=False):
+    """
+    Records one request's latency against its route's SLO. Streamed
+    predictions are tracked separately, by time to the first suggestion.
+    """
+    name = f"{kind}_stream" if stream else kind
+    metrics.incr(f"route.{name}.requests")
+    slo = get_route(kind).get("slo_ms")
+    if slo and ms <= slo:
+        metrics.incr(f"route.{name}.within_slo")
+    _histogram(name, kind).add(ms)
+
+
+_in_flight = defaultdict(int)
+_in_flight_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def in_flight(kind, stream=False):
+    """
+    Counts the requests a route is handling right now in this worker,
+    exposed as the route's in_flight gauge.
+    """
+    name = f"{kind}_stream" if stream else kind
+    with _in_flight_lock:
+        if name not in _in_flight:
+            metrics.register_gauge(f"route.{name}.in_flight", lambda: _in_flight[name])
+        _in_flight[name] += 1
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            _in_flight[name] -= 1
+
+
+def _elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+def observed(kind, stream=False):
+    """
+    Decorator recording a prediction function's latency with observe():
+    until it returns, or for generators (stream=True) until the first
+    suggestion is yielded. Calls are counted in_flight() until they finish.
+    """
+    def decorate(fn):
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                first = True
+                with in_flight(kind, stream):
+                    async for item in fn(*args, **kwargs):
+                        if first:
+                            observe(kind, _elapsed_ms(start), stream)
+                            first = False
+                        yield item
+                if first:
+                    observe(kind, _elapsed_ms(start), stream)
+        elif inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                first = True
+                with in_flight(kind, stream):
+                    for item in fn(*args, **kwargs):
+                        if first:
+                            observe(kind, _elapsed_ms(start), stream)
+                            first = False
+                        yield item
+                if first:
+                    observe(kind, _elapsed_ms(start), stream)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    with in_flight(kind, stream):
+                        return await fn(*args, **kwargs)
+                finally:
+                    observe(kind, _elapsed_ms(start), stream)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    with in_flight(kind, stream):
+                        return fn(*args, **kwargs)
+                finally:
+                    observe(kind, _elapsed_ms(start), stream)
+        return wrapper
+    return decorate
@@ -0,0 +1,269 @@
+import asyncio
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller (the leader)
+    runs fn(), every caller that arrives while it is in flight waits for and
+    receives the same result (or exception). Nothing is kept once it finishes;
+    caching completed results is prediction_cache's job.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        metrics.register_gauge(
+            f"{name}.coalesce_rate",
+            lambda: metrics.ratio(f"{name}.shared", f"{name}.leader", f"{name}.shared"),
+        )
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            metrics.incr(f"{self.name}.shared")
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight call {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.incr(f"{self.name}.leader")
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of SingleFlight for the async views. The leader's coroutine
+    runs as its own task and every caller awaits it through asyncio.shield(),
+    so one client disconnecting does not cancel the call for the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._tasks = {}
+
+    async def do(self, key, fn):
+        task = self._tasks.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+            metrics.incr(f"{self.name}.leader")
+        else:
+            metrics.incr(f"{self.name}.shared")
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+    def in_flight(self):
+        return len(self._tasks)
+
+
+class _Stream:
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.items = []
+        self.done = False
+        self.error = None
+
+
+class StreamFlight:
+    """
+    SingleFlight for generators: the leader iterates fn() and yields each
+    item as it arrives, and every caller that shares the key while it is in
+    flight replays the items produced so far, then waits for the rest. If the
+    leader's client goes away early, the others end with what it produced.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        metrics.register_gauge(
+            f"{name}.coalesce_rate",
+            lambda: metrics.ratio(f"{name}.shared", f"{name}.leader", f"{name}.shared"),
+        )
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Stream()
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            metrics.incr(f"{self.name}.shared")
+            yield from self._replay(key, call, timeout)
+            return
+
+        metrics.incr(f"{self.name}.leader")
+        try:
+            for item in fn():
+                with call.changed:
+                    call.items.append(item)
+                    call.changed.notify_all()
+                yield item
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            with call.changed:
+                call.done = True
+                call.changed.notify_all()
+
+    def _replay(self, key, call, timeout):
+        seen = 0
+        while True:
+            with call.changed:
+                if not call.changed.wait_for(lambda: len(call.items) > seen or call.done, timeout):
+                    raise TimeoutError(f"Timed out waiting for in-flight stream {key!r}")
+                items = call.items[seen:]
+                done = call.done
+            yield from items
+            seen += len(items)
+            if done:
+                if call.error is not None:
+                    raise call.error
+                return
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class _AsyncStream:
+    def __init__(self):
+        self.changed = asyncio.Event()
+        self.items = []
+        self.task = None
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class AsyncStreamFlight:
+    """
+    asyncio version of StreamFlight. The async generator is drained by its
+    own task, so one client disconnecting does not cut the stream short for
+    the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is None or call.task.get_loop() is not asyncio.get_running_loop():
+            call = _AsyncStream()
+            call.task = asyncio.ensure_future(self._drain(call, fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda t: self._finished(key, call))
+            metrics.incr(f"{self.name}.leader")
+        else:
+            metrics.incr(f"{self.name}.shared")
+
+        seen = 0
+        while True:
+            if seen < len(call.items):
+                seen += 1
+                yield call.items[seen - 1]
+            elif call.task.done():
+                call.task.result()  # re-raises the stream's error
+                return
+            else:
+                await call.changed.wait()
+
+    @staticmethod
+    async def _drain(call, stream):
+        try:
+            async for item in stream:
+                call.items.append(item)
+                call.notify()
+        finally:
+            call.notify()
+
+    def _finished(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.task.cancelled():
+            call.task.exception()  # mark retrieved even if every reader went away
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+# Shared by both prediction chains; keyed by the normalised prompt
+llm_calls = SingleFlight("singleflight")
+async_llm_calls = AsyncSingleFlight("singleflight")
+# The streaming chains' own flights, as they share tokens rather than lists
+llm_streams = StreamFlight("singleflight.stream")
+async_llm_streams = AsyncStreamFlight("singleflight.stream")
+
+
+def coalesced(key, fn):
+    if not settings.LLM_COALESCE_REQUESTS:
+        return fn()
+    return llm_calls.do(key, fn, timeout=settings.LLM_HTTP_TIMEOUT * 2)
+
+
+async def acoalesced(key, fn):
+    if not settings.LLM_COALESCE_REQUESTS:
+        return await fn()
+    return await async_llm_calls.do(key, fn)
+
+
+def coalesced_stream(key, fn):
+    if not settings.LLM_COALESCE_REQUESTS:
+        return fn()
+    return llm_streams.do(key, fn, timeout=settings.LLM_HTTP_TIMEOUT * 2)
+
+
+def acoalesced_stream(key, fn):
+    if not settings.LLM_COALESCE_REQUESTS:
+        return fn()
+    return async_llm_streams.do(key, fn)
@@ -1,3 +1,1422 @@
-from django.test import TestCase
+import asyncio
+import ctypes
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import wave
+from collections import OrderedDict
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase
+from django.test.utils import override_settings
+
+from . import hedging, llm_utils, metrics, ngram, phonetic, prediction_cache, routing, transcription, transcription_cache, views, warmup
+from .batching import MicroBatcher
+from .breaker import CLOSED, HALF_OPEN, OPEN, BackendUnavailable, CircuitBreaker
+from .context import build_context, count_tokens, keyword_summary
+from .direct_client import DirectChatClient
+from .hedging import HedgePolicy
+from .local_model import LocalModel
+from .logprobs import predict_next_words, rank_words, word_probabilities
+from .ngram import NgramModel
+from .parsing import MAX_TOKENS, TokenStreamParser, clean_tokens, repair_batch_results, repair_token_list
+from .phonetic import BKTree, PhoneticIndex, levenshtein, metaphone, transposition_distance
+from .prediction_cache import LRUCache, PredictionCache, SQLiteCache
+from .ranking import arank_with_deadline, history_words, merge_ranked, rank_with_deadline
+from .singleflight import AsyncSingleFlight, AsyncStreamFlight, SingleFlight, StreamFlight
+from .transcription import LocalWhisperEngine, TranscriptionEngine, transcription_result
+from .uploads import SpooledUploadedFile, audio_file, container_suffix
+from .warmup import COLD, HOT, REFRESH, UNAVAILABLE, WARM, WARMING, OllamaWarmer
+
+try:
+    import numpy
+
+    from . import audio, vad
+except ImportError:  # Optional: only the local model and the audio stage use it
+    numpy = None
+
+try:
+    import av
+except ImportError:  # Optional: only the audio stage decodes clips
+    av = None
+
+
+class RepairTokenListTests(SimpleTestCase):
+    def test_json_object(self):
+        self.assertEqual(repair_token_list('{"tokens": ["Coffee", "tea"]}'), ["coffee", "tea"])
+
+    def test_fenced_json(self):
+        self.assertEqual(repair_token_list('Sure!\n```json\n{"tokens": ["water"]}\n```'), ["water"])
+
+    def test_single_quoted_dict(self):
+        self.assertEqual(repair_token_list("{'tokens': ['juice', 'milk']}"), ["juice", "milk"])
+
+    def test_truncated_array(self):
+        self.assertEqual(repair_token_list('{"tokens": ["bread", "butter", "jam'), ["bread", "butter"])
+
+    def test_bare_list_drops_prose(self):
+        self.assertEqual(repair_token_list("Here you go:\n1. coffee\n2. tea"), ["coffee", "tea"])
+
+    def test_phrases_are_dropped(self):
+        self.assertEqual(repair_token_list("walking the dog, running"), ["running"])
+
+    def test_json_literals_are_dropped(self):
+        self.assertEqual(repair_token_list("null"), [])
+        self.assertEqual(repair_token_list('["true", "soup"]'), ["soup"])
+
+    def test_clean_tokens(self):
+        items = ["The", "Coffee.", "coffee", "don't", "x-ray", "ice cream", 3, "Suggestions:"]
+        self.assertEqual(clean_tokens(items), ["coffee", "don't", "x-ray"])
+
+    def test_limit(self):
+        words = ["apple", "bread", "cheese", "dates", "eggs", "figs", "grapes"]
+        self.assertEqual(repair_token_list(", ".join(words), limit=5), words[:5])
+
+
+class PredictionCacheTests(SimpleTestCase):
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+
+    def test_lru_expires_entries(self):
+        cache = LRUCache(max_size=2, ttl=10)
+        with mock.patch("core.prediction_cache.time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with mock.patch("core.prediction_cache.time.monotonic", return_value=111.0):
+            self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_sqlite_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            disk = SQLiteCache(path, ttl=10)
+            disk.set("k", ["coffee"])
+            self.assertEqual(SQLiteCache(path, ttl=10).get("k"), ["coffee"])
+            expired = time.time() + 11
+            with mock.patch("core.prediction_cache.time.time", return_value=expired):
+                self.assertEqual(disk.get("k"), None)
+
+    def test_sqlite_hit_fills_memory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            PredictionCache(4, 60, sqlite_path=path).set("k", ["tea"])
+            cache = PredictionCache(4, 60, sqlite_path=path, prefix="test_cache")
+            hits = metrics.get("test_cache.hit_sqlite")
+            self.assertEqual(cache.get("k"), ["tea"])
+            self.assertEqual(metrics.get("test_cache.hit_sqlite"), hits + 1)
+            self.assertEqual(cache.memory.get("k"), ["tea"])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight("test_singleflight")
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return ["coffee"]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("k", fn, timeout=5))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while flight.in_flight() == 0:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["coffee"]] * 4)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_error_reaches_every_caller_and_is_not_kept(self):
+        flight = SingleFlight("test_singleflight")
+
+        def fail():
+            raise ValueError("down")
+
+        with self.assertRaises(ValueError):
+            flight.do("k", fail)
+        self.assertEqual(flight.do("k", lambda: "ok"), "ok")
+
+    def test_async_callers_share_one_call(self):
+        flight = AsyncSingleFlight("test_singleflight")
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ["tea"]
+
+        async def main():
+            return await asyncio.gather(*(flight.do("k", fn) for _ in range(3)))
+
+        self.assertEqual(asyncio.run(main()), [["tea"]] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_stream_followers_replay_then_follow_the_leader(self):
+        flight = StreamFlight("test_singleflight")
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            yield "coffee"
+            release.wait(5)
+            yield "tea"
+
+        leader = flight.do("k", fn, timeout=5)
+        self.assertEqual(next(leader), "coffee")
+        results = []
+        follower = threading.Thread(target=lambda: results.append(list(flight.do("k", fn, timeout=5))))
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        self.assertEqual(list(leader), ["tea"])
+        follower.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["coffee", "tea"]])
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_stream_error_reaches_every_reader(self):
+        flight = StreamFlight("test_singleflight")
+
+        def fail():
+            yield "coffee"
+            raise ValueError("down")
+
+        leader = flight.do("k", fail)
+        self.assertEqual(next(leader), "coffee")
+        follower = flight.do("k", fail)
+        with self.assertRaises(ValueError):
+            next(leader)
+        self.assertEqual(next(follower), "coffee")
+        with self.assertRaises(ValueError):
+            next(follower)
+        self.assertEqual(list(flight.do("k", lambda: iter(["ok"]))), ["ok"])
+
+    def test_async_stream_outlives_a_disconnected_reader(self):
+        flight = AsyncStreamFlight("test_singleflight")
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            for token in ["coffee", "tea", "milk"]:
+                await asyncio.sleep(0.01)
+                yield token
+
+        async def first_only():
+            async for token in flight.do("k", fn):
+                return [token]
+
+        async def read_all():
+            return [token async for token in flight.do("k", fn)]
+
+        async def main():
+            return await asyncio.gather(first_only(), read_all(), read_all())
+
+        self.assertEqual(asyncio.run(main()), [["coffee"], ["coffee", "tea", "milk"], ["coffee", "tea", "milk"]])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_concurrent_token_streams_share_one_generation(self):
+        calls = []
+
+        async def tokens(inputs):
+            calls.append(inputs)
+            for token in ["coffee", "tea"]:
+                await asyncio.sleep(0.01)
+                yield token
+
+        async def read():
+            return [token async for token in llm_utils.astream_next_token_chain("a cup of")]
+
+        async def main():
+            return await asyncio.gather(read(), read())
+
+        with mock.patch.object(llm_utils, "_anext_token_stream", tokens), \
+                mock.patch.object(llm_utils, "get_cache", return_value=None):
+            self.assertEqual(asyncio.run(main()), [["coffee", "tea"]] * 2)
+        self.assertEqual(len(calls), 1)
+
+
+class AsyncViewTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+
+    def post(self, data):
+        return self.factory.post("/", data=json.dumps(data), content_type="application/json")
+
+    async def test_next_token(self):
+        async def predict(sentence, session):
+            return ["coffee", "tea"]
+
+        with mock.patch.object(views, "apredict_next_token_chain", predict):
+            response = await views.apredict_next_token(self.post({"sentence": "a cup of"}))
+        self.assertEqual(json.loads(response.content), {"tokens": ["coffee", "tea"], "pending": False})
+
+    async def test_word_completion_without_partial(self):
+        response = await views.apredict_word_completion(self.post({"sentence": "a cup of"}))
+        self.assertEqual(json.loads(response.content), {"tokens": []})
+
+    async def test_errors_are_reported(self):
+        async def predict(sentence, session):
+            raise RuntimeError("down")
+
+        with mock.patch.object(views, "apredict_next_token_chain", predict), self.assertLogs("core.views", "ERROR"):
+            response = await views.apredict_next_token(self.post({"sentence": "a cup of"}))
+        self.assertEqual(response.status_code, 500)
+
+    async def test_method_not_allowed(self):
+        response = await views.apredict_next_token(self.factory.get("/"))
+        self.assertEqual(response.status_code, 405)
+
+    async def test_transcribe_needs_audio(self):
+        response = await views.atranscribe_audio(self.factory.post("/"))
+        self.assertEqual(response.status_code, 400)
+
+
+def stream(text, chunk_size=3):
+    """
+    Feeds text to a TokenStreamParser in small chunks; returns the tokens
+    emitted while streaming and those emitted by finish().
+    """
+    parser = TokenStreamParser()
+    streamed = []
+    for i in range(0, len(text), chunk_size):
+        streamed += parser.feed(text[i:i + chunk_size])
+    return streamed, parser.finish()
+
+
+class TokenStreamParserTests(SimpleTestCase):
+    def test_json_strings_are_emitted_as_they_close(self):
+        parser = TokenStreamParser()
+        self.assertEqual(parser.feed('{"tokens": ["coff'), [])
+        self.assertEqual(parser.feed('ee", "te'), ["coffee"])
+        self.assertEqual(parser.feed('a"]}'), ["tea"])
+        self.assertEqual(parser.finish(), [])
+
+    def test_bare_lines(self):
+        self.assertEqual(stream("coffee\ntea\nmilk"), (["coffee", "tea"], ["milk"]))
+
+    def test_lead_in_line_is_not_emitted(self):
+        self.assertEqual(stream("Here you go:\ncoffee\ntea"), (["coffee"], ["tea"]))
+        self.assertEqual(stream("Sure, here are some words:\ncoffee\ntea\n"), (["coffee", "tea"], []))
+
+    def test_comma_list_streams_once_it_is_a_list(self):
+        self.assertEqual(stream("coffee, tea, milk, sugar", 1), (["coffee", "tea", "milk"], ["sugar"]))
+
+    def test_prose_before_json(self):
+        self.assertEqual(stream('Sure, here they are:\n["coffee", "tea"]'), (["coffee", "tea"], []))
+
+    def test_stops_at_limit(self):
+        parser = TokenStreamParser(limit=2)
+        self.assertEqual(parser.feed('["a1", "bread", "jam", "milk"]'), ["bread", "jam"])
+        self.assertTrue(parser.done)
+
+    def test_falls_back_to_repair(self):
+        self.assertEqual(stream("{'tokens': ['soup']}"), ([], ["soup"]))
+
+
+class StreamViewTests(SimpleTestCase):
+    def test_events(self):
+        request = RequestFactory().post("/", data=json.dumps({"sentence": "a cup of"}), content_type="application/json")
+        with mock.patch.object(views, "suggest_next_words", return_value=["tea"]), \
+                mock.patch.object(views, "stream_next_token_chain", return_value=iter(["coffee", "milk"])):
+            response = views.predict_next_token_stream(request)
+            body = b"".join(response.streaming_content).decode()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(body, "".join([
+            views.sse_event("seed", {"tokens": ["tea"]}),
+            views.sse_event("token", {"token": "coffee", "index": 0}),
+            views.sse_event("token", {"token": "milk", "index": 1}),
+            views.sse_event("done", {"tokens": ["coffee", "milk"]}),
+        ]))
+
+
+class FakeStreamClient:
+    """
+    Stands in for a DirectChatClient, streaming canned chunks and recording
+    how many were sent before the stream was closed.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+        self.closed = False
+
+    def stream(self, inputs):
+        try:
+            for chunk in self.chunks:
+                self.sent += 1
+                yield chunk
+        finally:
+            self.closed = True
+
+
+@override_settings(LLM_CLIENT="direct")
+class EarlyStopTests(SimpleTestCase):
+    def tokens(self, client):
+        with mock.patch.object(llm_utils, "get_direct_client", return_value=client):
+            return list(llm_utils._iter_backend_tokens("next_token", {"sentence": "a cup of"}, "ollama"))
+
+    def test_stream_closes_once_enough_words_are_parsed(self):
+        words = [f"word{a}{b}" for a in "ab" for b in "abcdefghijklmnop"]
+        client = FakeStreamClient(['{"tokens": ['] + [f'"{w}", ' for w in words] + ["]}"])
+        self.assertEqual(self.tokens(client), words[:MAX_TOKENS])
+        self.assertTrue(client.closed)
+        self.assertLess(client.sent, len(client.chunks))
+
+    def test_short_reply_is_read_to_the_end(self):
+        client = FakeStreamClient(['{"tokens": ["coffee", ', '"tea"', "]}"])
+        self.assertEqual(self.tokens(client), ["coffee", "tea"])
+        self.assertEqual(client.sent, 3)
+
+
+@override_settings(LLM_CONTEXT_SENTENCE_TOKENS=16, LLM_CONTEXT_HISTORY_TOKENS=24, LLM_CONTEXT_SUMMARY_KEYWORDS=3)
+class BuildContextTests(SimpleTestCase):
+    def test_short_conversation_is_kept_whole(self):
+        self.assertEqual(build_context("I am hungry. I would like"), "I am hungry. I would like")
+
+    def test_size_stays_bounded(self):
+        sentences = [f"I would like some {food} please." for food in ("soup", "bread", "cheese", "apples")] * 25
+        context = build_context(" ".join(sentences) + " and then a cup of")
+        summary, _, recent = context.partition(") ")
+        self.assertTrue(summary.startswith("(earlier topics: "))
+        self.assertLessEqual(count_tokens(recent), 16 + 24)
+        self.assertTrue(recent.endswith("and then a cup of"))
+
+    def test_long_sentence_keeps_its_last_words(self):
+        context = build_context("so " * 40 + "a cup of")
+        self.assertTrue(context.endswith("a cup of"))
+        self.assertLessEqual(count_tokens(context), 16)
+
+    def test_keyword_summary(self):
+        sentences = ["the soup was cold.", "more soup please.", "my bread is stale."]
+        self.assertEqual(keyword_summary(sentences, 2), "soup, bread")
+
+
+class NgramModelTests(SimpleTestCase):
+    def setUp(self):
+        self.model = NgramModel(order=3)
+        for sentence in [
+            "i would like a cup of tea",
+            "i would like a cup of coffee",
+            "a cup of tea please",
+            "we flew to san francisco",
+            "san francisco is foggy",
+            "back to san francisco",
+            "i like tea and toast",
+        ]:
+            self.model.update(sentence)
+
+    def test_probabilities_sum_to_one(self):
+        vocabulary = self.model.followers[()]
+        for context in [("cup", "of"), ("i", "like"), ("never", "seen")]:
+            total = sum(self.model._prob(w, context, True) for w in vocabulary)
+            self.assertAlmostEqual(total, 1.0, places=6)
+
+    def test_frequent_follower_ranks_first(self):
+        self.assertEqual(self.model.predict("a cup of")[:2], ["tea", "coffee"])
+
+    def test_continuation_counts_in_backoff(self):
+        # 'francisco' is as frequent as 'tea' but only ever follows 'san'
+        unseen = ("never", "seen")
+        self.assertLess(self.model._prob("francisco", unseen, True), self.model._prob("tea", unseen, True))
+
+    def test_prefix_and_stopwords(self):
+        self.assertEqual(self.model.predict("a cup of", prefix="co"), ["coffee"])
+        self.assertNotIn("a", self.model.predict("i would like"))
+
+
+@override_settings(NGRAM_ENABLED=True, NGRAM_HISTORY_MAX_BYTES=0)
+class LearnConversationTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.history = os.path.join(directory.name, "history.txt")
+        self.model = NgramModel(order=3)
+        for patch in (mock.patch.object(ngram, "_model", self.model), mock.patch.object(ngram, "_learned", OrderedDict())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def count(self):
+        return self.model.counts[("need", "water")]
+
+    def test_repeats_are_counted_once_per_occurrence(self):
+        with override_settings(NGRAM_HISTORY_PATH=self.history):
+            ngram.learn_conversation("I need water. Hello", "s1")
+            ngram.learn_conversation("I need water. Hello there.", "s1")
+            self.assertEqual(self.count(), 1)
+            ngram.learn_conversation("I need water. Hello there. I need water.", "s1")
+            self.assertEqual(self.count(), 2)
+            ngram.learn_conversation("I need water.", "s2")
+            self.assertEqual(self.count(), 3)
+        with open(self.history) as f:
+            self.assertEqual(f.read().splitlines(), ["I need water.", "Hello there.", "I need water.", "I need water."])
+
+    def test_history_rotates(self):
+        with override_settings(NGRAM_HISTORY_MAX_BYTES=20):
+            ngram.append_history(self.history, ["I need water.", "Hello there."])
+            ngram.append_history(self.history, ["Bye."])
+        with open(f"{self.history}.1") as f:
+            self.assertEqual(f.read(), "I need water.\nHello there.\n")
+        with open(self.history) as f:
+            self.assertEqual(f.read(), "Bye.\n")
+
+    def test_views_learn_but_chains_do_not(self):
+        request = RequestFactory().post(
+            "/", data=json.dumps({"sentence": "I need water. A cup of", "session": "s1"}), content_type="application/json",
+        )
+        with override_settings(PREDICTION_CACHE_ENABLED=False, LLM_ROUTES={}, PREDICTION_DEADLINE_MS=0), \
+                mock.patch.object(llm_utils, "generate_tokens", return_value=["tea"]):
+            # Replayed contexts (cache warming, benchmarks) go straight to the chains
+            llm_utils.predict_next_token_chain("I need water. A cup of", "s1")
+            self.assertEqual(self.count(), 0)
+            views.predict_next_token(request)
+            self.assertEqual(self.count(), 1)
+
+    def test_async_views_learn_off_the_event_loop(self):
+        threads = []
+
+        async def predict(sentence, session):
+            return ["tea"]
+
+        async def post():
+            request = AsyncRequestFactory().post("/", data=json.dumps({"sentence": "a cup of"}), content_type="application/json")
+            await views.apredict_next_token(request)
+            return threading.current_thread()
+
+        with mock.patch.object(views, "learn_conversation", lambda *args: threads.append(threading.current_thread())), \
+                mock.patch.object(views, "apredict_next_token_chain", predict):
+            loop_thread = asyncio.run(post())
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], loop_thread)
+
+
+class PhoneticTests(SimpleTestCase):
+    def test_metaphone_groups_sound_alikes(self):
+        self.assertEqual(metaphone("knife"), metaphone("nife"))
+        self.assertEqual(metaphone("phone"), metaphone("fone"))
+        self.assertEqual(metaphone(""), "")
+
+    def test_bit_parallel_levenshtein_matches_reference(self):
+        def reference(a, b):
+            row = list(range(len(b) + 1))
+            for i, ca in enumerate(a, 1):
+                previous, row[0] = row[0], i
+                for j, cb in enumerate(b, 1):
+                    previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (ca != cb))
+            return row[-1]
+
+        rng = random.Random(7)
+        for _ in range(300):
+            a = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 9)))
+            b = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 9)))
+            self.assertEqual(levenshtein(a, b), reference(a, b), (a, b))
+
+    def test_transpositions_cost_one(self):
+        self.assertEqual(transposition_distance("recieve", "receive"), 1)
+        self.assertEqual(levenshtein("recieve", "receive"), 2)
+
+    def test_bk_tree_finds_everything_within_radius(self):
+        words = ["book", "books", "cake", "boo", "boon", "cook", "cape", "cart"]
+        tree = BKTree()
+        for word in words:
+            tree.add(word)
+        for radius in range(3):
+            expected = sorted((w, levenshtein("bock", w)) for w in words if levenshtein("bock", w) <= radius)
+            self.assertEqual(sorted(tree.search("bock", radius)), expected)
+
+    def test_index_search(self):
+        index = PhoneticIndex(["hospital", "hose", "knife", "coffee", "cough"])
+        self.assertEqual(index.search("hostipal")[0], "hospital")
+        self.assertEqual(index.search("nife")[0], "knife")
+        self.assertIn("coffee", index.search("cof"))
+        self.assertEqual(index.search("123"), [])
+
+    def test_index_holds_only_the_lexicon(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lexicon = os.path.join(tmp, "lexicon.txt")
+            with open(lexicon, "w") as f:
+                f.write("# comment\nhospital coffee\nkitchen\n")
+            with mock.patch.object(phonetic, "_index", None), \
+                    override_settings(PHONETIC_LEXICON_PATH=lexicon, NGRAM_ENABLED=True):
+                index = phonetic.get_index()
+        self.assertEqual(len(index), 3)
+        self.assertIn("coffee", index)
+        # Common words the n-gram engine knows do not compete as completions
+        self.assertNotIn("some", index)
+
+    def test_rerank_keeps_the_llms_own_words_ahead_of_weak_sound_alikes(self):
+        candidates = ["physics", "physical", "fizzy", "physio"]
+        tokens = llm_utils.rerank_completions(["physiotherapy", "physio", "physician"], candidates)
+        # A word both suggest leads; the LLM's own words are not pushed below the candidates
+        self.assertEqual(tokens[0], "physio")
+        self.assertLess(tokens.index("physiotherapy"), tokens.index("fizzy"))
+        self.assertEqual(set(tokens), {"physiotherapy", "physio", "physician", "physics", "physical", "fizzy"})
+        self.assertEqual(llm_utils.rerank_completions(["coffee"], []), ["coffee"])
+
+
+class RankingTests(SimpleTestCase):
+    def test_merge_ranked(self):
+        merged = merge_ranked({"llm": ["coffee", "tea"], "ngram": ["tea", "milk"], "lexicon": ["cocoa"]})
+        # 'tea' is in two sources; the LLM's top word still leads the rest
+        self.assertEqual(merged[:2], ["tea", "coffee"])
+        self.assertEqual(set(merged), {"coffee", "tea", "milk", "cocoa"})
+
+    def test_llm_in_time_is_merged(self):
+        suggestions = rank_with_deadline(lambda: ["coffee"], {"ngram": lambda: ["tea"]}, deadline_ms=1000)
+        self.assertEqual(suggestions, ["coffee", "tea"])
+        self.assertFalse(suggestions.pending)
+
+    def test_late_llm_leaves_local_answer_pending(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        suggestions = rank_with_deadline(lambda: release.wait(5) and ["coffee"], {"ngram": lambda: ["tea"]}, deadline_ms=20)
+        self.assertEqual(suggestions, ["tea"])
+        self.assertTrue(suggestions.pending)
+
+    def test_failing_sources_are_skipped(self):
+        def fail():
+            raise RuntimeError("down")
+
+        with self.assertLogs("core.ranking", "WARNING") as logs:
+            suggestions = rank_with_deadline(fail, {"ngram": lambda: ["tea"], "lexicon": fail}, deadline_ms=1000)
+        self.assertEqual(suggestions, ["tea"])
+        self.assertEqual([r.levelname for r in logs.records], ["WARNING", "ERROR"])
+
+    def test_async_late_llm(self):
+        async def allm():
+            await asyncio.sleep(5)
+
+        async def main():
+            return await arank_with_deadline(allm, {"ngram": lambda: ["tea"]}, deadline_ms=20)
+
+        suggestions = asyncio.run(main())
+        self.assertEqual((suggestions, suggestions.pending), (["tea"], True))
+
+    def test_history_follows_the_previous_word(self):
+        self.assertEqual(history_words("i went to the shop. a cup of"), [])
+        self.assertEqual(history_words("i want a cup of tea. then a cup of coffee. a cup of"), ["coffee", "tea"])
+
+    def test_history_completion(self):
+        self.assertEqual(history_words("i went to the shop. a cup of", "sh"), ["shop"])
+        self.assertEqual(history_words("i went to the shop. we need", "!"), [])
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("core.breaker.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker("test", window=4, min_calls=4, failure_rate=0.5, slow_ms=100, cooldown=10)
+
+    def test_opens_once_enough_calls_fail(self):
+        for ok in (True, True, False):
+            self.breaker.record(ok)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.record(True, elapsed_ms=500)  # slow calls count as failures
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_probe(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.now += 10
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())  # one probe at a time
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+@override_settings(LLM_ROUTES={}, LLM_BACKEND_ORDER=["ollama", "mistral"], MISTRAL_API_KEY="key", LOCAL_MODEL_PATH="")
+class BackendFallbackTests(SimpleTestCase):
+    def setUp(self):
+        breakers = {}
+        patcher = mock.patch.object(
+            llm_utils, "get_breaker",
+            lambda name: breakers.setdefault(name, CircuitBreaker(name, min_calls=2, cooldown=60)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backend_order(self):
+        self.assertEqual(llm_utils.backend_order(), ["ollama", "mistral"])
+        with override_settings(MISTRAL_API_KEY=""):
+            self.assertEqual(llm_utils.backend_order(), ["ollama"])
+        with override_settings(LLM_BACKEND_ORDER=["ollama", "unknown"]):
+            self.assertEqual(llm_utils.backend_order(), ["ollama"])
+
+    def test_falls_over_and_skips_an_open_circuit(self):
+        calls = []
+
+        def call(name):
+            calls.append(name)
+            if name == "ollama":
+                raise ConnectionError("refused")
+            return name
+
+        with self.assertLogs("core.llm_utils", "WARNING"):
+            self.assertEqual(llm_utils._call_backends(call), "mistral")
+            self.assertEqual(llm_utils._call_backends(call), "mistral")
+        # Ollama's circuit is open now, so it is not called again
+        self.assertEqual(llm_utils._call_backends(call), "mistral")
+        self.assertEqual(calls, ["ollama", "mistral", "ollama", "mistral", "mistral"])
+
+    def test_all_backends_down(self):
+        def call(name):
+            raise ConnectionError("refused")
+
+        with self.assertLogs("core.llm_utils", "WARNING"), self.assertRaises(ConnectionError):
+            llm_utils._call_backends(call)
+        with override_settings(LLM_BACKEND_ORDER=[]), self.assertRaises(BackendUnavailable):
+            llm_utils._call_backends(call)
+
+
+class HedgePolicyTests(SimpleTestCase):
+    def test_burst_then_rate_cap(self):
+        policy = HedgePolicy(max_rate=0.1, burst=5)
+        decisions = [policy.decide(True) for _ in range(105)]
+        # The first requests after startup hedge, then one in ten
+        self.assertTrue(all(decisions[:5]))
+        self.assertEqual(sum(decisions), 5 + 10)
+
+    def test_requests_that_do_not_hedge_earn_hedges(self):
+        policy = HedgePolicy(max_rate=0.1, burst=1)
+        self.assertTrue(policy.decide(True))
+        self.assertFalse(policy.decide(True))
+        for _ in range(10):
+            policy.decide(False)
+        self.assertTrue(policy.decide(True))
+
+    def test_delay_follows_observed_latency(self):
+        policy = HedgePolicy(percentile=90, default_delay_ms=1000, min_delay_ms=50, min_samples=10)
+        self.assertEqual(policy.delay_ms(), 1000)
+        for ms in range(100, 1100, 100):
+            policy.latency.add(ms)
+        self.assertEqual(policy.delay_ms(), 1000.0)
+        policy.latency = metrics.LatencyWindow(10)
+        for _ in range(10):
+            policy.latency.add(10)
+        self.assertEqual(policy.delay_ms(), 50)
+
+
+class HedgedTests(SimpleTestCase):
+    def setUp(self):
+        self.policy = HedgePolicy(default_delay_ms=20)
+        patcher = mock.patch.object(hedging, "get_policy", lambda: self.policy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fast_primary_is_not_hedged(self):
+        secondary = mock.Mock(return_value=["tea"])
+        self.assertEqual(hedging.hedged(lambda cancel: ["coffee"], secondary), ["coffee"])
+        secondary.assert_not_called()
+
+    def test_slow_primary_is_hedged_and_cancelled(self):
+        cancelled = threading.Event()
+
+        def primary(cancel):
+            if cancel.wait(5):
+                cancelled.set()
+            return ["coffee"]
+
+        self.assertEqual(hedging.hedged(primary, lambda cancel: ["tea"]), ["tea"])
+        self.assertTrue(cancelled.wait(5))
+
+    def test_async_slow_primary_is_hedged(self):
+        async def primary():
+            await asyncio.sleep(5)
+            return ["coffee"]
+
+        async def secondary():
+            return ["tea"]
+
+        self.assertEqual(asyncio.run(hedging.ahedged(primary, secondary)), ["tea"])
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def test_batches_split_at_max_size(self):
+        sizes = []
+
+        def handler(items):
+            sizes.append(len(items))
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(handler, window_ms=200, max_size=3, name="test_batch")
+        futures = [batcher.submit(i) for i in range(5)]
+        self.assertEqual([f.result(timeout=5) for f in futures], [0, 2, 4, 6, 8])
+        self.assertEqual(sizes, [3, 2])
+
+    def test_handler_errors_reach_every_caller(self):
+        batcher = MicroBatcher(lambda items: [1], window_ms=50, name="test_batch")
+        futures = [batcher.submit(i) for i in range(2)]
+        for future in futures:
+            with self.assertRaisesRegex(ValueError, "1 results for 2 items"):
+                future.result(timeout=5)
+
+
+class RepairBatchResultsTests(SimpleTestCase):
+    def test_results_by_id(self):
+        text = '```json\n{"results": [{"id": 2, "tokens": ["tea", "the"]}, {"id": 1, "tokens": ["coffee"]}]}\n```'
+        self.assertEqual(repair_batch_results(text, 3), [["coffee"], ["tea"], []])
+
+    def test_results_by_position(self):
+        text = '[{"tokens": ["tea"]}, {"tokens": ["juice"]}, {"tokens": ["extra"]}]'
+        self.assertEqual(repair_batch_results(text, 2), [["tea"], ["juice"]])
+
+    def test_unusable_reply(self):
+        self.assertEqual(repair_batch_results("sorry, I can't help", 2), [[], []])
+
+
+class OllamaWarmerTests(SimpleTestCase):
+    def setUp(self):
+        self.warmer = OllamaWarmer("http://ollama:11434/v1", ["llama3.2"], "30m", interval=60)
+
+    def test_warm_sets_keep_alive_again_after_priming(self):
+        calls = []
+        with mock.patch.object(self.warmer, "preload", lambda: calls.append("preload") or 0), \
+                mock.patch.object(self.warmer, "prime", lambda: calls.append("prime")):
+            self.assertTrue(self.warmer.warm())
+        self.assertEqual(calls, ["preload", "prime", "preload"])
+        self.assertEqual(self.warmer.state, HOT)
+
+    def test_failed_warm_up(self):
+        with mock.patch.object(self.warmer, "preload", side_effect=ConnectionError("refused")), \
+                self.assertLogs("core.warmup", "WARNING"):
+            self.assertFalse(self.warmer.warm())
+        self.assertEqual((self.warmer.state, self.warmer.last_error), (UNAVAILABLE, "refused"))
+
+    def test_state_is_readable_during_a_warm_up(self):
+        loading, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+
+        def preload():
+            loading.set()
+            release.wait(5)
+            return 0
+
+        with mock.patch.object(self.warmer, "preload", preload), mock.patch.object(self.warmer, "prime"):
+            thread = threading.Thread(target=self.warmer.warm)
+            thread.start()
+            self.assertTrue(loading.wait(5))
+            # Neither a second warm-up nor a reader waits for the first one
+            self.assertFalse(self.warmer.warm())
+            self.assertEqual(self.warmer.state, WARMING)
+            release.set()
+            thread.join(5)
+        self.assertEqual(self.warmer.state, HOT)
+
+    def test_next_step(self):
+        self.assertEqual(self.warmer.next_step(), WARM)
+        self.warmer.state = HOT
+        for left, step in ((3600, None), (90, REFRESH), (None, WARM)):
+            with mock.patch.object(self.warmer, "seconds_left", return_value=left):
+                self.assertEqual(self.warmer.next_step(), step)
+        self.assertEqual(self.warmer.state, COLD)
+
+    def test_seconds_left(self):
+        response = mock.Mock()
+        response.json.return_value = {"models": [
+            {"name": "llama3.2:latest", "expires_at": "2999-01-01T00:00:00.123456789+00:00"},
+        ]}
+        with mock.patch("core.warmup.httpx.get", return_value=response) as get:
+            self.assertGreater(self.warmer.seconds_left(), 0)
+            get.assert_called_once_with("http://ollama:11434/api/ps", timeout=5)
+            self.warmer.models = ["llama3.2", "mistral"]
+            self.assertIsNone(self.warmer.seconds_left())
+
+
+@override_settings(OLLAMA_WARMUP=True, LLM_BACKEND_ORDER=["ollama"], LLM_ROUTES={}, TRANSCRIPTION_ENGINE="openai")
+class ReadinessTests(SimpleTestCase):
+    def test_not_required(self):
+        with override_settings(OLLAMA_WARMUP=False):
+            self.assertEqual(warmup.readiness(), {"ready": True, "state": "not_required"})
+
+    def test_only_reads_state(self):
+        warmer = OllamaWarmer("http://ollama:11434/v1", ["llama3.2"], "30m")
+        with mock.patch.object(warmup, "get_warmer", return_value=warmer), mock.patch.object(warmer, "start") as start:
+            self.assertEqual(warmup.readiness(), {"ready": False, "state": COLD, "models": ["llama3.2"]})
+            warmer.state = HOT
+            self.assertTrue(warmup.readiness()["ready"])
+        start.assert_not_called()
+
+
+@override_settings(LLM_PROMPT_CACHE=True, LLM_PROMPT_CACHE_SLOTS=4)
+class PromptCacheTests(SimpleTestCase):
+    def test_session_keeps_its_slot(self):
+        inputs = {"sentence": "a cup of", "session": "page-1"}
+        slot = llm_utils.prompt_slot("next_token", inputs, "ollama")
+        self.assertIn(slot, range(4))
+        self.assertEqual(llm_utils.prompt_slot("next_token", dict(inputs, sentence="a cup of tea and"), "ollama"), slot)
+
+    def test_no_slot(self):
+        inputs = {"sentence": "a cup of", "session": "page-1"}
+        self.assertIsNone(llm_utils.prompt_slot("next_token", inputs, "mistral"))
+        self.assertIsNone(llm_utils.prompt_slot("next_token", {"sentence": "a cup of"}, "ollama"))
+        with override_settings(LLM_PROMPT_CACHE_SLOTS=0):
+            self.assertIsNone(llm_utils.prompt_slot("next_token", inputs, "ollama"))
+
+    def test_system_prompt_is_a_stable_prefix(self):
+        prompt = llm_utils.build_prompt("next_token")
+        first, second = (prompt.format_messages(sentence=s) for s in ("a cup of", "i would like a cup of"))
+        self.assertEqual(first[0].content, second[0].content)
+
+    def test_slot_is_sent_with_the_backend_fields(self):
+        llm = llm_utils.build_llm("ollama")
+        self.assertTrue(llm.extra_body["cache_prompt"])
+        client = llm_utils.build_direct_client("next_token", llm, slot=3)
+        body = json.loads(client.payload({"sentence": "a cup of"}))
+        self.assertEqual((body["id_slot"], body["cache_prompt"]), (3, True))
+
+
+def logprob(token, p):
+    return {"token": token, "logprob": math.log(p)}
+
+
+class FakeLogprobLLM:
+    """
+    Answers the single-token call with TOP_LOGPROBS and each prefilled
+    continuation with CONTINUATIONS[fragment].
+    """
+    TOP_LOGPROBS = [
+        logprob(" coffee", 0.3), logprob("Coffee", 0.1), logprob(" the", 0.2),
+        logprob("cappu", 0.25), logprob("tea", 0.1), logprob(",", 0.05),
+    ]
+    CONTINUATIONS = {"cappu": "ccino please"}
+
+    extra_body = {"max_tokens": 160, "response_format": {"type": "json_object"}}
+
+    def __init__(self, bound=None):
+        self.bound = bound or {}
+
+    def bind(self, **kwargs):
+        return FakeLogprobLLM(kwargs)
+
+    def invoke(self, messages):
+        assert self.bound["logprobs"] and self.bound["extra_body"] == {"max_tokens": 1}
+        return SimpleNamespace(response_metadata={"logprobs": {"content": [{"top_logprobs": self.TOP_LOGPROBS}]}})
+
+    def batch(self, inputs, return_exceptions=False):
+        return [SimpleNamespace(content=self.CONTINUATIONS[messages[-1][1]]) for messages in inputs]
+
+
+class LogprobTests(SimpleTestCase):
+    def test_word_probabilities(self):
+        words, fragments = word_probabilities(FakeLogprobLLM.TOP_LOGPROBS)
+        self.assertEqual(set(words), {"coffee", "the", "tea"})
+        self.assertAlmostEqual(words["coffee"], 0.4)
+        self.assertEqual(set(fragments), {"cappu"})
+
+    def test_rank_words(self):
+        words = {"coffee": 0.4, "the": 0.2, "tea": 0.1}
+        self.assertEqual(rank_words(words, {"cappu": 0.25}, {"cappu": "cappuccino"}), ["coffee", "cappuccino", "tea"])
+
+    def test_predict_next_words(self):
+        self.assertEqual(predict_next_words(FakeLogprobLLM(), "a cup of"), ["coffee", "cappuccino", "tea"])
+
+
+class FakeLlama:
+    """
+    Stands in for llama_cpp.Llama: one token per word piece, with logits
+    that depend only on the last token evaluated.
+    """
+    VOCAB = ["<s>", "</s>", " a", " cup", " of", " coffee", " capp", "uccino", " tea", " the", ","]
+    NEXT = {
+        " of": {" coffee": 3.0, " capp": 2.5, " the": 2.5, " tea": 2.0, ",": 1.0},
+        " capp": {"uccino": 5.0},
+        "uccino": {",": 5.0},
+    }
+
+    def __init__(self, **kwargs):
+        self.ctx = self
+        self.input_ids = []
+        self.n_tokens = 0
+        self.evaluated = []
+
+    def tokenize(self, text, add_bos=True):
+        return [0] + [self.VOCAB.index(f" {word}") for word in text.decode().split()]
+
+    def detokenize(self, tokens):
+        return "".join(self.VOCAB[t] for t in tokens).encode()
+
+    def token_eos(self):
+        return 1
+
+    def n_vocab(self):
+        return len(self.VOCAB)
+
+    def eval(self, tokens):
+        self.evaluated.append(list(tokens))
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def logits(self):
+        following = self.NEXT.get(self.VOCAB[self.input_ids[-1]], {})
+        return (ctypes.c_float * len(self.VOCAB))(*(following.get(piece, 0.0) for piece in self.VOCAB))
+
+
+@skipUnless(numpy, "needs numpy")
+class LocalModelTests(SimpleTestCase):
+    def setUp(self):
+        fake = SimpleNamespace(Llama=FakeLlama, llama_get_logits_ith=lambda ctx, i: ctx.logits())
+        with mock.patch.dict(sys.modules, {"llama_cpp": fake}):
+            self.model = LocalModel("model.gguf", top_k=5, expansions=1)
+
+    def test_predict_ranks_next_words(self):
+        # 'capp' is finished greedily; 'the' is a stopword
+        self.assertEqual(self.model.predict("a cup of"), ["coffee", "cappuccino", "tea"])
+
+    def test_word_completion(self):
+        self.assertEqual(self.model.predict("a cup of", prefix="t"), ["tea"])
+
+    def test_next_turn_only_evaluates_new_words(self):
+        self.model.predict("a cup of")
+        self.model.llm.evaluated = []
+        self.model.predict("a cup of tea")
+        self.assertEqual(self.model.llm.evaluated[0], [FakeLlama.VOCAB.index(" tea")])
+
+
+ROUTES = {
+    "next_token": {"backends": ["ollama"], "models": {"ollama": "llama3.2:1b"}, "max_tokens": 64, "deadline_ms": 150, "slo_ms": 300},
+    "word_completion": {"temperature": 0.0},
+}
+
+
+@override_settings(LLM_ROUTES=ROUTES, LLM_BACKEND_ORDER=["mistral", "ollama"], MISTRAL_API_KEY="key", PREDICTION_DEADLINE_MS=400)
+class RoutingTests(SimpleTestCase):
+    def test_llm_overrides(self):
+        self.assertEqual(routing.llm_overrides("next_token", "ollama"), {"model": "llama3.2:1b", "max_tokens": 64})
+        self.assertEqual(routing.llm_overrides("next_token", "mistral"), {"max_tokens": 64})
+        self.assertEqual(routing.llm_overrides("word_completion", "ollama"), {"temperature": 0.0})
+        self.assertEqual(routing.llm_overrides("other", "ollama"), {})
+
+    def test_route_backends_and_deadline(self):
+        self.assertEqual(llm_utils.backend_order("next_token"), ["ollama"])
+        self.assertEqual(llm_utils.backend_order("word_completion"), ["mistral", "ollama"])
+        self.assertEqual((routing.deadline_ms("next_token"), routing.deadline_ms("word_completion")), (150, 400))
+
+    def test_route_llm(self):
+        llm = llm_utils.build_llm("ollama", overrides=routing.llm_overrides("next_token", "ollama"))
+        self.assertEqual((llm.model_name, llm.extra_body["max_tokens"]), ("llama3.2:1b", 64))
+
+    def test_observed_against_the_slo(self):
+        @routing.observed("next_token")
+        def predict(delay):
+            time.sleep(delay)
+
+        @routing.observed("next_token", stream=True)
+        def stream():
+            yield "coffee"
+            time.sleep(1)
+
+        before = [metrics.get(f"route.next_token.{c}") for c in ("requests", "within_slo")]
+        predict(0)
+        predict(0.35)
+        self.assertEqual(
+            [metrics.get(f"route.next_token.{c}") - b for c, b in zip(("requests", "within_slo"), before)], [2, 1],
+        )
+        before = metrics.get("route.next_token_stream.within_slo")
+        self.assertEqual(next(stream()), "coffee")  # timed to the first suggestion
+        self.assertEqual(metrics.get("route.next_token_stream.within_slo") - before, 1)
+
+    def test_in_flight_gauge(self):
+        seen = []
+
+        @routing.observed("word_completion")
+        async def predict():
+            seen.append(metrics.snapshot()["route"]["word_completion.in_flight"])
+            await asyncio.sleep(0.01)
+
+        async def main():
+            await asyncio.gather(predict(), predict(), predict())
+
+        asyncio.run(main())
+        self.assertEqual(seen, [1, 2, 3])
+        self.assertEqual(metrics.snapshot()["route"]["word_completion.in_flight"], 0)
+
+
+class DirectChatClientTests(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+
+        def handler(request):
+            self.requests.append(request)
+            body = json.loads(request.content)
+            if body["stream"]:
+                events = [{"choices": [{"delta": {"content": piece}}]} for piece in ('{"tokens": ["cof', 'fee"]}')]
+                lines = [f"data: {json.dumps(event)}" for event in events] + ["data: [DONE]"]
+                return httpx.Response(200, text="\n\n".join(lines))
+            return httpx.Response(200, json={"choices": [{"message": {"content": '{"tokens": ["coffee"]}'}}]})
+
+        transport = httpx.MockTransport(handler)
+        self.client = DirectChatClient(
+            "http://ollama/v1/chat/completions", "key", {"model": "llama3.2", "temperature": 0.3},
+            "Suggest words.", "Context: '{sentence}'.{seed_hint}", timeout=5,
+            http_client=httpx.Client(transport=transport), http_async_client=httpx.AsyncClient(transport=transport),
+            defaults={"seed_hint": ""},
+        )
+
+    def test_payload(self):
+        self.assertEqual(json.loads(self.client.payload({"sentence": 'say "hi"'})), {
+            "model": "llama3.2", "temperature": 0.3, "stream": False,
+            "messages": [{"role": "system", "content": "Suggest words."}, {"role": "user", "content": "Context: 'say \"hi\"'."}],
+        })
+
+    def test_invoke(self):
+        self.assertEqual(self.client.invoke({"sentence": "a cup of"}), '{"tokens": ["coffee"]}')
+        self.assertEqual(self.requests[0].headers["authorization"], "Bearer key")
+
+    def test_stream(self):
+        self.assertEqual("".join(self.client.stream({"sentence": "a cup of"})), '{"tokens": ["coffee"]}')
+
+    def test_astream(self):
+        async def collect():
+            return [text async for text in self.client.astream({"sentence": "a cup of"})]
+
+        self.assertEqual(asyncio.run(collect()), ['{"tokens": ["cof', 'fee"]}'])
+
+    def test_http_errors_raise(self):
+        self.client.http_client = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(503)))
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.client.invoke({"sentence": "a cup of"})
+
+    def test_same_prompt_as_langchain(self):
+        llm = llm_utils.build_llm("ollama")
+        client = llm_utils.build_direct_client("next_token", llm)
+        messages = json.loads(client.payload({"sentence": "a cup of"}))["messages"]
+        expected = llm_utils.build_prompt("next_token").format_messages(sentence="a cup of")
+        self.assertEqual([m["content"] for m in messages], [m.content for m in expected])
+
+
+WEBM_HEAD = b"\x1aE\xdf\xa3" + bytes(60)
+
+
+class ContainerSuffixTests(SimpleTestCase):
+    def test_sniffed_from_magic_bytes(self):
+        for head, suffix in (
+            (WEBM_HEAD, ".webm"), (b"OggS\x00", ".ogg"), (b"RIFF\x24\x00\x00\x00WAVEfmt ", ".wav"),
+            (b"\x00\x00\x00\x1cftypM4A ", ".m4a"), (b"ID3\x04", ".mp3"),
+        ):
+            self.assertEqual(container_suffix(io.BytesIO(head)), suffix)
+
+    def test_unknown_container(self):
+        file = io.BytesIO(b"not audio")
+        file.read()
+        self.assertEqual(container_suffix(file), ".webm")
+        self.assertEqual(file.tell(), 0)
+
+    def test_audio_file_named_for_its_container(self):
+        upload = SimpleUploadedFile("recording.webm", b"OggS\x00")
+        name, file = audio_file(upload)
+        self.assertEqual((name, file), ("recording.ogg", upload.file))
+
+
+@override_settings(FILE_UPLOAD_HANDLERS=["core.uploads.SpooledUploadHandler"], AUDIO_SPOOL_MAX_BYTES=1024)
+class SpooledUploadTests(SimpleTestCase):
+    def upload(self, content):
+        request = RequestFactory().post("/transcribe_audio/", {"audio": SimpleUploadedFile("a.webm", content)})
+        return request.FILES["audio"]
+
+    def test_small_clips_stay_in_memory(self):
+        upload = self.upload(WEBM_HEAD)
+        self.assertIsInstance(upload, SpooledUploadedFile)
+        self.assertFalse(upload.spilled)
+        self.assertEqual((upload.size, upload.read()), (64, WEBM_HEAD))
+
+    def test_large_clips_spill_to_disk(self):
+        upload = self.upload(bytes(4096))
+        self.assertTrue(upload.spilled)
+        self.assertEqual(upload.size, 4096)
+
+    def test_view_sends_the_spooled_file(self):
+        request = RequestFactory().post("/transcribe_audio/", {"audio": SimpleUploadedFile("clip", WEBM_HEAD)})
+        with mock.patch.object(transcription, "transcribe", return_value={"text": "hello", "confidence": 0.9}) as transcribe:
+            response = views.transcribe_audio(request)
+        self.assertEqual(json.loads(response.content), {"text": "hello", "confidence": 0.9})
+        name, file = transcribe.call_args.args[0]
+        self.assertEqual((name, file.read()), ("clip.webm", WEBM_HEAD))
+
+
+class FakeEngine(TranscriptionEngine):
+    # A registered name, so its latency is recorded like the real engine's
+    name = "openai"
+
+    def __init__(self, text="hello"):
+        self.text = text
+        self.clips = []
+
+    def transcribe(self, clip):
+        self.clips.append(clip)
+        return {"text": self.text, "confidence": 0.9}
+
+
+@override_settings(VAD_ENABLED=False, AUDIO_TRANSCODE=False, TRANSCRIPTION_CACHE_ENABLED=False)
+class TranscriptionEngineTests(SimpleTestCase):
+    def test_engines_must_transcribe(self):
+        class Incomplete(TranscriptionEngine):
+            name = "incomplete"
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_unknown_engine(self):
+        with self.assertRaisesRegex(ValueError, "Unknown transcription engine"):
+            transcription.get_engine("nope")
+
+    def test_result_confidence_and_hallucinations(self):
+        segments = [SimpleNamespace(avg_logprob=math.log(0.8)), SimpleNamespace(avg_logprob=math.log(0.6))]
+        result = transcription_result(SimpleNamespace(text="Coffee", segments=segments))
+        self.assertEqual(result["text"], "Coffee")
+        self.assertAlmostEqual(result["confidence"], 0.7)
+        self.assertEqual(transcription_result(SimpleNamespace(text="Thanks for watching!", segments=[])), {"text": "", "confidence": 0.0})
+
+    def test_transcribe_with_an_engine(self):
+        engine = FakeEngine()
+        clip = ("clip.webm", io.BytesIO(WEBM_HEAD))
+        self.assertEqual(transcription.transcribe(clip, engine), {"text": "hello", "confidence": 0.9})
+        self.assertEqual(asyncio.run(transcription.atranscribe(clip, engine)), {"text": "hello", "confidence": 0.9})
+        self.assertEqual(engine.clips, [clip, clip])
+
+    def test_local_whisper_engine(self):
+        model = mock.Mock()
+        model.transcribe.return_value = (iter([SimpleNamespace(text=" Tea please.", avg_logprob=math.log(0.9))]), None)
+        with mock.patch("faster_whisper.WhisperModel", return_value=model) as whisper_model:
+            engine = LocalWhisperEngine("/models/whisper-base", beam_size=2)
+        self.assertEqual(whisper_model.call_args.kwargs["local_files_only"], True)
+        result = engine.transcribe_pcm([0.0] * 160)
+        self.assertEqual(result["text"], "Tea please.")
+        self.assertAlmostEqual(result["confidence"], 0.9)
+        self.assertEqual(model.transcribe.call_args.kwargs["beam_size"], 2)
+        self.assertEqual(engine.cache_id, "local:/models/whisper-base:2")
+
+
+def tone_clip(silence_ms=500, speech_ms=600, rate=16000):
+    """
+    Quiet noise around a 220 Hz tone standing in for speech.
+    """
+    noise = numpy.random.default_rng(0).normal(0, 0.001, rate * (2 * silence_ms + speech_ms) // 1000)
+    start = rate * silence_ms // 1000
+    t = numpy.arange(rate * speech_ms // 1000) / rate
+    noise[start:start + len(t)] += 0.3 * numpy.sin(2 * numpy.pi * 220 * t)
+    return noise.astype(numpy.float32)
+
+
+@skipUnless(numpy, "needs numpy")
+@override_settings(VAD_ENABLED=True, AUDIO_TRANSCODE=False, TRANSCRIPTION_CACHE_ENABLED=False)
+class VADTests(SimpleTestCase):
+    def test_detect_speech(self):
+        start, end = vad.detect_speech(tone_clip(), padding_ms=150)
+        # The tone runs from 8000 to 17600; frames are 480 samples
+        self.assertLessEqual(abs(start - (8000 - 2400)), 480)
+        self.assertLessEqual(abs(end - (17600 + 2400)), 480)
+
+    def test_speech_throughout_is_kept_whole(self):
+        clip = tone_clip(silence_ms=0, speech_ms=1000)
+        self.assertEqual(vad.detect_speech(clip), (0, len(clip)))
+
+    def test_trim_silence(self):
+        speech, trimmed_ms = vad.trim_silence(tone_clip())
+        self.assertAlmostEqual(audio.duration_ms(speech) + trimmed_ms, 1600)
+        self.assertGreater(trimmed_ms, 500)
+        speech, trimmed_ms = vad.trim_silence(tone_clip(speech_ms=0))
+        self.assertEqual((len(speech), trimmed_ms), (0, 1000))
+
+    def test_engine_gets_the_trimmed_speech(self):
+        engine = FakeEngine()
+        clip = ("clip.wav", io.BytesIO(audio.to_wav(tone_clip())))
+        self.assertEqual(transcription.transcribe(clip, engine)["text"], "hello")
+        name, file = engine.clips[0]
+        self.assertEqual(name, "audio.wav")
+        self.assertLess(len(file.getvalue()), len(clip[1].getvalue()) * 0.75)
+
+    def test_silent_clip_skips_the_engine(self):
+        engine = FakeEngine()
+        clip = ("clip.wav", io.BytesIO(audio.to_wav(tone_clip(speech_ms=0))))
+        self.assertEqual(transcription.transcribe(clip, engine), {"text": "", "confidence": 0.0})
+        self.assertEqual(engine.clips, [])
+
+
+def stereo_wav(samples, rate=48000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as clip:
+        clip.setnchannels(2)
+        clip.setsampwidth(2)
+        clip.setframerate(rate)
+        clip.writeframes((numpy.repeat(samples, 2) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+class PCMEngine(FakeEngine):
+    accepts_pcm = True
+
+    def transcribe_pcm(self, samples):
+        self.clips.append(samples)
+        return {"text": self.text, "confidence": 0.9}
+
+
+@skipUnless(numpy and av, "needs numpy and PyAV")
+@override_settings(VAD_ENABLED=False, AUDIO_TRANSCODE=True, TRANSCRIPTION_CACHE_ENABLED=False)
+class AudioStageTests(SimpleTestCase):
+    def setUp(self):
+        # One second of the test tone, as a browser might upload it
+        self.clip = ("clip.wav", io.BytesIO(stereo_wav(tone_clip(silence_ms=0, speech_ms=1000, rate=48000))))
+
+    def test_decode_downmixes_and_resamples(self):
+        samples = audio.decode(self.clip[1])
+        self.assertEqual((samples.dtype, self.clip[1].tell()), (numpy.float32, 0))
+        self.assertLessEqual(abs(len(samples) - 16000), 160)
+
+    def test_api_engines_get_compact_opus(self):
+        name, file = transcription.prepare(FakeEngine(), self.clip)
+        self.assertEqual(name, "audio.ogg")
+        self.assertLess(len(file.getvalue()), len(self.clip[1].getvalue()) / 10)
+        self.assertLessEqual(abs(len(audio.decode(file)) - 16000), 800)
+
+    def test_pcm_engines_get_decoded_audio(self):
+        engine = PCMEngine()
+        self.assertEqual(transcription.transcribe(self.clip, engine)["text"], "hello")
+        self.assertEqual(len(engine.clips), 1)
+        self.assertLessEqual(abs(len(engine.clips[0]) - 16000), 160)
+
+    def test_undecodable_clip_is_sent_as_is(self):
+        clip = ("clip.webm", io.BytesIO(WEBM_HEAD))
+        with self.assertLogs("core.transcription", "WARNING"):
+            self.assertIs(transcription.prepare(FakeEngine(), clip), clip)
+
+
+@override_settings(
+    TRANSCRIPTION_CACHE_ENABLED=True, TRANSCRIPTION_CACHE_SQLITE_PATH="", VAD_ENABLED=False, AUDIO_TRANSCODE=False,
+)
+class TranscriptionCacheTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(transcription_cache, "_cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def clip(self, data=WEBM_HEAD, name="clip.webm"):
+        return name, io.BytesIO(data)
+
+    def test_key_follows_the_audio_not_the_name(self):
+        engine = FakeEngine()
+        key = transcription_cache.make_key(engine, self.clip())
+        self.assertEqual(transcription_cache.make_key(engine, self.clip(name="retry.webm")), key)
+        self.assertNotEqual(transcription_cache.make_key(engine, self.clip(WEBM_HEAD + b"\x00")), key)
+
+    def test_key_changes_with_the_engine_and_audio_stage(self):
+        engine = FakeEngine()
+        key = transcription_cache.make_key(engine, self.clip())
+        with override_settings(VAD_ENABLED=True):
+            vad_key = transcription_cache.make_key(engine, self.clip())
+            with override_settings(VAD_MARGIN_DB=6.0):
+                self.assertNotEqual(transcription_cache.make_key(engine, self.clip()), vad_key)
+        with override_settings(AUDIO_TRANSCODE=True):
+            self.assertNotEqual(transcription_cache.make_key(engine, self.clip()), key)
+        self.assertNotEqual(vad_key, key)
+        with mock.patch.object(FakeEngine, "cache_id", "openai:whisper-2"):
+            self.assertNotEqual(transcription_cache.make_key(engine, self.clip()), key)
+
+    def test_repeated_clips_are_served_from_the_cache(self):
+        engine = FakeEngine()
+        first = transcription.transcribe(self.clip(), engine)
+        first["text"] = "changed by the caller"
+        self.assertEqual(transcription.transcribe(self.clip(name="retry.webm"), engine)["text"], "hello")
+        self.assertEqual(asyncio.run(transcription.atranscribe(self.clip(), engine))["text"], "hello")
+        self.assertEqual(len(engine.clips), 1)
+
+    def test_errors_are_not_cached(self):
+        engine = FakeEngine()
+        with mock.patch.object(engine, "transcribe", side_effect=ConnectionError("refused")):
+            with self.assertRaises(ConnectionError):
+                transcription.transcribe(self.clip(), engine)
+        self.assertEqual(transcription.transcribe(self.clip(), engine)["text"], "hello")
+
+    def test_disabled(self):
+        engine = FakeEngine()
+        with override_settings(TRANSCRIPTION_CACHE_ENABLED=False):
+            transcription.transcribe(self.clip(), engine)
+            transcription.transcribe(self.clip(), engine)
+        self.assertEqual(len(engine.clips), 2)
+
+
+@override_settings(LLM_ROUTES={}, LLM_BACKEND_ORDER=["ollama"])
+class ClientRegistryTests(SimpleTestCase):
+    def test_clients_and_chains_are_built_once(self):
+        llm = llm_utils.get_llm("ollama")
+        self.assertIs(llm_utils.get_llm("ollama"), llm)
+        self.assertIs(llm.http_client, llm_utils.get_http_client())
+        self.assertIs(llm_utils.get_chain("next_token", "ollama"), llm_utils.get_chain("next_token"))
+
+    def test_rebuilt_after_a_fork(self):
+        llm = llm_utils.get_llm("ollama")
+        chain = llm_utils.get_chain("next_token", "ollama")
+        with mock.patch.object(llm_utils, "_registry_pid", None):
+            self.assertIsNot(llm_utils.get_chain("next_token", "ollama"), chain)
+            self.assertIsNot(llm_utils.get_llm("ollama"), llm)
+            self.assertIsNot(llm_utils.get_llm("ollama").http_client, llm.http_client)
+
+    def test_warm_chains(self):
+        with mock.patch.object(llm_utils, "get_chain") as get_chain:
+            llm_utils.warm_chains()
+        self.assertEqual(get_chain.call_args_list, [mock.call(kind, "ollama") for kind in llm_utils.PROMPTS])
+
+
+@override_settings(PREDICTION_CACHE_ENABLED=True, LLM_ROUTES={"next_token": {"deadline_ms": 100}}, PHONETIC_LLM_RERANK=False)
+class WarmPredictionCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, "server.log")
+        with open(self.log, "w") as f:
+            f.write("INFO Predicting next token for sentence: 'Um, a cup of'\n")
+            f.write("INFO Predicting next token for sentence: 'I went to the'\n")
+            f.write("INFO Predicting word completion for partial: 'cof' in sentence: 'a cup of'\n")
+        self.cache = PredictionCache(16, 60, sqlite_path=os.path.join(directory.name, "cache.db"))
+        patcher = mock.patch.object(prediction_cache, "_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def warm(self, generate):
+        out = io.StringIO()
+        with mock.patch.object(llm_utils, "generate_tokens", side_effect=generate), \
+                mock.patch.object(llm_utils, "sound_alike_words", return_value=["coffee"]):
+            call_command("warm_prediction_cache", self.log, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_only_llm_answers_count_as_warmed(self):
+        def generate(kind, inputs):
+            # Slower than the route's deadline, which warming does not apply
+            time.sleep(0.2)
+            return ["tea"] if "cup" in inputs["sentence"] else []
+
+        self.assertIn("Warmed 1, already cached 0, not cached 2", self.warm(generate))
+        self.assertEqual(self.cache.get(prediction_cache.make_key("next_token", build_context("Um, a cup of"))), ["tea"])
+        # The skip check finds entries under the context the chains key them by
+        self.assertIn("Warmed 0, already cached 1, not cached 2", self.warm(lambda kind, inputs: []))
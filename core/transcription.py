@@ -0,0 +1,383 @@
+import asyncio
+import io
+import logging
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from django.conf import settings
+
+from . import metrics, transcription_cache
+
+logger = logging.getLogger(__name__)
+
+# Filter out common Whisper hallucinations
+HALLUCINATIONS = {
+    "thank you for watching",
+    "thanks for watching",
+    "subscribe",
+    "amara.org",
+    "mbc",
+    "you", # Often hallucinated in silence
+    ".",
+    "bye",
+    "subtitles by",
+    "copyright",
+    "all rights reserved"
+}
+
+
+def transcription_result(transcription):
+    """
+    Turns a verbose_json Whisper response into the {'text', 'confidence'} payload.
+    """
+    text = transcription.text
+
+    # Calculate confidence from segments estimate
+    # segments is a list, we might have multiple if long speech,
+    # but usually one for short commands.
+    # We'll take the average of segment confidence or just the first.
+    confidence = 0.0
+    if hasattr(transcription, 'segments') and transcription.segments:
+        try:
+            # Try attribute access first (Pydantic model)
+            probs = [math.exp(s.avg_logprob) for s in transcription.segments]
+            confidence = sum(probs) / len(probs)
+        except AttributeError:
+            # Fallback to dictionary access
+            try:
+                 probs = [math.exp(s['avg_logprob']) for s in transcription.segments]
+                 confidence = sum(probs) / len(probs)
+            except:
+                confidence = 0.0
+
+    # If no segments or confidence failed, default to 1.0 to assume it's a good word
+    # unless the text is empty or very short?
+    # No, if we fail to calc confidence, better to assume it's OK than to block it
+    # because the user says "words aren't being displayed".
+    # The previous code defaulted to 0.0 which triggered the "partial" logic.
+    clean_text = text.strip().lower()
+    # Remove punctuation for check
+    clean_text_check = clean_text.replace(".", "").replace("!", "").replace("?", "")
+
+    # Check for exact matches or "thank you for watching" containment
+    if clean_text_check in HALLUCINATIONS or "thank you for watching" in clean_text or "thanks for watching" in clean_text:
+        text = ""
+        confidence = 0.0
+
+    if confidence == 0.0 and text:
+        confidence = 1.0
+
+    return {'text': text, 'confidence': confidence}
+
+
+class TranscriptionEngine(ABC):
+    """
+    Speech-to-text for one clip. transcribe() takes a (name, file) pair (see
+    uploads.audio_file()) and returns the {'text', 'confidence'} payload.
+    """
+
+    name = ""
+    # Whether transcribe_pcm() takes decoded audio without re-encoding it
+    accepts_pcm = False
+
+    @property
+    def cache_id(self):
+        """
+        Identifies the model and options in transcription cache keys.
+        """
+        return self.name
+
+    @abstractmethod
+    def transcribe(self, clip):
+        pass
+
+    async def atranscribe(self, clip):
+        return await asyncio.to_thread(self.transcribe, clip)
+
+    def transcribe_pcm(self, samples):
+        """
+        Transcribes 16 kHz mono float32 PCM (see audio.decode()).
+        """
+        from .audio import to_wav
+        return self.transcribe(("audio.wav", io.BytesIO(to_wav(samples))))
+
+    async def atranscribe_pcm(self, samples):
+        from .audio import to_wav
+        return await self.atranscribe(("audio.wav", io.BytesIO(to_wav(samples))))
+
+
+class OpenAIEngine(TranscriptionEngine):
+    """
+    The OpenAI transcription API (whisper-1).
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key, model="whisper-1"):
+        import openai
+        self.client = openai.OpenAI(api_key=api_key)
+        # Used by the async views (see settings.ASYNC_VIEWS)
+        self.async_client = openai.AsyncOpenAI(api_key=api_key)
+        self.model = model
+
+    @property
+    def cache_id(self):
+        return f"{self.name}:{self.model}"
+
+    def transcribe(self, clip):
+        transcription = self.client.audio.transcriptions.create(
+            model=self.model,
+            file=clip,
+            language="en",
+            response_format="verbose_json"
+        )
+        return transcription_result(transcription)
+
+    async def atranscribe(self, clip):
+        transcription = await self.async_client.audio.transcriptions.create(
+            model=self.model,
+            file=clip,
+            language="en",
+            response_format="verbose_json"
+        )
+        return transcription_result(transcription)
+
+
+class LocalWhisperEngine(TranscriptionEngine):
+    """
+    Whisper run in the worker on CPU through faster-whisper (CTranslate2,
+    int8 by default), from a converted model directory on disk, so words
+    are transcribed without a network round trip or upload. One clip is
+    decoded at a time per model.
+    """
+
+    name = "local"
+    accepts_pcm = True
+
+    def __init__(self, path, beam_size=1, threads=0, compute_type="int8"):
+        # Optional dependency, only needed for this engine
+        from faster_whisper import WhisperModel
+        self.model = WhisperModel(
+            path,
+            device="cpu",
+            compute_type=compute_type,
+            cpu_threads=threads,
+            local_files_only=True,
+        )
+        self.path = path
+        self.beam_size = beam_size
+        self._lock = threading.Lock()
+
+    @property
+    def cache_id(self):
+        return f"{self.name}:{self.path}:{self.beam_size}"
+
+    def transcribe(self, clip):
+        return self._transcribe(clip[1])
+
+    def transcribe_pcm(self, samples):
+        return self._transcribe(samples)
+
+    def _transcribe(self, source):
+        with self._lock:
+            segments, _ = self.model.transcribe(
+                source,
+                language="en",
+                beam_size=self.beam_size,
+                condition_on_previous_text=False,
+            )
+            # Segments are decoded lazily, while they are iterated
+            segments = list(segments)
+        metrics.incr("transcription.local_segments", len(segments))
+        text = "".join(s.text for s in segments).strip()
+        return transcription_result(SimpleNamespace(text=text, segments=segments))
+
+
+ENGINES = {
+    "openai": lambda: OpenAIEngine(settings.OPENAI_API_KEY),
+    "local": lambda: LocalWhisperEngine(
+        settings.WHISPER_MODEL_PATH,
+        beam_size=settings.WHISPER_BEAM_SIZE,
+        threads=settings.WHISPER_THREADS,
+        compute_type=settings.WHISPER_COMPUTE_TYPE,
+    ),
+}
+
+_engines = {}
+_engines_pid = None
+_engines_lock = threading.Lock()
+
+
+def get_engine(name=None):
+    """
+    Returns the transcription engine (settings.TRANSCRIPTION_ENGINE by
+    default), built once per process; a local model is loaded on first use.
+    """
+    global _engines_pid
+    name = name or settings.TRANSCRIPTION_ENGINE
+    if name not in ENGINES:
+        raise ValueError(f"Unknown transcription engine: {name}")
+    with _engines_lock:
+        if _engines_pid != os.getpid():
+            _engines.clear()
+            _engines_pid = os.getpid()
+        engine = _engines.get(name)
+        if engine is None:
+            start = time.perf_counter()
+            engine = ENGINES[name]()
+            _engines[name] = engine
+            if name == "local":
+                logger.info(
+                    f"Loaded Whisper model {settings.WHISPER_MODEL_PATH} "
+                    f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+                )
+        return engine
+
+
+def is_loaded(name=None):
+    return _engines_pid == os.getpid() and (name or settings.TRANSCRIPTION_ENGINE) in _engines
+
+
+def _observe(engine, start, payload):
+    ms = (time.perf_counter() - start) * 1000
+    metrics.incr(f"transcription.{engine.name}")
+    _latency[engine.name].add(ms)
+    _latency[payload].add(ms)
+
+
+def _size(file):
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    return size
+
+
+def audio_stage_enabled():
+    return settings.VAD_ENABLED or settings.AUDIO_TRANSCODE
+
+
+def prepare(engine, clip):
+    """
+    The audio stage before an engine call, with settings.VAD_ENABLED or
+    settings.AUDIO_TRANSCODE on: the clip is decoded once to 16 kHz mono,
+    trimmed of silence, and then handed to engines that take PCM as it is,
+    or re-encoded as compact Ogg/Opus for the API when that is smaller or
+    cut enough silence. Returns the PCM, the (name, file) clip to send, or
+    None when the clip holds no speech.
+    """
+    if not audio_stage_enabled():
+        return clip
+    # numpy and PyAV are only needed for this stage
+    from . import audio, vad
+    size = _size(clip[1])
+    metrics.incr("audio.upload_bytes", size)
+    try:
+        samples = audio.decode(clip[1])
+    except Exception as e:
+        metrics.incr("audio.decode_failed")
+        logger.warning(f"Could not decode clip {clip[0]}: {e}")
+        metrics.incr("audio.sent_bytes", size)
+        return clip
+    trimmed_ms = 0.0
+    if settings.VAD_ENABLED:
+        samples, trimmed_ms = vad.trim_silence(samples)
+        if not len(samples):
+            return None
+    if engine.accepts_pcm:
+        metrics.incr("vad.saved_ms", round(trimmed_ms))
+        return samples
+    # Re-encoding only pays off when it shrinks the upload or cut enough silence
+    trimmed = trimmed_ms >= settings.VAD_MIN_TRIM_MS
+    data = audio.encode(samples, bitrate=settings.AUDIO_TRANSCODE_BITRATE) if settings.AUDIO_TRANSCODE else None
+    if data is not None and (trimmed or len(data) < size):
+        name = "audio.ogg"
+    elif trimmed:
+        data, name = audio.to_wav(samples), "audio.wav"
+    else:
+        metrics.incr("audio.sent_bytes", size)
+        return clip
+    metrics.incr("vad.saved_ms", round(trimmed_ms))
+    metrics.incr("audio.transcoded")
+    metrics.incr("audio.sent_bytes", len(data))
+    return name, io.BytesIO(data)
+
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    """
+    Worker pool for the audio stage, bounding how many clips are decoded and
+    encoded at once (settings.AUDIO_WORKERS) whatever the request concurrency.
+    """
+    global _pool, _pool_pid
+    with _engines_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=settings.AUDIO_WORKERS, thread_name_prefix="audio")
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _payload(clip, prepared):
+    if not isinstance(prepared, tuple):
+        return "pcm"
+    return "original" if prepared is clip else "transcoded"
+
+
+NO_SPEECH = {'text': '', 'confidence': 0.0}
+
+
+def transcribe(clip, engine=None):
+    """
+    Transcribes a (name, file) clip with the configured engine, through the
+    audio stage (see prepare()). Clips without speech are answered without
+    calling the engine, and clips already seen from the transcription cache.
+    """
+    engine = engine or get_engine()
+    return transcription_cache.cached_transcription(engine, clip, lambda: _transcribe(clip, engine))
+
+
+def _transcribe(clip, engine):
+    start = time.perf_counter()
+    prepared = get_pool().submit(prepare, engine, clip).result() if audio_stage_enabled() else clip
+    if prepared is None:
+        return dict(NO_SPEECH)
+    if isinstance(prepared, tuple):
+        result = engine.transcribe(prepared)
+    else:
+        result = engine.transcribe_pcm(prepared)
+    _observe(engine, start, _payload(clip, prepared))
+    return result
+
+
+async def atranscribe(clip, engine=None):
+    engine = engine or (get_engine() if is_loaded() else await asyncio.to_thread(get_engine))
+    return await transcription_cache.acached_transcription(engine, clip, lambda: _atranscribe(clip, engine))
+
+
+async def _atranscribe(clip, engine):
+    start = time.perf_counter()
+    prepared = await asyncio.wrap_future(get_pool().submit(prepare, engine, clip)) if audio_stage_enabled() else clip
+    if prepared is None:
+        return dict(NO_SPEECH)
+    if isinstance(prepared, tuple):
+        result = await engine.atranscribe(prepared)
+    else:
+        result = await engine.atranscribe_pcm(prepared)
+    _observe(engine, start, _payload(clip, prepared))
+    return result
+
+
+# End-to-end latency per engine and per payload sent (the upload as it
+# arrived, the transcoded clip, or decoded PCM)
+_latency = {name: metrics.LatencyWindow() for name in (*ENGINES, "original", "transcoded", "pcm")}
+for _name, _window in _latency.items():
+    metrics.register_gauge(f"transcription.{_name}_p50_ms", lambda w=_window: w.percentile(50))
+    metrics.register_gauge(f"transcription.{_name}_p95_ms", lambda w=_window: w.percentile(95))
+metrics.register_gauge("audio.sent_ratio", lambda: metrics.ratio("audio.sent_bytes", "audio.upload_bytes"))
@@ -0,0 +1,116 @@
+import hashlib
+import threading
+
+from django.conf import settings
+
+from . import metrics
+from .prediction_cache import PredictionCache
+
+_CHUNK = 1 << 20
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def audio_digest(file):
+    """
+    BLAKE2b digest of the clip's bytes, leaving the file at its start.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    file.seek(0)
+    for chunk in iter(lambda: file.read(_CHUNK), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def stage_id():
+    """
+    The audio stage settings that change what the engine hears (see
+    transcription.prepare()), so results cached under other settings, in
+    the persistent tier too, are not served after a change.
+    """
+    parts = []
+    if settings.VAD_ENABLED:
+        parts.append(
+            f"vad:{settings.VAD_MARGIN_DB}:{settings.VAD_MIN_DB}:{settings.VAD_MIN_SPEECH_MS}"
+            f":{settings.VAD_PADDING_MS}:{settings.VAD_MIN_TRIM_MS}"
+        )
+    if settings.AUDIO_TRANSCODE:
+        parts.append(f"opus:{settings.AUDIO_TRANSCODE_BITRATE}")
+    return ",".join(parts) or "raw"
+
+
+def make_key(engine, clip):
+    """
+    Key for a (name, file) clip: the engine's identity (see
+    TranscriptionEngine.cache_id), the audio stage settings and a hash of
+    the uploaded bytes, so retried and re-sent clips match whatever they
+    are called.
+    """
+    return f"{engine.cache_id}\x1f{stage_id()}\x1f{audio_digest(clip[1])}"
+
+
+def get_cache():
+    """
+    Returns the worker-wide transcription cache, or None if it is disabled.
+    """
+    global _cache
+    if not settings.TRANSCRIPTION_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PredictionCache(
+                    max_size=settings.TRANSCRIPTION_CACHE_SIZE,
+                    ttl=settings.TRANSCRIPTION_CACHE_TTL,
+                    sqlite_path=settings.TRANSCRIPTION_CACHE_SQLITE_PATH,
+                    sqlite_ttl=settings.TRANSCRIPTION_CACHE_SQLITE_TTL,
+                    table="transcriptions",
+                    prefix="transcription_cache",
+                )
+    return _cache
+
+
+def cached_transcription(engine, clip, compute):
+    """
+    Returns the cached {'text', 'confidence'} result for this clip, or calls
+    compute() and caches its result. Engine errors propagate uncached.
+    """
+    cache = get_cache()
+    if cache is None:
+        return compute()
+    key = make_key(engine, clip)
+    result = cache.get(key)
+    if result is not None:
+        return dict(result)
+    result = compute()
+    cache.set(key, dict(result))
+    return result
+
+
+async def acached_transcription(engine, clip, compute):
+    """
+    Async version of cached_transcription(); compute is a coroutine function.
+    Hashing stays inline: clips are small and BLAKE2b runs at about 1 GB/s.
+    """
+    cache = get_cache()
+    if cache is None:
+        return await compute()
+    key = make_key(engine, clip)
+    result = cache.get(key)
+    if result is not None:
+        return dict(result)
+    result = await compute()
+    cache.set(key, dict(result))
+    return result
+
+
+def _hit_rate():
+    hits = metrics.get("transcription_cache.hit_memory") + metrics.get("transcription_cache.hit_sqlite")
+    total = hits + metrics.get("transcription_cache.miss")
+    return round(hits / total, 4) if total else 0.0
+
+
+metrics.register_gauge("transcription_cache.hit_rate", _hit_rate)
+metrics.register_gauge("transcription_cache.size", lambda: len(_cache.memory) if _cache else 0)
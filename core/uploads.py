@@ -0,0 +1,97 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from . import metrics
+
+# Whisper picks the decoder from the file name, so the container is
+# sniffed from the first bytes; WebM is what MediaRecorder usually sends.
+UPLOAD_SUFFIX = ".webm"
+CONTAINER_SIGNATURES = (
+    (0, b"\x1aE\xdf\xa3", ".webm"),  # EBML: WebM / Matroska
+    (0, b"OggS", ".ogg"),
+    (8, b"WAVE", ".wav"),
+    (4, b"ftyp", ".m4a"),  # MP4 audio (Safari)
+    (0, b"fLaC", ".flac"),
+    (0, b"ID3", ".mp3"),
+    (0, b"\xff\xfb", ".mp3"),
+    (0, b"\xff\xf3", ".mp3"),
+)
+
+
+def container_suffix(file):
+    """
+    File suffix for the clip's container, from its magic bytes; UPLOAD_SUFFIX
+    when it is not recognised. Leaves the file at its start.
+    """
+    file.seek(0)
+    head = file.read(16)
+    file.seek(0)
+    for offset, magic, suffix in CONTAINER_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return suffix
+    metrics.incr("uploads.unknown_container")
+    return UPLOAD_SUFFIX
+
+
+class SpooledUploadedFile(UploadedFile):
+    """
+    An upload held in a SpooledTemporaryFile: in memory, or on disk once it
+    outgrew settings.AUDIO_SPOOL_MAX_BYTES.
+    """
+
+    def __init__(self, file, field_name, name, content_type, size, charset, content_type_extra=None):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.field_name = field_name
+
+    @property
+    def spilled(self):
+        return bool(getattr(self.file, "_rolled", False))
+
+    def open(self, mode=None):
+        self.file.seek(0)
+        return self
+
+
+class SpooledUploadHandler(FileUploadHandler):
+    """
+    Streams each uploaded file into a SpooledTemporaryFile, so clips stay in
+    memory and only spill to disk above settings.AUDIO_SPOOL_MAX_BYTES,
+    whatever the request's Content-Length says. Installed through
+    settings.FILE_UPLOAD_HANDLERS when settings.AUDIO_UPLOAD_SPOOL is on.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.AUDIO_SPOOL_MAX_BYTES, suffix=UPLOAD_SUFFIX)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        upload = SpooledUploadedFile(
+            file=self.file,
+            field_name=self.field_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+        metrics.incr("uploads.spilled" if upload.spilled else "uploads.in_memory")
+        metrics.incr("uploads.bytes", file_size)
+        return upload
+
+
+def audio_file(upload):
+    """
+    The upload as a (name, file) pair the OpenAI client sends as it is,
+    without copying it to a temp file first, named for its actual container.
+    """
+    name = os.path.splitext(os.path.basename(upload.name or "audio"))[0]
+    return name + container_suffix(upload.file), upload.file
@@ -1,9 +1,24 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+if settings.ASYNC_VIEWS:
+    transcribe_audio = views.atranscribe_audio
+    predict_next_token = views.apredict_next_token
+    predict_word_completion = views.apredict_word_completion
+    predict_next_token_stream = views.apredict_next_token_stream
+else:
+    transcribe_audio = views.transcribe_audio
+    predict_next_token = views.predict_next_token
+    predict_word_completion = views.predict_word_completion
+    predict_next_token_stream = views.predict_next_token_stream
+
 urlpatterns = [
     path('', views.index, name='index'),
-    path('transcribe_audio/', views.transcribe_audio, name='transcribe_audio'),
-    path('predict_next_token/', views.predict_next_token, name='predict_next_token'),
-    path('predict_word_completion/', views.predict_word_completion, name='predict_word_completion'),
+    path('transcribe_audio/', transcribe_audio, name='transcribe_audio'),
+    path('predict_next_token/', predict_next_token, name='predict_next_token'),
+    path('predict_next_token/stream/', predict_next_token_stream, name='predict_next_token_stream'),
+    path('predict_word_completion/', predict_word_completion, name='predict_word_completion'),
+    path('metrics/', views.metrics_snapshot, name='metrics'),
+    path('ready/', views.readiness, name='ready'),
 ]
@@ -0,0 +1,73 @@
+import numpy as np
+from django.conf import settings
+
+from . import audio, metrics
+
+FRAME_MS = 30
+
+
+def frame_features(samples, rate=audio.SAMPLE_RATE):
+    """
+    Per-frame energy (dBFS) and zero-crossing rate over FRAME_MS frames.
+    """
+    size = rate * FRAME_MS // 1000
+    count = len(samples) // size
+    frames = samples[:count * size].reshape(count, size)
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / size
+    return energy, zcr
+
+
+def detect_speech(samples, rate=audio.SAMPLE_RATE, margin_db=12.0, min_db=-50.0, min_speech_ms=120, padding_ms=150):
+    """
+    Returns the (start, end) sample range holding speech, padded by
+    padding_ms, or None when there is less than min_speech_ms of it.
+
+    A frame is speech when it is margin_db above the clip's noise floor
+    (its quietest tenth), or near the clip's peak, and louder than min_db.
+    Quieter frames with a high zero-crossing rate count too, so soft
+    fricatives ('s', 'f') at the ends of words are kept.
+    """
+    energy, zcr = frame_features(samples, rate)
+    if not len(energy):
+        return None
+    # Capped below the peak so a clip that is speech throughout is kept whole
+    threshold = max(min(np.percentile(energy, 10) + margin_db, energy.max() - 3), min_db)
+    speech = (energy > threshold) | ((energy > threshold - margin_db / 2) & (zcr > 0.3))
+    if np.count_nonzero(speech) * FRAME_MS < min_speech_ms:
+        return None
+    frames = np.flatnonzero(speech)
+    size = rate * FRAME_MS // 1000
+    padding = rate * padding_ms // 1000
+    return int(max(0, frames[0] * size - padding)), int(min(len(samples), (frames[-1] + 1) * size + padding))
+
+
+def trim_silence(samples):
+    """
+    Returns (speech, trimmed_ms): 16 kHz PCM without its leading and
+    trailing silence, and how much audio was cut. speech is empty when the
+    clip holds no speech at all.
+    """
+    total_ms = audio.duration_ms(samples)
+    metrics.incr("vad.clips")
+    metrics.incr("vad.audio_ms", round(total_ms))
+    span = detect_speech(
+        samples,
+        margin_db=settings.VAD_MARGIN_DB,
+        min_db=settings.VAD_MIN_DB,
+        min_speech_ms=settings.VAD_MIN_SPEECH_MS,
+        padding_ms=settings.VAD_PADDING_MS,
+    )
+    if span is None:
+        metrics.incr("vad.no_speech")
+        metrics.incr("vad.saved_ms", round(total_ms))
+        return samples[:0], total_ms
+    speech = samples[span[0]:span[1]]
+    trimmed_ms = total_ms - audio.duration_ms(speech)
+    metrics.incr("vad.trimmed_ms", round(trimmed_ms))
+    return speech, trimmed_ms
+
+
+metrics.register_gauge("vad.seconds_saved", lambda: round(metrics.get("vad.saved_ms") / 1000, 1))
+metrics.register_gauge("vad.no_speech_rate", lambda: metrics.ratio("vad.no_speech", "vad.clips"))
@@ -1,23 +1,24 @@
+import asyncio
 import json
 import logging
-import math
-import os
-import tempfile
 
-from django.conf import settings
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
-import openai
 
-from .llm_utils import predict_next_token_chain, predict_word_completion_chain
+from . import metrics, transcription, uploads, warmup
+from .llm_utils import (
+    apredict_next_token_chain,
+    apredict_word_completion_chain,
+    astream_next_token_chain,
+    predict_next_token_chain,
+    predict_word_completion_chain,
+    stream_next_token_chain,
+)
+from .ngram import learn_conversation, suggest_next_words
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client (make sure API key is set)
-# If settings.OPENAI_API_KEY is None, the client might fail on init or call.
-client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-
 def index(request):
     return render(request, 'index.html')
 
@@ -26,86 +27,14 @@ def transcribe_audio(request):
     if request.method == 'POST':
         if 'audio' not in request.FILES:
             return JsonResponse({'error': 'No audio file provided'}, status=400)
-        
-        audio_file = request.FILES['audio']
-        
-        # Save temp file
-        # We need a file extension for Whisper to recognize format, usually .webm from browser
-        suffix = '.webm'
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_audio:
-            for chunk in audio_file.chunks():
-                temp_audio.write(chunk)
-            temp_audio_path = temp_audio.name
 
         try:
-            with open(temp_audio_path, 'rb') as audio:
-                transcription = client.audio.transcriptions.create(
-                    model="whisper-1", 
-                    file=audio,
-                    language="en",
-                    response_format="verbose_json"
-                )
-            
-            text = transcription.text
-            
-            # Calculate confidence from segments estimate
-            # segments is a list, we might have multiple if long speech, 
-            # but usually one for short commands.
-            # We'll take the average of segment confidence or just the first.
-            confidence = 0.0
-            if hasattr(transcription, 'segments') and transcription.segments:
-                try:
-                    # Try attribute access first (Pydantic model)
-                    probs = [math.exp(s.avg_logprob) for s in transcription.segments]
-                    confidence = sum(probs) / len(probs)
-                except AttributeError:
-                    # Fallback to dictionary access
-                    try:
-                         probs = [math.exp(s['avg_logprob']) for s in transcription.segments]
-                         confidence = sum(probs) / len(probs)
-                    except:
-                        confidence = 0.0
-            
-            # If no segments or confidence failed, default to 1.0 to assume it's a good word
-            # unless the text is empty or very short? 
-            # No, if we fail to calc confidence, better to assume it's OK than to block it 
-            # because the user says "words aren't being displayed".
-            # The previous code defaulted to 0.0 which triggered the "partial" logic.
-            # Filter out common Whisper hallucinations
-            HALLUCINATIONS = {
-                "thank you for watching",
-                "thanks for watching",
-                "subscribe",
-                "amara.org",
-                "mbc",
-                "you", # Often hallucinated in silence
-                ".",
-                "bye",
-                "subtitles by",
-                "copyright",
-                "all rights reserved"
-            }
-            
-            clean_text = text.strip().lower()
-            # Remove punctuation for check
-            clean_text_check = clean_text.replace(".", "").replace("!", "").replace("?", "")
-            
-            # Check for exact matches or "thank you for watching" containment
-            if clean_text_check in HALLUCINATIONS or "thank you for watching" in clean_text or "thanks for watching" in clean_text:
-                text = ""
-                confidence = 0.0
-
-            if confidence == 0.0 and text:
-                confidence = 1.0
-
-            return JsonResponse({'text': text, 'confidence': confidence})
+            # Sent straight from the upload buffer (see uploads.py)
+            result = transcription.transcribe(uploads.audio_file(request.FILES['audio']))
+            return JsonResponse(result)
         except Exception as e:
             # print(f"Error: {e}") 
             return JsonResponse({'error': str(e)}, status=500)
-        finally:
-            # Clean up
-            if os.path.exists(temp_audio_path):
-                os.remove(temp_audio_path)
 
     return JsonResponse({'error': 'Invalid method'}, status=405)
 
@@ -115,10 +44,12 @@ def predict_next_token(request):
         try:
             data = json.loads(request.body)
             sentence = data.get('sentence', '')
+            session = data.get('session', '')
             
             logger.info(f"Predicting next token for sentence: '{sentence}'")
-            tokens = predict_next_token_chain(sentence)
-            return JsonResponse({'tokens': tokens})
+            learn_conversation(sentence, session)
+            tokens = predict_next_token_chain(sentence, session)
+            return JsonResponse({'tokens': tokens, 'pending': getattr(tokens, 'pending', False)})
         
         except Exception as e:
             logger.error(f"Error in predict_next_token: {e}", exc_info=True)
@@ -135,17 +66,158 @@ def predict_word_completion(request):
         try:
             data = json.loads(request.body)
             sentence = data.get('sentence', '')
+            session = data.get('session', '')
             partial = data.get('partial', '')
             
             if not partial:
                  return JsonResponse({'tokens': []})
 
             logger.info(f"Predicting word completion for partial: '{partial}' in sentence: '{sentence}'")
-            tokens = predict_word_completion_chain(sentence, partial)
-            return JsonResponse({'tokens': tokens})
+            tokens = predict_word_completion_chain(sentence, partial, session)
+            return JsonResponse({'tokens': tokens, 'pending': getattr(tokens, 'pending', False)})
 
         except Exception as e:
             logger.error(f"Error in predict_word_completion: {e}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
             
     return JsonResponse({'error': 'Invalid method'}, status=405)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx buffering the stream
+    return response
+
+@csrf_exempt
+def predict_next_token_stream(request):
+    """
+    Streaming variant of predict_next_token: sends the local n-gram answer
+    as an instant 'seed' event, then each LLM suggestion as a 'token' event
+    as soon as it is parsed, then a 'done' event with the full list.
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        sentence = data.get('sentence', '')
+        session = data.get('session', '')
+        logger.info(f"Predicting next token for sentence: '{sentence}'")
+        learn_conversation(sentence, session)
+
+        def events():
+            seeds = suggest_next_words(sentence)
+            if seeds:
+                yield sse_event('seed', {'tokens': seeds})
+            tokens = []
+            for token in stream_next_token_chain(sentence, session):
+                tokens.append(token)
+                yield sse_event('token', {'token': token, 'index': len(tokens) - 1})
+            yield sse_event('done', {'tokens': tokens})
+
+        return sse_response(events())
+
+    return JsonResponse({'error': 'Invalid method'}, status=405)
+
+# Async versions of the views above, routed instead of them under ASGI so a
+# worker is not tied up for the whole Whisper/LLM round trip.
+
+@csrf_exempt
+async def atranscribe_audio(request):
+    if request.method == 'POST':
+        if 'audio' not in request.FILES:
+            return JsonResponse({'error': 'No audio file provided'}, status=400)
+
+        try:
+            result = await transcription.atranscribe(uploads.audio_file(request.FILES['audio']))
+            return JsonResponse(result)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid method'}, status=405)
+
+@csrf_exempt
+async def apredict_next_token(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            sentence = data.get('sentence', '')
+            session = data.get('session', '')
+
+            logger.info(f"Predicting next token for sentence: '{sentence}'")
+            # Learning may append to the history file or train the model
+            await asyncio.to_thread(learn_conversation, sentence, session)
+            tokens = await apredict_next_token_chain(sentence, session)
+            return JsonResponse({'tokens': tokens, 'pending': getattr(tokens, 'pending', False)})
+
+        except Exception as e:
+            logger.error(f"Error in predict_next_token: {e}", exc_info=True)
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid method'}, status=405)
+
+@csrf_exempt
+async def apredict_word_completion(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            sentence = data.get('sentence', '')
+            session = data.get('session', '')
+            partial = data.get('partial', '')
+
+            if not partial:
+                 return JsonResponse({'tokens': []})
+
+            logger.info(f"Predicting word completion for partial: '{partial}' in sentence: '{sentence}'")
+            tokens = await apredict_word_completion_chain(sentence, partial, session)
+            return JsonResponse({'tokens': tokens, 'pending': getattr(tokens, 'pending', False)})
+
+        except Exception as e:
+            logger.error(f"Error in predict_word_completion: {e}", exc_info=True)
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid method'}, status=405)
+
+@csrf_exempt
+async def apredict_next_token_stream(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        sentence = data.get('sentence', '')
+        session = data.get('session', '')
+        logger.info(f"Predicting next token for sentence: '{sentence}'")
+        await asyncio.to_thread(learn_conversation, sentence, session)
+
+        async def events():
+            seeds = suggest_next_words(sentence)
+            if seeds:
+                yield sse_event('seed', {'tokens': seeds})
+            tokens = []
+            async for token in astream_next_token_chain(sentence, session):
+                tokens.append(token)
+                yield sse_event('token', {'token': token, 'index': len(tokens) - 1})
+            yield sse_event('done', {'tokens': tokens})
+
+        return sse_response(events())
+
+    return JsonResponse({'error': 'Invalid method'}, status=405)
+
+def metrics_snapshot(request):
+    """
+    Returns this worker's prediction pipeline counters as JSON.
+    """
+    return JsonResponse(metrics.snapshot())
+
+
+def readiness(request):
+    """
+    Readiness probe: 200 once the local model is loaded and primed, 503
+    while it is still warming up.
+    """
+    status = warmup.readiness()
+    return JsonResponse(status, status=200 if status['ready'] else 503)
@@ -0,0 +1,357 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import httpx
+from django.conf import settings
+
+from . import local_model, metrics, transcription
+
+logger = logging.getLogger(__name__)
+
+COLD = "cold"
+WARMING = "warming"
+HOT = "hot"
+UNAVAILABLE = "unavailable"
+
+# Steps of the warm-up loop
+WARM = "warm"
+REFRESH = "refresh"
+
+WARMUP_INPUTS = {
+    "next_token": {"sentence": "this morning i would like a cup of"},
+    "word_completion": {"sentence": "this morning i would like a cup of", "partial": "cof"},
+}
+
+
+def _parse_expiry(value):
+    # Ollama reports e.g. "2026-10-15T01:30:00.123456789+01:00"; trim to microseconds
+    if not value:
+        return None
+    head, sep, rest = value.partition(".")
+    if sep:
+        digits = len(rest) - len(rest.lstrip("0123456789"))
+        rest = rest[:min(digits, 6)] + rest[digits:]
+        value = f"{head}.{rest}"
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+class OllamaWarmer:
+    """
+    Keeps the local models loaded and their prompt prefixes hot. warm()
+    preloads each model (the default plus any settings.LLM_ROUTES picks)
+    through Ollama's native API, runs each prompt once through the real
+    chains so the static system prompt is already evaluated, then sets
+    settings.OLLAMA_KEEP_ALIVE again. A background loop checks /api/ps every
+    `interval` seconds, warms again if a model was evicted and refreshes the
+    keep-alive when it is about to run out.
+
+    Predictions go through the OpenAI-compatible endpoint, which cannot pass
+    keep_alive, so each one resets a model's expiry to the server default
+    (OLLAMA_KEEP_ALIVE in the Ollama server's environment, 5 minutes unless
+    set); the loop's refresh puts it back.
+    """
+
+    def __init__(self, api_base, models, keep_alive, interval=60, timeout=120):
+        self.native_base = api_base.rstrip("/").removesuffix("/v1")
+        self.models = list(models)
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self.timeout = timeout
+        self.state = COLD
+        self.last_error = ""
+        self.warmed_at = None
+        # Guards state changes only; never held across a network call
+        self._lock = threading.Lock()
+        # Held for a whole warm-up, so two never overlap
+        self._warming = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    @staticmethod
+    def _matches(model, name):
+        if ":" in model:
+            return name == model
+        return name.split(":", 1)[0] == model
+
+    def seconds_left(self):
+        """
+        Seconds until Ollama unloads the first of the models, or None if one
+        is not loaded.
+        """
+        response = httpx.get(f"{self.native_base}/api/ps", timeout=5)
+        response.raise_for_status()
+        loaded = response.json().get("models", [])
+        left = float("inf")
+        for model in self.models:
+            entry = next(
+                (e for e in loaded if self._matches(model, e.get("name", "")) or self._matches(model, e.get("model", ""))),
+                None,
+            )
+            if entry is None:
+                return None
+            expires = _parse_expiry(entry.get("expires_at"))
+            if expires is not None:
+                left = min(left, (expires - datetime.now(timezone.utc)).total_seconds())
+        return left
+
+    def preload(self):
+        """
+        Loads the models (an empty prompt generates nothing) and sets how
+        long Ollama keeps them resident. Returns the total load time in ms,
+        0 for models already loaded.
+        """
+        load_ms = 0.0
+        for model in self.models:
+            response = httpx.post(
+                f"{self.native_base}/api/generate",
+                json={"model": model, "prompt": "", "keep_alive": self.keep_alive},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            load_ms += response.json().get("load_duration", 0) / 1e6
+        return load_ms
+
+    def prime(self):
+        from .llm_utils import get_chain
+
+        for kind, inputs in WARMUP_INPUTS.items():
+            get_chain(kind, "ollama", parsed=False).invoke(inputs)
+
+    def warm(self):
+        """
+        Preloads and primes the models. Returns False if it failed or another
+        warm-up is already running; readers of `state` never wait on it.
+        """
+        if not self._warming.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                # A hot model being refreshed stays ready while it is re-primed
+                if self.state != HOT:
+                    self.state = WARMING
+            start = time.perf_counter()
+            try:
+                load_ms = self.preload()
+                self.prime()
+                # Priming went through the OpenAI endpoint, which reset keep_alive
+                self.preload()
+            except Exception as e:
+                with self._lock:
+                    self.state = UNAVAILABLE
+                    self.last_error = str(e)
+                metrics.incr("warmup.failures")
+                logger.warning(f"Ollama warm-up failed: {e}")
+                return False
+            with self._lock:
+                self.state = HOT
+                self.last_error = ""
+                self.warmed_at = time.time()
+            metrics.incr("warmup.runs")
+            metrics.incr("warmup.load_ms", round(load_ms))
+            logger.info(
+                f"Ollama models {', '.join(self.models)} warm in {(time.perf_counter() - start) * 1000:.0f} ms "
+                f"(load {load_ms:.0f} ms, keep_alive {self.keep_alive})"
+            )
+            return True
+        finally:
+            self._warming.release()
+
+    def refresh(self):
+        """
+        Sets the keep-alive again on the loaded models, without generating.
+        """
+        try:
+            self.preload()
+        except Exception as e:
+            logger.warning(f"Ollama keep-alive refresh failed: {e}")
+            return False
+        metrics.incr("warmup.refreshes")
+        return True
+
+    def next_step(self):
+        """
+        What the loop does next: WARM when a model is not hot or was evicted,
+        REFRESH when its keep-alive is about to run out, otherwise None.
+        """
+        if self.state != HOT:
+            return WARM
+        try:
+            left = self.seconds_left()
+        except Exception as e:
+            with self._lock:
+                self.state = UNAVAILABLE
+                self.last_error = str(e)
+            return WARM
+        if left is None:
+            metrics.incr("warmup.evicted")
+            with self._lock:
+                self.state = COLD
+            return WARM
+        # Still loaded: extend it before the keep-alive runs out in a quiet spell
+        return REFRESH if left < 2 * self.interval else None
+
+    def run(self):
+        while True:
+            step = self.next_step()
+            if step == WARM:
+                self.warm()
+            elif step == REFRESH:
+                self.refresh()
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        Starts the warm-up loop once per process (threads do not survive a fork).
+        """
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # A fork mid warm-up copies the locks held by the parent's loop
+            self._lock = threading.Lock()
+            self._warming = threading.Lock()
+            self.state = COLD
+        threading.Thread(target=self.run, name="ollama-warmup", daemon=True).start()
+
+
+_warmer = None
+_warmer_lock = threading.Lock()
+_local_pid = None
+_local_error = ""
+_speech_pid = None
+_speech_error = ""
+
+
+def warmup_required():
+    from .llm_utils import backends_in_use
+    return settings.OLLAMA_WARMUP and "ollama" in backends_in_use()
+
+
+def local_model_required():
+    from .llm_utils import LOCAL_BACKEND, backends_in_use
+    return LOCAL_BACKEND in backends_in_use()
+
+
+def speech_model_required():
+    return settings.TRANSCRIPTION_ENGINE == "local"
+
+
+def ollama_models():
+    """
+    The Ollama models in use: the default and any a route picks.
+    """
+    models = [settings.MISTRAL_MODEL_NAME]
+    for route in settings.LLM_ROUTES.values():
+        model = route.get("models", {}).get("ollama")
+        if model and model not in models:
+            models.append(model)
+    return models
+
+
+def _load_local_model():
+    global _local_error
+    try:
+        local_model.get_model()
+    except Exception as e:
+        _local_error = str(e)
+        logger.warning(f"Could not load local model: {e}")
+
+
+def _load_speech_model():
+    global _speech_error
+    try:
+        transcription.get_engine()
+    except Exception as e:
+        _speech_error = str(e)
+        logger.warning(f"Could not load Whisper model: {e}")
+
+
+def get_warmer():
+    global _warmer
+    with _warmer_lock:
+        if _warmer is None:
+            _warmer = OllamaWarmer(
+                settings.OLLAMA_API_BASE,
+                ollama_models(),
+                settings.OLLAMA_KEEP_ALIVE,
+                interval=settings.OLLAMA_WARMUP_INTERVAL,
+                timeout=settings.OLLAMA_WARMUP_TIMEOUT,
+            )
+        return _warmer
+
+
+_fork_hook = False
+
+
+def _after_fork():
+    global _warmer_lock
+    # The parent's threads may have held it at the fork
+    _warmer_lock = threading.Lock()
+    start_warmup()
+
+
+def start_warmup():
+    """
+    Called from the WSGI/ASGI entry points, so management commands do not
+    warm the model, and again in each worker a server forks from there
+    (e.g. gunicorn --preload), whose threads do not survive the fork.
+    """
+    global _local_pid, _speech_pid, _fork_hook
+    if not _fork_hook:
+        _fork_hook = True
+        os.register_at_fork(after_in_child=_after_fork)
+    if warmup_required():
+        get_warmer().start()
+    # Load the in-process models in the background, once per process
+    with _warmer_lock:
+        load_local = local_model_required() and _local_pid != os.getpid()
+        load_speech = speech_model_required() and _speech_pid != os.getpid()
+        if load_local:
+            _local_pid = os.getpid()
+        if load_speech:
+            _speech_pid = os.getpid()
+    if load_local:
+        threading.Thread(target=_load_local_model, name="local-model-load", daemon=True).start()
+    if load_speech:
+        threading.Thread(target=_load_speech_model, name="speech-model-load", daemon=True).start()
+
+
+def readiness():
+    """
+    Readiness state for /ready/: only ready once the Ollama model is hot
+    and the in-process models loaded (for the backends and speech engine in
+    use), or straight away when none is needed. Only reads state: the
+    loaders are started by start_warmup().
+    """
+    if not warmup_required() and not local_model_required() and not speech_model_required():
+        return {"ready": True, "state": "not_required"}
+    status = {"ready": True}
+    if warmup_required():
+        warmer = get_warmer()
+        status.update(ready=warmer.state == HOT, state=warmer.state, models=warmer.models)
+        if warmer.warmed_at:
+            status["warmed_seconds_ago"] = round(time.time() - warmer.warmed_at)
+        if warmer.last_error:
+            status["error"] = warmer.last_error
+    if local_model_required():
+        loaded = local_model.is_loaded()
+        status["ready"] = status["ready"] and loaded
+        status["local_model"] = "loaded" if loaded else ("failed" if _local_error else "loading")
+        if _local_error:
+            status["local_model_error"] = _local_error
+    if speech_model_required():
+        loaded = transcription.is_loaded()
+        status["ready"] = status["ready"] and loaded
+        status["speech_model"] = "loaded" if loaded else ("failed" if _speech_error else "loading")
+        if _speech_error:
+            status["speech_model_error"] = _speech_error
+    return status
+
+
+metrics.register_gauge("warmup.state", lambda: _warmer.state if _warmer else COLD)
@@ -12,5 +12,14 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'speech_helper.settings')
+# Serve the async transcription/prediction views when running under ASGI
+os.environ.setdefault('ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
+
+# Build the LLM clients and prompt chains, and load the local model, before
+# the first prediction; management commands import neither entry point
+from core.llm_utils import warm_chains  # noqa: E402
+from core.warmup import start_warmup  # noqa: E402
+warm_chains()
+start_warmup()
@@ -123,3 +123,251 @@ MISTRAL_API_KEY = os.getenv('MISTRAL_API_KEY')
 OLLAMA_API_BASE = os.getenv('OLLAMA_API_BASE', 'http://localhost:11434/v1')
 MISTRAL_MODEL_NAME = os.getenv('MISTRAL_MODEL_NAME', 'ministral-3b')
 USE_LOCAL_SLM_FOR_NEXT_WORD = os.getenv('USE_LOCAL_SLM_FOR_NEXT_WORD', 'True').lower() in ('true', '1', 't')
+
+# Shared HTTP connection pool for the LLM backends (one per worker process)
+LLM_HTTP_TIMEOUT = float(os.getenv('LLM_HTTP_TIMEOUT', '30'))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', '20'))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv('LLM_HTTP_MAX_KEEPALIVE', '10'))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', '120'))
+
+# Ask the backends for JSON output and repair bad output locally instead of
+# making a second OutputFixingParser call to the LLM
+LLM_STRUCTURED_OUTPUT = os.getenv('LLM_STRUCTURED_OUTPUT', 'True').lower() in ('true', '1', 't')
+
+# Prediction cache: in-process LRU plus an optional SQLite tier that survives
+# restarts (set PREDICTION_CACHE_SQLITE_PATH to enable it)
+PREDICTION_CACHE_ENABLED = os.getenv('PREDICTION_CACHE_ENABLED', 'True').lower() in ('true', '1', 't')
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '2048'))
+PREDICTION_CACHE_TTL = int(os.getenv('PREDICTION_CACHE_TTL', '3600'))
+PREDICTION_CACHE_SQLITE_PATH = os.getenv('PREDICTION_CACHE_SQLITE_PATH', '')
+PREDICTION_CACHE_SQLITE_TTL = int(os.getenv('PREDICTION_CACHE_SQLITE_TTL', str(7 * 24 * 3600)))
+
+# Share one upstream LLM call between concurrent requests for the same context
+LLM_COALESCE_REQUESTS = os.getenv('LLM_COALESCE_REQUESTS', 'True').lower() in ('true', '1', 't')
+
+# Route the async views (set automatically by asgi.py). Run with an ASGI server,
+# e.g. `uvicorn speech_helper.asgi:application`, to hold many predictions open
+# per process.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False').lower() in ('true', '1', 't')
+LLM_ASYNC_MAX_CONNECTIONS = int(os.getenv('LLM_ASYNC_MAX_CONNECTIONS', '500'))
+
+# Bound generation: stream the model output and stop as soon as 15 distinct
+# suggestions are parsed, and send per-backend stop sequences / token limits
+LLM_EARLY_STOP = os.getenv('LLM_EARLY_STOP', 'True').lower() in ('true', '1', 't')
+LLM_LIMIT_GENERATION = os.getenv('LLM_LIMIT_GENERATION', 'True').lower() in ('true', '1', 't')
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv('LLM_MAX_OUTPUT_TOKENS', '160'))
+
+# Bounded context sent to the LLM: the current sentence plus recent history up
+# to a token budget, and a keyword summary of older sentences (0 disables it)
+LLM_CONTEXT_SENTENCE_TOKENS = int(os.getenv('LLM_CONTEXT_SENTENCE_TOKENS', '64'))
+LLM_CONTEXT_HISTORY_TOKENS = int(os.getenv('LLM_CONTEXT_HISTORY_TOKENS', '96'))
+LLM_CONTEXT_SUMMARY_KEYWORDS = int(os.getenv('LLM_CONTEXT_SUMMARY_KEYWORDS', '8'))
+
+# Local n-gram next-word engine: trained from the bundled corpus plus a
+# conversation history file (completed sentences are appended to it, and it
+# is rotated to NGRAM_HISTORY_PATH.1 past NGRAM_HISTORY_MAX_BYTES), used as an
+# instant first answer, a seed list for the LLM and a fallback when it fails
+NGRAM_ENABLED = os.getenv('NGRAM_ENABLED', 'True').lower() in ('true', '1', 't')
+NGRAM_ORDER = int(os.getenv('NGRAM_ORDER', '3'))
+NGRAM_CORPUS_PATH = os.getenv('NGRAM_CORPUS_PATH', str(BASE_DIR / 'core' / 'data' / 'ngram_corpus.txt'))
+NGRAM_HISTORY_PATH = os.getenv('NGRAM_HISTORY_PATH', '')
+NGRAM_HISTORY_MAX_BYTES = int(os.getenv('NGRAM_HISTORY_MAX_BYTES', str(4 * 1024 * 1024)))
+NGRAM_SEED_PROMPT = os.getenv('NGRAM_SEED_PROMPT', 'True').lower() in ('true', '1', 't')
+NGRAM_SEED_COUNT = int(os.getenv('NGRAM_SEED_COUNT', '5'))
+
+# Phonetic (Metaphone + BK-tree) index for word completion. Sound-alike words
+# from the lexicon are found locally; with PHONETIC_LLM_RERANK they are
+# merged with the LLM's completions by context, otherwise they are returned
+# without an LLM call
+PHONETIC_ENABLED = os.getenv('PHONETIC_ENABLED', 'True').lower() in ('true', '1', 't')
+PHONETIC_LEXICON_PATH = os.getenv('PHONETIC_LEXICON_PATH', str(BASE_DIR / 'core' / 'data' / 'lexicon.txt'))
+PHONETIC_MAX_DISTANCE = int(os.getenv('PHONETIC_MAX_DISTANCE', '2'))
+PHONETIC_LLM_RERANK = os.getenv('PHONETIC_LLM_RERANK', 'True').lower() in ('true', '1', 't')
+
+# Latency budget (ms) for /predict_next_token/ and /predict_word_completion/.
+# The LLM runs alongside the local lexicon, n-gram and history sources; at the
+# deadline whatever has answered is merged and the response is marked pending
+# so the client can ask again for the refined list. 0 waits for the LLM.
+PREDICTION_DEADLINE_MS = int(os.getenv('PREDICTION_DEADLINE_MS', '400'))
+PREDICTION_DEADLINE_WORKERS = int(os.getenv('PREDICTION_DEADLINE_WORKERS', '16'))
+
+# Per-request LLM timeout (seconds); on timeout or error the n-gram answer is used
+LLM_PREDICTION_TIMEOUT = float(os.getenv('LLM_PREDICTION_TIMEOUT', '8'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '0'))
+
+# Ordered LLM backend chain; each backend sits behind a circuit breaker that
+# opens when LLM_BREAKER_FAILURE_RATE of the last LLM_BREAKER_WINDOW calls
+# failed or took longer than LLM_BREAKER_SLOW_MS, then lets one probe through
+# every LLM_BREAKER_COOLDOWN seconds. The local n-gram/lexicon engines answer
+# when every backend is down. With local Ollama first, falling back to the
+# remote, paid Mistral API sends the conversation off the machine, so it is
+# off unless LLM_REMOTE_FALLBACK=True (or LLM_BACKEND_ORDER lists mistral).
+LLM_REMOTE_FALLBACK = os.getenv('LLM_REMOTE_FALLBACK', 'False').lower() in ('true', '1', 't')
+LLM_BACKEND_ORDER = [
+    b.strip() for b in os.getenv(
+        'LLM_BACKEND_ORDER',
+        ('ollama,mistral' if LLM_REMOTE_FALLBACK else 'ollama') if USE_LOCAL_SLM_FOR_NEXT_WORD else 'mistral,ollama'
+    ).split(',') if b.strip()
+]
+LLM_BACKEND_TIMEOUTS = {
+    'ollama': float(os.getenv('OLLAMA_TIMEOUT', str(LLM_PREDICTION_TIMEOUT))),
+    'mistral': float(os.getenv('MISTRAL_TIMEOUT', str(LLM_PREDICTION_TIMEOUT))),
+}
+LLM_BREAKER_WINDOW = int(os.getenv('LLM_BREAKER_WINDOW', '20'))
+LLM_BREAKER_MIN_CALLS = int(os.getenv('LLM_BREAKER_MIN_CALLS', '5'))
+LLM_BREAKER_FAILURE_RATE = float(os.getenv('LLM_BREAKER_FAILURE_RATE', '0.5'))
+LLM_BREAKER_SLOW_MS = float(os.getenv('LLM_BREAKER_SLOW_MS', '3000'))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '15'))
+
+# Hedged requests: when a prediction has not answered by the observed
+# LLM_HEDGE_PERCENTILE latency, send the same prompt to LLM_HEDGE_BACKEND
+# (default: the second backend in LLM_BACKEND_ORDER; 'ollama_replica' uses
+# OLLAMA_REPLICA_API_BASE) and take the first answer. At most
+# LLM_HEDGE_MAX_RATE of requests are hedged over time, with bursts of up to
+# LLM_HEDGE_BURST hedges (also allowed straight after startup).
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'False').lower() in ('true', '1', 't')
+LLM_HEDGE_BACKEND = os.getenv('LLM_HEDGE_BACKEND', '')
+OLLAMA_REPLICA_API_BASE = os.getenv('OLLAMA_REPLICA_API_BASE', '')
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '90'))
+LLM_HEDGE_DEFAULT_DELAY_MS = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY_MS', '1000'))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv('LLM_HEDGE_MIN_DELAY_MS', '50'))
+LLM_HEDGE_MAX_RATE = float(os.getenv('LLM_HEDGE_MAX_RATE', '0.1'))
+LLM_HEDGE_BURST = float(os.getenv('LLM_HEDGE_BURST', '5'))
+LLM_HEDGE_WORKERS = int(os.getenv('LLM_HEDGE_WORKERS', '16'))
+
+# Micro-batching: prompts arriving within LLM_BATCH_WINDOW_MS of each other
+# (up to LLM_BATCH_MAX_SIZE) go to the model together, either packed into one
+# generation ('packed') or sent side by side for a server with parallel decode
+# slots ('parallel'). Takes precedence over hedging.
+LLM_BATCH_ENABLED = os.getenv('LLM_BATCH_ENABLED', 'False').lower() in ('true', '1', 't')
+LLM_BATCH_MODE = os.getenv('LLM_BATCH_MODE', 'packed')
+LLM_BATCH_WINDOW_MS = float(os.getenv('LLM_BATCH_WINDOW_MS', '5'))
+LLM_BATCH_MAX_SIZE = int(os.getenv('LLM_BATCH_MAX_SIZE', '8'))
+LLM_BATCH_CONCURRENCY = int(os.getenv('LLM_BATCH_CONCURRENCY', '4'))
+
+# Local model warm-up: when 'ollama' is in LLM_BACKEND_ORDER the server
+# preloads the model at startup with OLLAMA_KEEP_ALIVE, primes the system
+# prompts, and every OLLAMA_WARMUP_INTERVAL seconds re-warms it if Ollama
+# evicted it, or sets OLLAMA_KEEP_ALIVE again when it is about to expire.
+# Predictions use the OpenAI-compatible API, which resets the expiry to the
+# Ollama server's own default on each call; setting OLLAMA_KEEP_ALIVE in the
+# Ollama server's environment as well avoids those refreshes. /ready/
+# answers 503 until the model is hot.
+OLLAMA_WARMUP = os.getenv('OLLAMA_WARMUP', 'True').lower() in ('true', '1', 't')
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_WARMUP_INTERVAL = float(os.getenv('OLLAMA_WARMUP_INTERVAL', '60'))
+OLLAMA_WARMUP_TIMEOUT = float(os.getenv('OLLAMA_WARMUP_TIMEOUT', '120'))
+
+# Prompt (KV) cache reuse on the local backend. Requests ask llama.cpp-style
+# servers to keep the evaluated prompt (cache_prompt), and with
+# LLM_PROMPT_CACHE_SLOTS set (match the server's --parallel) each session's
+# next-word and completion prompts are pinned to their own slot (id_slot),
+# so a turn only evaluates the newly spoken words. Ollama ignores both
+# fields and matches cached prefixes across its OLLAMA_NUM_PARALLEL slots.
+LLM_PROMPT_CACHE = os.getenv('LLM_PROMPT_CACHE', 'True').lower() in ('true', '1', 't')
+LLM_PROMPT_CACHE_SLOTS = int(os.getenv('LLM_PROMPT_CACHE_SLOTS', '0'))
+
+# Next-word prediction mode. 'list' asks the model to write a JSON list of
+# words; 'logprobs' reads the next-token distribution from a one-token reply
+# (its top LLM_TOP_LOGPROBS alternatives), completes up to
+# LLM_LOGPROB_EXPANSIONS word fragments with a continuation of at most
+# LLM_LOGPROB_CONTINUATION_TOKENS tokens, and ranks the content words by
+# probability. Needs a local backend that returns logprobs; list mode is
+# used otherwise and whenever the logprob call fails.
+LLM_PREDICTION_MODE = os.getenv('LLM_PREDICTION_MODE', 'list')
+LLM_TOP_LOGPROBS = int(os.getenv('LLM_TOP_LOGPROBS', '20'))
+LLM_LOGPROB_EXPANSIONS = int(os.getenv('LLM_LOGPROB_EXPANSIONS', '3'))
+LLM_LOGPROB_CONTINUATION_TOKENS = int(os.getenv('LLM_LOGPROB_CONTINUATION_TOKENS', '4'))
+
+# In-process CPU backend: add 'local' to LLM_BACKEND_ORDER to run a small
+# quantised GGUF causal LM from LOCAL_MODEL_PATH inside each worker through
+# llama-cpp-python (pip install llama-cpp-python), with no network or Ollama
+# daemon. Loaded once per process with LOCAL_MODEL_THREADS intra-op threads
+# (0 = llama.cpp default); suggestions come from the top LOCAL_MODEL_TOP_K
+# next-token logits, fragments finished as in LLM_PREDICTION_MODE=logprobs.
+LOCAL_MODEL_PATH = os.getenv('LOCAL_MODEL_PATH', '')
+LOCAL_MODEL_THREADS = int(os.getenv('LOCAL_MODEL_THREADS', '0'))
+LOCAL_MODEL_CONTEXT = int(os.getenv('LOCAL_MODEL_CONTEXT', '512'))
+LOCAL_MODEL_TOP_K = int(os.getenv('LOCAL_MODEL_TOP_K', '100'))
+
+# Per-endpoint routing. Each prediction endpoint can use its own backends
+# (e.g. NEXT_TOKEN_BACKENDS=ollama,mistral), models per backend
+# (e.g. WORD_COMPLETION_MODELS=ollama=qwen2.5:0.5b), temperature, output
+# token budget and latency deadline; unset fields keep the global settings.
+# Each route also has a latency SLO (ms): /metrics/ shows per-route latency
+# histograms and the share of requests that met it.
+LLM_ROUTES = {
+    route: {
+        'backends': [b.strip() for b in os.getenv(f'{prefix}_BACKENDS', '').split(',') if b.strip()],
+        'models': dict(
+            pair.strip().split('=', 1) for pair in os.getenv(f'{prefix}_MODELS', '').split(',') if '=' in pair
+        ),
+        'temperature': float(os.getenv(f'{prefix}_TEMPERATURE')) if os.getenv(f'{prefix}_TEMPERATURE') else None,
+        'max_tokens': int(os.getenv(f'{prefix}_MAX_TOKENS')) if os.getenv(f'{prefix}_MAX_TOKENS') else None,
+        'deadline_ms': int(os.getenv(f'{prefix}_DEADLINE_MS')) if os.getenv(f'{prefix}_DEADLINE_MS') else None,
+        'slo_ms': float(os.getenv(f'{prefix}_SLO_MS', slo_ms)),
+    }
+    for route, prefix, slo_ms in (
+        ('next_token', 'NEXT_TOKEN', '800'),
+        ('word_completion', 'WORD_COMPLETION', '300'),
+    )
+}
+
+# LLM client for predictions: 'langchain' (prompt | ChatOpenAI | parser
+# chains) or 'direct', which POSTs the same request to the OpenAI-compatible
+# endpoint on the pooled HTTP client from a pre-serialised body and decodes
+# the reply with orjson when installed, skipping LangChain's per-call
+# overhead. Output is repaired locally, never re-asked of the LLM. Logprob
+# mode and packed batches still go through LangChain.
+LLM_CLIENT = os.getenv('LLM_CLIENT', 'langchain')
+
+# Audio uploads: stream each clip into a SpooledTemporaryFile that only
+# spills to disk above AUDIO_SPOOL_MAX_BYTES, and hand it to the
+# transcription client as it is (no temp file copy, reopen and unlink).
+AUDIO_UPLOAD_SPOOL = os.getenv('AUDIO_UPLOAD_SPOOL', 'True').lower() in ('true', '1', 't')
+AUDIO_SPOOL_MAX_BYTES = int(os.getenv('AUDIO_SPOOL_MAX_BYTES', str(4 * 1024 * 1024)))
+if AUDIO_UPLOAD_SPOOL:
+    FILE_UPLOAD_HANDLERS = ['core.uploads.SpooledUploadHandler']
+
+# Speech recognition engine: 'openai' (whisper-1 API) or 'local', which runs
+# Whisper on CPU in the worker through faster-whisper (CTranslate2). The local
+# engine loads the converted model directory at WHISPER_MODEL_PATH once per
+# process; beam size 1 (greedy) is fastest for one- to three-second clips,
+# and WHISPER_THREADS=0 lets CTranslate2 choose.
+TRANSCRIPTION_ENGINE = os.getenv('TRANSCRIPTION_ENGINE', 'openai')
+WHISPER_MODEL_PATH = os.getenv('WHISPER_MODEL_PATH', '')
+WHISPER_BEAM_SIZE = int(os.getenv('WHISPER_BEAM_SIZE', '1'))
+WHISPER_THREADS = int(os.getenv('WHISPER_THREADS', '0'))
+WHISPER_COMPUTE_TYPE = os.getenv('WHISPER_COMPUTE_TYPE', 'int8')
+
+# Voice activity detection before transcription (needs numpy and PyAV):
+# clips are decoded to 16 kHz mono, those with less than VAD_MIN_SPEECH_MS
+# of speech are answered as empty without calling the engine, and leading and
+# trailing silence is cut (keeping VAD_PADDING_MS either side). A trimmed clip
+# is re-sent as WAV to the API only when at least VAD_MIN_TRIM_MS was cut;
+# local engines always take the decoded audio.
+VAD_ENABLED = os.getenv('VAD_ENABLED', 'False').lower() in ('true', '1', 't')
+VAD_MARGIN_DB = float(os.getenv('VAD_MARGIN_DB', '12'))
+VAD_MIN_DB = float(os.getenv('VAD_MIN_DB', '-50'))
+VAD_MIN_SPEECH_MS = int(os.getenv('VAD_MIN_SPEECH_MS', '120'))
+VAD_PADDING_MS = int(os.getenv('VAD_PADDING_MS', '150'))
+VAD_MIN_TRIM_MS = int(os.getenv('VAD_MIN_TRIM_MS', '500'))
+
+# Audio transcoding before transcription (needs numpy and PyAV): clips are
+# decoded once, whatever their container, and downmixed to 16 kHz mono. Local
+# engines get that PCM directly. For the API it is re-encoded as Ogg/Opus at
+# AUDIO_TRANSCODE_BITRATE when that is smaller than the upload. Decoding and
+# encoding run on a pool of AUDIO_WORKERS threads.
+AUDIO_TRANSCODE = os.getenv('AUDIO_TRANSCODE', 'False').lower() in ('true', '1', 't')
+AUDIO_TRANSCODE_BITRATE = int(os.getenv('AUDIO_TRANSCODE_BITRATE', '24000'))
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS', '2'))
+
+# Transcription cache: results keyed by engine and a hash of the uploaded
+# bytes, so retried or re-sent clips skip the engine. Only the hash and the
+# text are kept, in memory unless TRANSCRIPTION_CACHE_SQLITE_PATH is set; set
+# TRANSCRIPTION_CACHE_ENABLED=False where transcripts must not be retained.
+TRANSCRIPTION_CACHE_ENABLED = os.getenv('TRANSCRIPTION_CACHE_ENABLED', 'True').lower() in ('true', '1', 't')
+TRANSCRIPTION_CACHE_SIZE = int(os.getenv('TRANSCRIPTION_CACHE_SIZE', '1024'))
+TRANSCRIPTION_CACHE_TTL = int(os.getenv('TRANSCRIPTION_CACHE_TTL', '3600'))
+TRANSCRIPTION_CACHE_SQLITE_PATH = os.getenv('TRANSCRIPTION_CACHE_SQLITE_PATH', '')
+TRANSCRIPTION_CACHE_SQLITE_TTL = int(os.getenv('TRANSCRIPTION_CACHE_SQLITE_TTL', str(24 * 3600)))
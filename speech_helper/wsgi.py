@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'speech_helper.settings')
 
 application = get_wsgi_application()
+
+# Build the LLM clients and prompt chains, and load the local model, before
+# the first prediction; management commands import neither entry point
+from core.llm_utils import warm_chains  # noqa: E402
+from core.warmup import start_warmup  # noqa: E402
+warm_chains()
+start_warmup()
@@ -15,5 +15,14 @@ window.APP_SETTINGS = {
     MIN_WORDS_FOR_PREDICTION: 1,
 
     // Confidence threshold (0.0 - 1.0). Transcriptions below this are treated as partial/unsure.
-    CONFIDENCE_THRESHOLD: 0.4
+    CONFIDENCE_THRESHOLD: 0.4,
+
+    // Stream next-word suggestions (server-sent events) so the first row shows as soon as it is generated
+    STREAM_PREDICTIONS: true,
+
+    // When the server answers before the LLM has finished, ask again after this many ms for the refined list
+    PREDICTION_REFINE_DELAY: 1000,
+
+    // How many times to ask for a refined list
+    PREDICTION_REFINE_ATTEMPTS: 2
 };
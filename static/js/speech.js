@@ -29,7 +29,10 @@ document.addEventListener('DOMContentLoaded', () => {
     // Prediction state
     let allPredictions = [];
     let currentPredictionIndex = 0;
+    let predictionRequestId = 0; // Incremented to abandon in-flight streamed predictions
     const PREDICTION_PAGE_SIZE = 5;
+    // Identifies this conversation so the server can keep its prompt cached between words
+    const SESSION_ID = Math.random().toString(36).slice(2) + Date.now().toString(36);
 
     // Configuration
     // Configuration load from global settings object (injected via settings.js)
@@ -38,6 +41,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const MIN_WORDS_FOR_PREDICTION = window.APP_SETTINGS?.MIN_WORDS_FOR_PREDICTION || 3;
     const CONFIDENCE_THRESHOLD = window.APP_SETTINGS?.CONFIDENCE_THRESHOLD || 0.5;
     const PREDICTION_PAUSE_DELAY = window.APP_SETTINGS?.PREDICTION_PAUSE_DELAY || 1500;
+    const STREAM_PREDICTIONS = window.APP_SETTINGS?.STREAM_PREDICTIONS ?? true;
+    const PREDICTION_REFINE_DELAY = window.APP_SETTINGS?.PREDICTION_REFINE_DELAY || 1000;
+    const PREDICTION_REFINE_ATTEMPTS = window.APP_SETTINGS?.PREDICTION_REFINE_ATTEMPTS ?? 2;
 
     // List of common words to accept even if confidence is low
     const COMMON_WORDS = new Set([
@@ -293,17 +299,27 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // Construct sentence
         const sentence = words.map(w => w.text).join(' ');
+        const requestId = ++predictionRequestId;
 
+        if (STREAM_PREDICTIONS) {
+            return streamPredictions(sentence, requestId);
+        }
+        return fetchPredictions(sentence, requestId, 0);
+    }
+
+    // The server answers at its latency deadline; if the LLM had not finished
+    // yet ('pending'), ask again shortly for the refined list.
+    async function fetchPredictions(sentence, requestId, attempt) {
         try {
             const response = await fetch('/predict_next_token/', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ sentence: sentence })
+                body: JSON.stringify({ sentence: sentence, session: SESSION_ID })
             });
             const data = await response.json();
 
-            // Only render if we haven't started speaking again
-            if (!isSpeaking) {
+            // Only render if we haven't started speaking again or moved on
+            if (!isSpeaking && requestId === predictionRequestId) {
                 if (data.tokens && data.tokens.length > 0) {
                     renderPredictions(data.tokens);
                     statusText.textContent = "Ready";
@@ -312,14 +328,77 @@ document.addEventListener('DOMContentLoaded', () => {
                     // predictionContainer.classList.add('hidden'); // Removed
                     statusText.textContent = "Ready";
                 }
+                if (data.pending && attempt < PREDICTION_REFINE_ATTEMPTS) {
+                    setTimeout(() => fetchPredictions(sentence, requestId, attempt + 1), PREDICTION_REFINE_DELAY);
+                }
+            }
+        } catch (err) {
+            console.error("Prediction error:", err);
+            statusText.textContent = "Error predicting.";
+        }
+    }
+
+    // Reads server-sent events from the streaming endpoint and shows each
+    // suggestion as soon as it arrives.
+    async function streamPredictions(sentence, requestId) {
+        try {
+            const response = await fetch('/predict_next_token/stream/', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ sentence: sentence, session: SESSION_ID })
+            });
+            if (!response.ok || !response.body) throw new Error(`HTTP ${response.status}`);
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let received = 0;
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+
+                // Stop if the patient started speaking or a newer prediction superseded this one
+                if (isSpeaking || requestId !== predictionRequestId) {
+                    reader.cancel();
+                    return;
+                }
+
+                buffer += decoder.decode(value, { stream: true });
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const message = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let eventType = 'message';
+                    let data = '';
+                    message.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) eventType = line.slice(6).trim();
+                        else if (line.startsWith('data:')) data += line.slice(5).trim();
+                    });
+
+                    // Instant local suggestions, replaced once the first LLM token arrives
+                    if (eventType === 'seed' && received === 0) {
+                        renderPredictions(JSON.parse(data).tokens);
+                    } else if (eventType === 'token') {
+                        if (received === 0) {
+                            predictionsList.innerHTML = '';
+                            if (morePredictionsBtn) morePredictionsBtn.classList.add('hidden');
+                        }
+                        appendPrediction(JSON.parse(data).token, received++);
+                    }
+                }
             }
+
+            if (received === 0) predictionsList.innerHTML = '';
+            statusText.textContent = "Ready";
         } catch (err) {
             console.error("Prediction error:", err);
             statusText.textContent = "Error predicting.";
         }
     }
 
-    async function getWordCompletions(partial) {
+    async function getWordCompletions(partial, attempt = 0, requestId = predictionRequestId) {
         // Construct sentence context
         const sentence = words.map(w => w.text).join(' ');
 
@@ -327,22 +406,28 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/predict_word_completion/', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ sentence: sentence, partial: partial })
+                body: JSON.stringify({ sentence: sentence, partial: partial, session: SESSION_ID })
             });
             const data = await response.json();
 
+            // A refinement is dropped once the patient has moved on
+            if (attempt > 0 && requestId !== predictionRequestId) return;
+
             if (data.tokens && data.tokens.length > 0) {
                 renderPredictions(data.tokens);
                 // predictionContainer.classList.remove('hidden'); // Always visible
                 document.querySelector('#prediction-container h3').textContent = `Suggestions for "${partial}":`;
-            } else {
+                if (data.pending && attempt < PREDICTION_REFINE_ATTEMPTS) {
+                    setTimeout(() => getWordCompletions(partial, attempt + 1, requestId), PREDICTION_REFINE_DELAY);
+                }
+            } else if (attempt === 0) {
                 // If no completions, maybe just add the word anyway?
                 // or just fail silently. Let's add the word if we can't complete it.
                 addWord(partial);
             }
         } catch (err) {
             console.error("Completion error:", err);
-            addWord(partial); // Fallback
+            if (attempt === 0) addWord(partial); // Fallback
         }
     }
 
@@ -366,6 +451,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // Reset prediction state
         allPredictions = [];
         currentPredictionIndex = 0;
+        predictionRequestId++;
 
         // Schedule next prediction
         schedulePrediction();
@@ -494,31 +580,28 @@ document.addEventListener('DOMContentLoaded', () => {
         // Hide pagination button if it exists
         if (morePredictionsBtn) morePredictionsBtn.classList.add('hidden');
 
-        // We want 3 rows of up to 5 words each
-        const batchSize = 5;
-        // Total rows to display (up to 3)
-        const rowCount = Math.ceil(tokens.length / batchSize);
-
-        for (let i = 0; i < Math.min(rowCount, 3); i++) {
-            const start = i * batchSize;
-            const end = start + batchSize;
-            const batch = tokens.slice(start, end);
-
-            if (batch.length === 0) continue;
-
-            const rowDiv = document.createElement('div');
-            rowDiv.className = `prediction-row priority-${i + 1}`;
+        tokens.forEach((token, index) => appendPrediction(token, index));
+    }
 
-            batch.forEach(token => {
-                const chip = document.createElement('div');
-                chip.className = 'prediction-chip';
-                chip.textContent = token.toLowerCase();
-                chip.onclick = () => addWord(token);
-                rowDiv.appendChild(chip);
-            });
+    // Adds one suggestion at its position in the 3 rows of up to 5 words each,
+    // so streamed suggestions fill the top row first as they arrive.
+    function appendPrediction(token, index) {
+        const batchSize = 5;
+        const row = Math.floor(index / batchSize);
+        if (row >= 3) return;
 
+        let rowDiv = predictionsList.querySelector(`.priority-${row + 1}`);
+        if (!rowDiv) {
+            rowDiv = document.createElement('div');
+            rowDiv.className = `prediction-row priority-${row + 1}`;
             predictionsList.appendChild(rowDiv);
         }
+
+        const chip = document.createElement('div');
+        chip.className = 'prediction-chip';
+        chip.textContent = token.toLowerCase();
+        chip.onclick = () => addWord(token);
+        rowDiv.appendChild(chip);
     }
 
     // Deprecated pagination functions removed